@@ -1,14 +1,25 @@
-from flask import Flask, request, render_template, session, jsonify, redirect, abort
+from flask import Flask, Response, request, render_template, session, jsonify, redirect, abort, stream_with_context
 from flasgger import Swagger
-from utils.db import init_db, get_db
+from utils.db import init_db, init_app, get_db, read_db
 from utils.auth import (
     register_user, login_user, get_user_profile,
     update_user_info, change_password
 )
-from utils.scanner import scan_document, get_matches
+from utils.scanner import scan_document, get_matches, find_near_duplicates, MATCH_MODES
+from utils.minhash import LSH_THRESHOLD
+from utils.ai_matcher import start_warmup, model_status, embedding_service
+from utils.jobs import submit_scan, get_scan, start_workers
+from utils.score_cache import cache_stats
+from utils.pagination import listing_response
+from utils.analytics import dashboard_analytics
+from utils.export import EXPORT_FORMATS, check_export, export_stream
+from utils.metrics import METRICS_ENABLED, render as render_metrics
 from utils.credits import request_credits, approve_credit_request, reject_credit_request
 import os
-from werkzeug.utils import secure_filename
+import queue
+import threading
+from contextlib import ExitStack
+from datetime import datetime
 from jinja2 import TemplateNotFound
 
 app = Flask(__name__)
@@ -17,12 +28,33 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'default_fallback_key')
 app.config['SESSION_COOKIE_SECURE'] = False
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
-app.config['UPLOAD_FOLDER'] = os.path.join('data', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 swagger = Swagger(app)
 init_db()
+init_app(app)
+
+_background_lock = threading.Lock()
+_background_started = False
+
+@app.before_request
+def start_background():
+    # Started from the first request rather than at import, so it happens in
+    # the serving process under any WSGI server (after gunicorn forks, never
+    # in the reloader parent). Tests drive the job queue by hand.
+    global _background_started
+    if _background_started or app.testing:
+        return
+    with _background_lock:
+        if not _background_started:
+            start_warmup()
+            start_workers()
+            _background_started = True
+
+@app.errorhandler(queue.Empty)
+def read_pool_busy(e):
+    # Every pooled read connection stayed busy for the SQLite busy timeout.
+    return jsonify({"error": "Database busy, try again shortly"}), 503, {"Retry-After": "1"}
 
 @app.before_request
 def check_admin():
@@ -209,7 +241,7 @@ def upload():
         required: true
     responses:
       200:
-        description: Document upload result
+        description: Document upload result; an identical earlier upload is returned as a 1.0 match
       401:
         description: Not logged in
     """
@@ -223,56 +255,45 @@ def upload():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
-    try:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-        file.save(file_path)
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        conn = get_db()
-        cursor = conn.execute(
-            'INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
-            (session['username'], filename, content)
-        )
-        doc_id = cursor.lastrowid
-        conn.commit()
-
-        conn.execute('UPDATE users SET credits = credits - 1 WHERE username = ?', (session['username'],))
-        conn.commit()
-
-        return jsonify({"success": True, "document_id": doc_id}), 200
-
-    except Exception as e:
-        print(f"Upload Error: {e}")
-        return jsonify({"error": str(e)}), 500
+    result = scan_document(session['username'], file)
+    if 'error' in result:
+        return jsonify(result), 500
+    return jsonify(result), 200
 
 @app.route('/admin/credit-requests', methods=['GET'])
 def admin_credit_requests():
     """
-    Get all credit requests
+    Get credit requests, newest first, one page at a time
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Cursor from the previous page's "next"
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [json, ndjson]
     responses:
       200:
-        description: List of credit requests
+        description: Page of credit requests and the cursor of the next page
       403:
         description: Unauthorized
     """
     if 'username' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Unauthorized"}), 403
     
-    conn = get_db()
-    cursor = conn.execute('''
-        SELECT cr.id, cr.username, cr.requested_at, cr.status
-        FROM credit_requests cr
-        ORDER BY cr.requested_at DESC
-    ''')
-    
-    requests = [dict(row) for row in cursor.fetchall()]
-    
-    return jsonify({"requests": requests})
+    return listing_response(
+        "requests", 'SELECT id, username, requested_at, status FROM credit_requests',
+        'requested_at', 'id'
+    )
 
 @app.route('/admin/credit-requests/process', methods=['POST'])
 def admin_process_credit_request():
@@ -346,57 +367,233 @@ def admin_process_credit_request():
 @app.route('/admin/users', methods=['GET'])
 def admin_users():
     """
-    Get all users
+    Get users, newest first, one page at a time
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Cursor from the previous page's "next"
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [json, ndjson]
     responses:
       200:
-        description: List of users
+        description: Page of users and the cursor of the next page
       403:
         description: Unauthorized
     """
     if 'username' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Unauthorized"}), 403
     
-    conn = get_db()
-    cursor = conn.execute('''
-        SELECT username, role, credits, created_at
-        FROM users
-        ORDER BY created_at DESC
-    ''')
-    
-    users = [dict(row) for row in cursor.fetchall()]
-    
-    return jsonify({"users": users})
+    return listing_response(
+        "users", 'SELECT username, role, credits, created_at FROM users',
+        'created_at', 'username'
+    )
 
 @app.route('/admin/documents', methods=['GET'])
 def admin_documents():
     """
-    Get all documents
+    Get documents, newest first, one page at a time
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Cursor from the previous page's "next"
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [json, ndjson]
     responses:
       200:
-        description: List of documents
+        description: Page of documents and the cursor of the next page
       403:
         description: Unauthorized
     """
     if 'username' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Unauthorized"}), 403
     
-    conn = get_db()
-    cursor = conn.execute('''
-        SELECT id, username, filename, scanned_at
-        FROM documents
-        ORDER BY scanned_at DESC
-    ''')
-    
-    documents = [dict(row) for row in cursor.fetchall()]
-    
-    return jsonify({"documents": documents})
+    return listing_response(
+        "documents", 'SELECT id, username, filename, scanned_at FROM documents',
+        'scanned_at', 'id'
+    )
     
+@app.route('/admin/export/<table>', methods=['GET'])
+def admin_export(table):
+    """
+    Stream an export of scan_results or documents metadata
+    ---
+    parameters:
+      - name: table
+        in: path
+        type: string
+        required: true
+        enum: [scan_results, documents]
+      - name: format
+        in: query
+        type: string
+        required: false
+        enum: [csv, ndjson, columnar, parquet]
+      - name: start
+        in: query
+        type: string
+        required: false
+        description: First day to include (YYYY-MM-DD)
+      - name: end
+        in: query
+        type: string
+        required: false
+        description: Last day to include (YYYY-MM-DD)
+      - name: username
+        in: query
+        type: string
+        required: false
+      - name: filenames
+        in: query
+        type: boolean
+        required: false
+        description: Join document filenames into scan_results
+      - name: gzip
+        in: query
+        type: boolean
+        required: false
+    responses:
+      200:
+        description: Export stream
+      400:
+        description: Invalid table, format or date
+      403:
+        description: Unauthorized
+    """
+    if 'username' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Unauthorized"}), 403
+
+    fmt = request.args.get('format', 'csv')
+    start, end = request.args.get('start'), request.args.get('end')
+    username = request.args.get('username')
+    with_filenames = request.args.get('filenames', 'false').lower() in ('1', 'true', 'yes')
+    gzip = request.args.get('gzip', 'false').lower() in ('1', 'true', 'yes')
+    try:
+        check_export(table, fmt)
+        for day in (start, end):
+            if day:
+                datetime.strptime(day, '%Y-%m-%d')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Borrowed before streaming starts, so a busy pool is still a 503.
+    reader = ExitStack()
+    conn = reader.enter_context(read_db())
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"{table}.{extension}" + ('.gz' if gzip else '')
+    response = Response(
+        stream_with_context(export_stream(conn, table, fmt, gzip, start, end, username, with_filenames)),
+        mimetype='application/gzip' if gzip else mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+    response.call_on_close(reader.close)
+    return response
+
+@app.route('/admin/score-cache', methods=['GET'])
+def admin_score_cache():
+    """
+    Pair score cache statistics for this process
+    ---
+    responses:
+      200:
+        description: LRU and SQLite hit counts and hit rates
+      403:
+        description: Unauthorized
+    """
+    if 'username' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify(cache_stats())
+
+@app.route('/admin/embedding-service', methods=['GET'])
+def embedding_service_stats():
+    """
+    Micro-batching embedding service metrics
+    ---
+    responses:
+      200:
+        description: Queue depth, batch sizes and wait times of the shared encoder
+      403:
+        description: Unauthorized
+    """
+    if 'username' not in session or session.get('role') != 'admin':
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify(embedding_service().stats())
+
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus metrics: per-stage latency histograms, scan and cache counters, model and queue gauges
+    ---
+    responses:
+      200:
+        description: Metrics in the Prometheus text exposition format
+      404:
+        description: Metrics are disabled (DOCSCAN_METRICS=0)
+    """
+    if not METRICS_ENABLED:
+        return "Metrics are disabled", 404
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health')
+@app.route('/health/live')
 def health():
+    """
+    Liveness probe: the process is up and serving requests
+    ---
+    responses:
+      200:
+        description: Alive
+    """
     return "OK", 200
 
+@app.route('/health/ready')
+def health_ready():
+    """
+    Readiness probe: the database answers and warmup has loaded the models
+    ---
+    responses:
+      200:
+        description: Ready to serve matches
+      503:
+        description: Still warming up, or the database is unreachable
+    """
+    start_warmup()
+    status = model_status()
+    try:
+        with read_db() as conn:
+            conn.execute('SELECT 1').fetchone()
+        status["database"] = "ok"
+    except queue.Empty:
+        status["database"] = "busy"
+    except Exception as e:
+        status["database"] = str(e)
+    status["ready"] = status["warmed_up"] and status["database"] == "ok"
+    return jsonify(status), 200 if status["ready"] else 503
+
 @app.route('/matches/<int:doc_id>', methods=['GET'])
 def matches(doc_id):
     """
@@ -430,9 +627,27 @@ def get_matches_api(doc_id):
         in: path
         type: integer
         required: true
+      - name: top_k
+        in: query
+        type: integer
+        required: false
+        description: Return at most this many matches, best first
+      - name: min_score
+        in: query
+        type: number
+        required: false
+        description: Leave out matches scoring below this (0-1)
+      - name: mode
+        in: query
+        type: string
+        required: false
+        enum: [fast, balanced, exhaustive]
+        description: How many candidates the AI scorer runs on
     responses:
       200:
-        description: JSON data of matching documents
+        description: JSON data of matching documents, with per-stage pruning counts
+      400:
+        description: Invalid top_k, min_score or mode
       401:
         description: Not logged in
       404:
@@ -441,12 +656,124 @@ def get_matches_api(doc_id):
     if 'username' not in session:
         return jsonify({"error": "Not logged in"}), 401
 
-    result = get_matches(session['username'], doc_id)
+    top_k = request.args.get('top_k', type=int)
+    min_score = request.args.get('min_score', 0.0, type=float)
+    mode = request.args.get('mode')
+    if top_k is not None and top_k < 1:
+        return jsonify({"error": "top_k must be at least 1"}), 400
+    if not 0.0 <= min_score <= 1.0:
+        return jsonify({"error": "min_score must be between 0 and 1"}), 400
+    if mode is not None and mode not in MATCH_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(MATCH_MODES)}"}), 400
+
+    result = get_matches(session['username'], doc_id, top_k=top_k, min_score=min_score, mode=mode)
     if isinstance(result, dict) and 'matches' in result:
         return jsonify(result)
     else:
         return jsonify({"error": "Document not found"}), 404
 
+@app.route('/api/scans', methods=['POST'])
+def create_scan():
+    """
+    Queue a Document Scan
+    ---
+    parameters:
+      - name: doc_id
+        in: formData
+        type: integer
+        required: true
+    responses:
+      202:
+        description: Scan queued; poll /api/scans/{job_id} for the result
+      400:
+        description: Missing doc_id
+      401:
+        description: Not logged in
+      404:
+        description: Document not found
+    """
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    data = request.get_json(silent=True) or request.form
+    try:
+        doc_id = int(data.get('doc_id'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "doc_id is required"}), 400
+
+    conn = get_db()
+    doc = conn.execute(
+        'SELECT id FROM documents WHERE id = ? AND username = ?', (doc_id, session['username'])
+    ).fetchone()
+    if not doc:
+        return jsonify({"error": "Document not found"}), 404
+
+    job_id = submit_scan(session['username'], doc_id)
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+@app.route('/api/scans/<int:job_id>', methods=['GET'])
+def scan_status(job_id):
+    """
+    Document Scan Status
+    ---
+    parameters:
+      - name: job_id
+        in: path
+        type: integer
+        required: true
+    responses:
+      200:
+        description: Job status and progress, with the matches once done
+      401:
+        description: Not logged in
+      404:
+        description: Job not found
+    """
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    job = get_scan(session['username'], job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/duplicates/<int:doc_id>', methods=['GET'])
+def get_duplicates_api(doc_id):
+    """
+    Near-Duplicate Documents API
+    ---
+    parameters:
+      - name: doc_id
+        in: path
+        type: integer
+        required: true
+      - name: threshold
+        in: query
+        type: number
+        required: false
+      - name: verify
+        in: query
+        type: boolean
+        required: false
+        description: Re-score candidates with exact Jaccard
+    responses:
+      200:
+        description: Near-duplicates with (estimated) Jaccard similarity
+      401:
+        description: Not logged in
+      404:
+        description: Document not found
+    """
+    if 'username' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    threshold = request.args.get('threshold', LSH_THRESHOLD, type=float)
+    verify = request.args.get('verify', 'false').lower() in ('1', 'true', 'yes')
+    duplicates = find_near_duplicates(session['username'], doc_id, threshold, verify)
+    if duplicates is None:
+        return jsonify({"error": "Document not found"}), 404
+    return jsonify({"duplicates": duplicates, "verified": verify})
+
 @app.route('/credits/request', methods=['POST'])
 def credits_request():
     """
@@ -472,7 +799,7 @@ def admin_dashboard():
 @app.route('/admin/analytics', methods=['GET'])
 def admin_analytics():
     """
-    Get admin analytics data
+    Get admin analytics data, read from the rollup counters
     ---
     responses:
       200:
@@ -483,68 +810,8 @@ def admin_analytics():
     if 'username' not in session or session.get('role') != 'admin':
         return jsonify({"error": "Unauthorized"}), 403
     
-    conn = get_db()
-    
-    cursor = conn.execute('SELECT COUNT(*) as total_scans FROM documents')
-    total_scans = cursor.fetchone()["total_scans"]
-    
-    cursor = conn.execute('''
-        SELECT COUNT(DISTINCT username) as active_users 
-        FROM documents 
-        WHERE scanned_at > datetime('now', '-1 day')
-    ''')
-    active_users = cursor.fetchone()["active_users"]
-    
-    cursor = conn.execute('''
-        SELECT COUNT(*) as pending_credits 
-        FROM credit_requests 
-        WHERE status = 'pending'
-    ''')
-    pending_credits = cursor.fetchone()["pending_credits"]
-    
-    cursor = conn.execute('''
-        SELECT date(scanned_at) as date, COUNT(*) as count 
-        FROM documents 
-        WHERE scanned_at > datetime('now', '-7 days')
-        GROUP BY date(scanned_at)
-        ORDER BY date(scanned_at)
-    ''')
-    scan_timeline = [dict(row) for row in cursor.fetchall()]
-    
-    cursor = conn.execute('''
-        SELECT role, COUNT(*) as count 
-        FROM users 
-        GROUP BY role
-    ''')
-    user_distribution = [dict(row) for row in cursor.fetchall()]
-    
-    cursor = conn.execute('''
-        SELECT sr.id, sr.username, sr.doc_id, sr.matched_doc_id, sr.final_score as similarity,
-               sr.scanned_at as timestamp, d.filename
-        FROM scan_results sr
-        JOIN documents d ON sr.doc_id = d.id
-        ORDER BY sr.scanned_at DESC
-        LIMIT 10
-    ''')
-    recent_matches = []
-    for row in cursor.fetchall():
-        recent_matches.append({
-            "id": row["id"],
-            "username": row["username"],
-            "doc_id": row["doc_id"],
-            "filename": row["filename"],
-            "similarity": row["similarity"],
-            "timestamp": row["timestamp"]
-        })
-    
-    return jsonify({
-        "total_scans": total_scans,
-        "active_users": active_users,
-        "pending_credits": pending_credits,
-        "scan_timeline": scan_timeline,
-        "user_distribution": user_distribution,
-        "recent_matches": recent_matches
-    })
+    with read_db() as conn:
+        return jsonify(dashboard_analytics(conn))
 
 ALLOWED_PAGES = {"login", "register", "credits", "profile", "upload", "dashboard", "index"}
 
@@ -558,4 +825,9 @@ def serve_page(name):
         abort(404)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    debug = True
+    # Under the debug reloader only the child process serves requests.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warmup()
+        start_workers()
+    app.run(host='0.0.0.0', port=8080, debug=debug)
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Recall-vs-latency benchmark for the IVF index against exhaustive search.
+
+    python -m benchmarks.ann_recall --docs 5000 --k 50
+"""
+import argparse
+import time
+import numpy as np
+from utils.ai_matcher import max_chunk_similarity_many
+from utils.ann_index import IVFIndex
+
+def synthetic_corpus(n_docs, dim, n_topics, seed=0):
+    """Documents of 1-4 chunks drawn around shared topic directions."""
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dim))
+    docs = []
+    for _ in range(n_docs):
+        n_chunks = rng.integers(1, 5)
+        centers = topics[rng.integers(0, n_topics, size=n_chunks)]
+        docs.append((centers + 0.6 * rng.normal(size=(n_chunks, dim))).astype(np.float32))
+    return docs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--topics', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    docs = synthetic_corpus(args.docs, args.dim, args.topics)
+    index = IVFIndex(args.dim)
+    start = time.perf_counter()
+    for doc_id, emb in enumerate(docs):
+        index.add(doc_id, emb)
+    index.train()
+    print(f"built index over {len(index.ids)} chunks, {len(index.centroids)} lists "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    queries = range(0, args.docs, max(1, args.docs // args.queries))
+    exact = {}
+    start = time.perf_counter()
+    for q in queries:
+        scores = max_chunk_similarity_many(docs[q], docs)
+        scores[q] = -1
+        exact[q] = set(np.argsort(-scores, kind='stable')[:args.k].tolist())
+    exhaustive_ms = 1000 * (time.perf_counter() - start) / len(exact)
+    print(f"{'exhaustive':>12}  recall@{args.k}=1.000  {exhaustive_ms:8.2f} ms/query")
+
+    for nprobe in args.nprobe:
+        hits = 0
+        start = time.perf_counter()
+        for q in queries:
+            found = {doc_id for doc_id, _ in index.search(docs[q], args.k, nprobe, exclude=q)}
+            hits += len(found & exact[q])
+        elapsed_ms = 1000 * (time.perf_counter() - start) / len(exact)
+        recall = hits / (args.k * len(exact))
+        print(f"{'nprobe=' + str(nprobe):>12}  recall@{args.k}={recall:.3f}  {elapsed_ms:8.2f} ms/query")
+
+if __name__ == '__main__':
+    main()
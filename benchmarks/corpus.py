@@ -0,0 +1,124 @@
+"""
+Deterministic synthetic corpora and offline stand-ins for the embedding
+model and NLTK data, shared by the benchmarks.
+"""
+import re
+import zlib
+import numpy as np
+
+_SYLLABLES = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiou']
+
+def _word(i):
+    """The i-th pseudo-word: i written in base len(_SYLLABLES), at least two syllables."""
+    syllables = []
+    while True:
+        i, digit = divmod(i, len(_SYLLABLES))
+        syllables.append(_SYLLABLES[digit])
+        if not i and len(syllables) >= 2:
+            return ''.join(syllables)
+
+class SyntheticCorpus:
+    """
+    Documents built from Zipf-distributed pseudo-words in sentences, with a
+    share of exact duplicates, paraphrases (synonym swaps, dropped words,
+    reordered sentences) and long documents. The same seed always yields
+    the same corpus.
+    """
+
+    def __init__(self, seed=0, vocabulary=20000, topics=50):
+        self.rng = np.random.default_rng(seed)
+        self.words = [_word(i) for i in range(vocabulary)]
+        weights = 1 / np.arange(1, vocabulary + 1)
+        self.word_cdf = np.cumsum(weights / weights.sum())
+        # Each topic favours its own slice of the vocabulary.
+        self.topics = [self.rng.choice(vocabulary, size=200, replace=False) for _ in range(topics)]
+        self.synonyms = {w: self.words[(i + 1) % vocabulary] for i, w in enumerate(self.words) if i % 2 == 0}
+
+    def sentence(self, topic, length):
+        common = np.minimum(np.searchsorted(self.word_cdf, self.rng.random(length)), len(self.words) - 1)
+        topical = self.rng.choice(self.topics[topic], size=length)
+        picks = np.where(self.rng.random(length) < 0.4, topical, common)
+        words = [self.words[i] for i in picks]
+        return ' '.join(words).capitalize() + '.'
+
+    def document(self, n_words):
+        topic = int(self.rng.integers(len(self.topics)))
+        sentences, total = [], 0
+        while total < n_words:
+            length = int(self.rng.integers(6, 20))
+            sentences.append(self.sentence(topic, length))
+            total += length
+        return ' '.join(sentences)
+
+    def paraphrase(self, text, swap=0.3, drop=0.1):
+        sentences = re.split(r'(?<=\.) ', text)
+        order = self.rng.permutation(len(sentences))
+        out = []
+        for i in order:
+            words = []
+            for word in sentences[i].split():
+                roll = self.rng.random()
+                if roll < drop:
+                    continue
+                if roll < drop + swap:
+                    word = self.synonyms.get(word.lower().rstrip('.'), word)
+                words.append(word)
+            out.append(' '.join(words))
+        return ' '.join(out)
+
+    def generate(self, n_docs, duplicate_share=0.05, paraphrase_share=0.1, long_share=0.02,
+                 short_words=(50, 400), long_words=(3000, 8000)):
+        """List of (kind, text) pairs; kind is original, long, duplicate or paraphrase."""
+        docs = []
+        for _ in range(n_docs):
+            roll = self.rng.random()
+            if docs and roll < duplicate_share:
+                docs.append(("duplicate", docs[int(self.rng.integers(len(docs)))][1]))
+            elif docs and roll < duplicate_share + paraphrase_share:
+                docs.append(("paraphrase", self.paraphrase(docs[int(self.rng.integers(len(docs)))][1])))
+            elif roll < duplicate_share + paraphrase_share + long_share:
+                docs.append(("long", self.document(int(self.rng.integers(*long_words)))))
+            else:
+                docs.append(("original", self.document(int(self.rng.integers(*short_words)))))
+        return docs
+
+class StubEmbeddingModel:
+    """
+    Offline stand-in for the sentence-transformers model: a hashed
+    bag-of-words projection, so similar chunks get similar vectors.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.split():
+                embeddings[row, zlib.crc32(word.encode()) % self.dim] += 1.0
+        return embeddings
+
+class _StubStemmer:
+    def stem(self, word):
+        return word
+
+def stub_nltk_tools():
+    """Regex stand-ins for the NLTK tokenizers, stopwords and stemmer."""
+    return {
+        "sent_tokenize": lambda text: [s for s in re.split(r'(?<=[.!?])\s+', text) if s],
+        "word_tokenize": lambda text: re.findall(r'\w+', text),
+        "stop_words": {'the', 'a', 'an', 'and', 'or', 'of', 'to', 'in', 'is', 'it'},
+        "stemmer": _StubStemmer()
+    }
+
+def use_offline_models():
+    """
+    Point ai_matcher at the stub model, and at stub NLTK tools when the
+    NLTK data is not installed. Returns which NLTK tools are in use.
+    """
+    from utils import ai_matcher
+    ai_matcher._model = StubEmbeddingModel()
+    if ai_matcher.initialize_nltk(download=False):
+        ai_matcher._nltk = stub_nltk_tools()
+        return "stub"
+    return "nltk"
@@ -0,0 +1,75 @@
+"""
+Encode throughput and peak memory of each embedding backend. Every backend
+runs in a fresh process so its peak RSS is not inflated by the others.
+
+    python -m benchmarks.embedding_backends --chunks 512 --words 150
+"""
+import time
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from utils.ai_matcher import MODEL_NAME
+from utils.embedding_backends import BACKEND_REQUIREMENTS, backend_available, load_backend
+
+def synthetic_chunks(n_chunks, n_words, vocabulary=2000, seed=0):
+    """Chunks of pseudo-words, about as long as chunk_text produces."""
+    rng = np.random.default_rng(seed)
+    words = [f"w{i}" for i in range(vocabulary)]
+    return [' '.join(rng.choice(words, size=n_words)) for _ in range(n_chunks)]
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_backend(name, chunks, repeats):
+    start = time.perf_counter()
+    backend = load_backend(name, MODEL_NAME)
+    backend.encode(chunks[:8])
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        embeddings = backend.encode(chunks)
+    elapsed = time.perf_counter() - start
+    return {
+        "load_seconds": load_seconds,
+        "chunks_per_second": repeats * len(chunks) / elapsed,
+        "peak_rss_mb": _peak_rss_mb(),
+        "embeddings": embeddings
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=list(BACKEND_REQUIREMENTS))
+    parser.add_argument('--chunks', type=int, default=512)
+    parser.add_argument('--words', type=int, default=150)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = synthetic_chunks(args.chunks, args.words)
+    reference = None
+    print(f"{'backend':>12}  {'chunks/s':>9}  {'load s':>7}  {'peak MB':>8}  {'max |cos drift|':>15}")
+    for name in args.backends:
+        if not backend_available(name):
+            print(f"{name:>12}  skipped: needs {', '.join(BACKEND_REQUIREMENTS[name])}")
+            continue
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            try:
+                result = pool.submit(run_backend, name, chunks, args.repeats).result()
+            except Exception as e:
+                print(f"{name:>12}  failed: {e}")
+                continue
+
+        embeddings = result["embeddings"]
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-9)
+        if reference is None:
+            reference, drift = embeddings, 0.0
+        else:
+            drift = float(np.abs(embeddings @ embeddings.T - reference @ reference.T).max())
+        print(f"{name:>12}  {result['chunks_per_second']:9.1f}  {result['load_seconds']:7.2f}  "
+              f"{result['peak_rss_mb']:8.0f}  {drift:15.4f}")
+
+if __name__ == '__main__':
+    main()
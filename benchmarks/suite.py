@@ -0,0 +1,224 @@
+"""
+Benchmarks of the scanner and matcher hot paths on a synthetic corpus,
+offline, with a stub embedding model. Results are written as JSON; with
+--compare, best times are checked against a stored baseline and the run
+fails if any benchmark slowed down by more than --threshold.
+
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --compare baseline.json
+    python -m benchmarks.suite --only scaling
+    python -m benchmarks.suite --sizes 100 1000 --only e2e
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import numpy as np
+from benchmarks.corpus import SyntheticCorpus, use_offline_models
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+# Queries timed per corpus size: one of each kind where the corpus has it.
+QUERY_KINDS = ["original", "duplicate", "paraphrase", "long"]
+
+def measure(fn, repeats=5, min_time=0.2):
+    """Median and best seconds per call over `repeats` rounds of at least min_time each."""
+    fn()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        if time.perf_counter() - start >= min_time / 10:
+            break
+        calls *= 2
+    per_round = max(1, int(calls * min_time / max(time.perf_counter() - start, 1e-9)))
+
+    rounds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(per_round):
+            fn()
+        rounds.append((time.perf_counter() - start) / per_round)
+    return {"median_s": statistics.median(rounds), "min_s": min(rounds), "calls": per_round * repeats}
+
+def micro_benchmarks(corpus, repeats):
+    from utils import scanner, ai_matcher
+    short_a, short_b = corpus.document(200), corpus.document(200)
+    long_a = corpus.document(5000)
+    long_b = corpus.paraphrase(long_a)
+    clean = {name: ai_matcher.preprocess_text(text) for name, text in
+             (("short_a", short_a), ("short_b", short_b), ("long_a", long_a), ("long_b", long_b))}
+
+    cases = {
+        "scanner.preprocess_text[long]": lambda: scanner.preprocess_text(long_a),
+        "calculate_similarity[short]": lambda: scanner.calculate_similarity(short_a, short_b),
+        "calculate_similarity[long]": lambda: scanner.calculate_similarity(long_a, long_b),
+        "calculate_cosine_similarity[short]": lambda: scanner.calculate_cosine_similarity(short_a, short_b),
+        "calculate_cosine_similarity[long]": lambda: scanner.calculate_cosine_similarity(long_a, long_b),
+        "ai_matcher.preprocess_text[long]": lambda: ai_matcher.preprocess_text(long_a),
+        "chunk_text[long]": lambda: ai_matcher.chunk_text(clean["long_a"]),
+        "custom_tfidf_similarity[short]": lambda: ai_matcher.custom_tfidf_similarity(clean["short_a"], clean["short_b"]),
+        "custom_tfidf_similarity[long]": lambda: ai_matcher.custom_tfidf_similarity(clean["long_a"], clean["long_b"]),
+        "transformer_similarity[short]": lambda: ai_matcher.transformer_similarity(clean["short_a"], clean["short_b"]),
+        "transformer_similarity[long]": lambda: ai_matcher.transformer_similarity(clean["long_a"], clean["long_b"]),
+    }
+    results = {}
+    for name, fn in cases.items():
+        results[f"micro/{name}"] = measure(fn, repeats)
+        print(f"{name:>42}  {1e6 * results[f'micro/{name}']['median_s']:12.1f} us")
+    return results
+
+def scaling_benchmarks(corpus, repeats, lengths=(1000, 4000, 16000, 64000)):
+    """Dependency-free TF-IDF scoring against document length; time per word should stay flat."""
+    from utils import ai_matcher
+    from utils.tfidf import tfidf_similarity_many
+    results = {}
+    for n in lengths:
+        a, b = corpus.document(n).lower(), corpus.document(n).lower()
+        result = measure(lambda: ai_matcher.custom_tfidf_similarity(a, b), repeats)
+        result["ns_per_word"] = 1e9 * result["median_s"] / (2 * n)
+        results[f"scaling/custom_tfidf_similarity[words={n}]"] = result
+        print(f"{'custom_tfidf_similarity words=' + str(n):>42}  {1e6 * result['median_s']:12.1f} us"
+              f"  {result['ns_per_word']:8.0f} ns/word")
+
+    target = corpus.document(500).lower().split()
+    candidates = [corpus.document(500).lower().split() for _ in range(1000)]
+    result = measure(lambda: tfidf_similarity_many(target, candidates), repeats)
+    results["scaling/tfidf_similarity_many[candidates=1000]"] = result
+    print(f"{'tfidf_similarity_many 1000 x 500 words':>42}  {1e6 * result['median_s']:12.1f} us")
+    return results
+
+def _load_user(conn, username, docs, batch_size=500):
+    """Store and index a corpus for one user, as uploads would."""
+    from utils.scanner import prepare_document, index_document
+    from utils.ann_index import add_to_index
+    conn.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, 'x')", (username,))
+    conn.commit()
+    doc_ids = {}
+    for start in range(0, len(docs), batch_size):
+        batch = docs[start:start + batch_size]
+        prepared = [prepare_document(text) for _, text in batch]
+        indexed = []
+        for i, ((kind, text), document) in enumerate(zip(batch, prepared), start):
+            doc_id = conn.execute(
+                'INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                (username, f"{kind}-{i}.txt", text)
+            ).lastrowid
+            indexed.append((doc_id, index_document(conn, username, doc_id, text, prepared=document)))
+            doc_ids.setdefault(kind, []).append(doc_id)
+        conn.commit()
+        for doc_id, embeddings in indexed:
+            if embeddings is not None:
+                add_to_index(username, doc_id, embeddings)
+    return doc_ids
+
+def end_to_end_benchmarks(corpus, sizes, mode):
+    from utils.db import init_db, get_db
+    from utils.scanner import get_matches
+    init_db()
+    conn = get_db()
+    results = {}
+    for n in sizes:
+        docs = corpus.generate(n)
+        start = time.perf_counter()
+        doc_ids = _load_user(conn, f"bench{n}", docs)
+        ingest_s = time.perf_counter() - start
+        results[f"e2e/ingest[n={n}]"] = {"median_s": ingest_s / n, "min_s": ingest_s / n, "calls": n}
+        print(f"{'ingest n=' + str(n):>42}  {1e6 * ingest_s / n:12.1f} us/doc")
+
+        for kind in QUERY_KINDS:
+            if kind not in doc_ids:
+                continue
+            doc_id = doc_ids[kind][-1]
+            timings = {}
+            for phase in ("cold", "warm"):
+                start = time.perf_counter()
+                result = get_matches(f"bench{n}", doc_id, mode=mode)
+                timings[phase] = time.perf_counter() - start
+            name = f"e2e/get_matches[n={n},{kind}]"
+            results[name] = {
+                "median_s": timings["cold"], "min_s": timings["cold"], "calls": 1,
+                "warm_s": timings["warm"], "candidates": result["cascade"]["candidates"],
+                "ai_scored": result["cascade"]["ai_scored"]
+            }
+            print(f"{'get_matches n=' + str(n) + ' ' + kind:>42}  {1e3 * timings['cold']:9.1f} ms cold"
+                  f"  {1e3 * timings['warm']:9.1f} ms warm  ({result['cascade']['candidates']} candidates)")
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Benchmarks whose best time slowed down by more than threshold (a
+    fraction); the best of several rounds is far less noisy than the median.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None or not before["min_s"]:
+            continue
+        change = result["min_s"] / before["min_s"] - 1
+        flag = "REGRESSION" if change > threshold else ""
+        print(f"{name:>60}  {change:+8.1%}  {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--only', choices=['micro', 'scaling', 'e2e'])
+    parser.add_argument('--mode', default=None, help="get_matches cascade mode (default: DOCSCAN_MATCH_MODE)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.15, help="allowed slowdown, as a fraction")
+    parser.add_argument('--workdir', help="where the benchmark database is built (default: a temp dir)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    # The app keeps its database, blobs and indexes under ./data.
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix='docscan-bench-'))
+
+    nltk_tools = use_offline_models()
+    corpus = SyntheticCorpus(args.seed)
+    results = {}
+    if args.only in (None, 'micro'):
+        results.update(micro_benchmarks(corpus, args.repeats))
+    if args.only in (None, 'scaling'):
+        results.update(scaling_benchmarks(corpus, args.repeats))
+    if args.only in (None, 'e2e'):
+        results.update(end_to_end_benchmarks(corpus, args.sizes, args.mode))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+            "model": "stub",
+            "nltk": nltk_tools
+        },
+        "results": results
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
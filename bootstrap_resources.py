@@ -0,0 +1,21 @@
+import sys
+from utils.ai_matcher import HAVE_TRANSFORMERS, MODEL_NAME, EMBEDDING_BACKEND, initialize_nltk, warmup
+from utils.embedding_backends import export_onnx
+
+# Run at image build time so the NLTK data and the transformer weights are in
+# the image (under NLTK_DATA and SENTENCE_TRANSFORMERS_HOME) and the app never
+# needs the network at runtime.
+if __name__ == '__main__':
+    missing = initialize_nltk(download=True)
+    if missing:
+        sys.exit(f"Could not download NLTK resources: {', '.join(missing)}")
+    print("NLTK resources ready.")
+
+    if EMBEDDING_BACKEND.startswith('onnx'):
+        paths = export_onnx(MODEL_NAME)
+        print(f"Exported {MODEL_NAME} to {paths['onnx']} and {paths['onnx-int8']}.")
+
+    status = warmup()
+    if HAVE_TRANSFORMERS and status["model"] != "loaded":
+        sys.exit(f"Could not load {MODEL_NAME}")
+    print(f"Scorer backend ready: {status['backend']}.")
@@ -0,0 +1,31 @@
+import sys
+import argparse
+from utils.db import get_db
+from utils.export import EXPORT_TABLES, EXPORT_FORMATS, export_stream
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream an export of scan results or document metadata.")
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--start', help="first day to include (YYYY-MM-DD)")
+    parser.add_argument('--end', help="last day to include (YYYY-MM-DD)")
+    parser.add_argument('--user', help="only this user's rows")
+    parser.add_argument('--filenames', action='store_true', help="join document filenames into scan_results")
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--output', help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    conn = get_db()
+    try:
+        chunks = export_stream(conn, args.table, args.format, args.gzip, args.start, args.end,
+                               args.user, args.filenames)
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
@@ -0,0 +1,26 @@
+import sys
+from utils.db import get_db
+from utils.blob_store import migrate_documents, BLOB_FOLDER
+from utils.text_pipeline import migrate_document_texts
+
+if __name__ == '__main__':
+    conn = get_db()
+    total = 0
+    while True:
+        moved = migrate_documents(conn)
+        total += moved
+        if moved == 0:
+            break
+    print(f"Moved {total} document bodies to {BLOB_FOLDER}.")
+
+    total = 0
+    while True:
+        moved = migrate_document_texts(conn)
+        total += moved
+        if moved == 0:
+            break
+    print(f"Moved {total} documents' text artifacts to {BLOB_FOLDER}.")
+
+    if '--vacuum' in sys.argv:
+        conn.execute('VACUUM')
+        print("Database vacuumed.")
@@ -0,0 +1,9 @@
+from utils.db import get_db
+from utils.analytics import rebuild_rollups
+
+if __name__ == '__main__':
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    rebuild_rollups(conn)
+    conn.commit()
+    print("Analytics rollups rebuilt from the raw tables.")
@@ -0,0 +1,12 @@
+from utils.db import get_db
+from utils.tfidf import refresh_stale_vectors
+
+if __name__ == '__main__':
+    conn = get_db()
+    total = 0
+    while True:
+        refreshed = refresh_stale_vectors(conn)
+        total += refreshed
+        if refreshed == 0:
+            break
+    print(f"Refreshed {total} stale TF-IDF vectors.")
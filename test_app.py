@@ -3,6 +3,27 @@ from app import app
 from flask import session
 import time
 
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    """Point the database, blob store and ANN indexes at a fresh directory per test"""
+    import queue
+    from collections import OrderedDict
+    from utils import db, blob_store, ann_index, score_cache
+    db.close_thread_db()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'document_scanner.db'))
+    monkeypatch.setattr(db, '_read_pool', queue.LifoQueue())
+    monkeypatch.setattr(db, '_read_pool_created', 0)
+    monkeypatch.setattr(blob_store, 'BLOB_FOLDER', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(ann_index, 'ANN_INDEX_FOLDER', str(tmp_path / 'ann'))
+    monkeypatch.setattr(ann_index, '_indexes', {})
+    monkeypatch.setattr(score_cache, '_lru', OrderedDict())
+    monkeypatch.setattr(score_cache, '_purged', set())
+    db.init_db()
+    yield tmp_path
+    db.close_thread_db()
+    while not db._read_pool.empty():
+        db._read_pool.get_nowait().close()
+
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
@@ -42,4 +63,787 @@ def test_logout(client):
         sess['username'] = 'testuser'
     response = client.post('/auth/logout')
     assert response.status_code == 200
-    assert response.json['message'] == "Logged out"
\ No newline at end of file
+    assert response.json['message'] == "Logged out"
+
+class StubModel:
+    """Deterministic stand-in for the sentence transformer"""
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, chunks):
+        import numpy as np
+        self.calls += 1
+        return np.array([[len(c) % 7 + 1.0, c.count('e') + 1.0, 1.0] for c in chunks])
+
+class WriteLockProbeModel(StubModel):
+    """StubModel that records whether the database write lock was free at each encode"""
+    def __init__(self):
+        super().__init__()
+        self.lock_free = []
+
+    def encode(self, chunks):
+        import sqlite3
+        from utils import db
+        probe = sqlite3.connect(db.DB_PATH, timeout=0)
+        try:
+            probe.execute('BEGIN IMMEDIATE')
+            probe.rollback()
+            self.lock_free.append(True)
+        except sqlite3.OperationalError:
+            self.lock_free.append(False)
+        finally:
+            probe.close()
+        return super().encode(chunks)
+
+def test_upload_stores_embeddings(client, mocker):
+    """Uploaded documents are encoded once, outside the write transaction, and reused when matching"""
+    import io
+    from utils.db import get_db
+    from utils.scanner import get_matches
+    model = WriteLockProbeModel()
+    mocker.patch('utils.ai_matcher.get_model', return_value=model)
+    mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+
+    doc_ids = []
+    for text in (b"the quick brown fox jumps", b"the lazy fox sleeps all day"):
+        response = client.post('/upload', data={'document': (io.BytesIO(text), 'emb.txt')},
+                               content_type='multipart/form-data')
+        assert response.status_code == 200
+        doc_ids.append(response.json['document_id'])
+
+    row = get_db().execute('SELECT n_chunks, dim FROM document_embeddings WHERE doc_id = ?',
+                           (doc_ids[0],)).fetchone()
+    assert (row['n_chunks'], row['dim']) == (1, 3)
+    assert model.lock_free and all(model.lock_free)
+    from utils.embeddings import load_chunk_offsets
+    from utils.text_pipeline import load_document_texts
+    stemmed = load_document_texts(get_db(), [doc_ids[0]])[doc_ids[0]]["stemmed"]
+    assert load_chunk_offsets(get_db(), doc_ids[0]).tolist() == [[0, len(stemmed)]]
+
+    # The first match may backfill older documents; a repeat must not encode anything.
+    get_matches('admin', doc_ids[0])
+    calls = model.calls
+    result = get_matches('admin', doc_ids[0])
+    assert any(m['id'] == doc_ids[1] for m in result['matches'])
+    assert model.calls == calls
+    # Repeats, in either direction, are served from the pair cache.
+    assert result['cache']['misses'] == 0
+    reverse = get_matches('admin', doc_ids[1])
+    assert next(m for m in reverse['matches'] if m['id'] == doc_ids[0])['metrics'] == \
+        next(m for m in result['matches'] if m['id'] == doc_ids[1])['metrics']
+
+def test_streaming_upload_matches_full_read(client, mocker):
+    """The single-pass reader agrees with a full decode, and identical uploads short-circuit"""
+    import io
+    import hashlib
+    from collections import Counter
+    from utils.ingest import read_upload
+    from utils.text_pipeline import normalize_text
+    for raw in ("Caf\u00e9 na\u00efve, r\u00e9sum\u00e9! Hello-world x_y".encode('utf-8') * 3,
+                b"plain ascii first, then caf\xe9 cr\xe8me " * 5):
+        upload = read_upload(io.BytesIO(raw), chunk_size=7)
+        try:
+            content = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            content = raw.decode('latin-1')
+        assert upload["content"] == content
+        assert upload["sha256"] == hashlib.sha256(raw).hexdigest()
+        assert upload["normalized"] == normalize_text(content)
+        assert upload["term_counts"] == Counter(normalize_text(content).split())
+
+    mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+    text = b"duplicate upload"
+    first = client.post('/upload', data={'document': (io.BytesIO(text), 'a.txt')},
+                        content_type='multipart/form-data').json
+    second = client.post('/upload', data={'document': (io.BytesIO(text), 'b.txt')},
+                         content_type='multipart/form-data').json
+    assert second['duplicate_of'] == first['document_id']
+    assert second['matches'][0]['similarity'] == 1.0
+
+def test_max_chunk_similarity_many_matches_pairwise():
+    """Vectorized one-vs-many scoring agrees with the pairwise chunk loop"""
+    import numpy as np
+    from utils.ai_matcher import max_chunk_similarity_many
+    rng = np.random.default_rng(0)
+    target = rng.normal(size=(3, 8))
+    candidates = [rng.normal(size=(n, 8)) for n in (1, 4, 2)]
+
+    expected = []
+    for cand in candidates:
+        sims = [np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)) for a in target for b in cand]
+        expected.append(max(0, max(sims)))
+
+    assert np.allclose(max_chunk_similarity_many(target, candidates, block_size=3), expected, atol=1e-5)
+
+def test_parallel_scoring_matches_in_process(mocker):
+    """Sharding candidates across the process pool gives the in-process scores"""
+    import numpy as np
+    from utils.ai_matcher import max_chunk_similarity_many
+    from utils.parallel import score_segments, shutdown_pool
+    from utils.tfidf import sparse_dot_kernel
+    mocker.patch('utils.ai_matcher.PARALLEL_MIN_CHUNKS', 0)
+    rng = np.random.default_rng(1)
+    target = rng.normal(size=(3, 8))
+    candidates = [rng.normal(size=(n, 8)) for n in (1, 4, 2, 7, 3)] + [None]
+
+    dense = rng.random(50).astype(np.float32)
+    features = rng.integers(0, 50, size=20).astype(np.int32)
+    weights = rng.random(20).astype(np.float32)
+    lengths = [5, 3, 8, 4]
+    try:
+        assert np.allclose(max_chunk_similarity_many(target, candidates, workers=2),
+                           max_chunk_similarity_many(target, candidates, workers=1), atol=1e-6)
+        assert np.allclose(score_segments(sparse_dot_kernel, [features, weights], lengths, [dense], workers=2),
+                           score_segments(sparse_dot_kernel, [features, weights], lengths, [dense], workers=1))
+    finally:
+        shutdown_pool()
+
+def test_ivf_index_persists_and_finds_neighbours(tmp_path):
+    """The ANN index survives a reload and agrees with exhaustive search when fully probed"""
+    import numpy as np
+    from utils.ai_matcher import max_chunk_similarity_many
+    from utils.ann_index import IVFIndex
+    rng = np.random.default_rng(1)
+    docs = [rng.normal(size=(rng.integers(1, 4), 16)).astype(np.float32) for _ in range(200)]
+
+    index = IVFIndex(16, str(tmp_path))
+    index.save()
+    for doc_id, emb in enumerate(docs):
+        index.add(doc_id, emb)
+    assert index.centroids is not None
+
+    reloaded = IVFIndex.load(str(tmp_path))
+    found = [doc_id for doc_id, _ in reloaded.search(docs[0], k=5, nprobe=len(reloaded.centroids), exclude=0)]
+    scores = max_chunk_similarity_many(docs[0], docs)
+    scores[0] = -1
+    assert found == np.argsort(-scores, kind='stable')[:5].tolist()
+
+def test_ivf_index_writers_share_files(tmp_path):
+    """Two copies of one index (as in two processes) keep each other's rows and never duplicate a document"""
+    import numpy as np
+    from utils.ann_index import IVFIndex
+    rng = np.random.default_rng(2)
+    docs = [rng.normal(size=(2, 16)).astype(np.float32) for _ in range(200)]
+
+    first, second = IVFIndex(16, str(tmp_path)), IVFIndex(16, str(tmp_path))
+    for doc_id, emb in enumerate(docs):
+        (first if doc_id % 2 else second).add(doc_id, emb)
+        second.add(doc_id, emb)
+    assert first.centroids is not None
+
+    reloaded = IVFIndex.load(str(tmp_path))
+    assert sorted(reloaded.ids.tolist()) == sorted(2 * list(range(len(docs))))
+    assert reloaded.vectors.shape == (2 * len(docs), 16)
+    for doc_id in (0, 1, 199):
+        rows = reloaded.vectors[reloaded.ids == doc_id]
+        assert np.allclose(rows, docs[doc_id] / np.linalg.norm(docs[doc_id], axis=1, keepdims=True), atol=1e-6)
+
+def test_lexical_scores_match_exact_scorers(client):
+    """Postings-based Jaccard and cosine agree with the per-pair scanner functions"""
+    from utils.db import get_db
+    from utils.scanner import index_document, calculate_similarity, calculate_cosine_similarity
+    from utils.term_index import lexical_scores
+    texts = ["The cat sat on the mat, the end.", "A cat and a dog sat together.", "Nothing in common here!",
+             "On the other hand."]
+    conn = get_db()
+    ids = []
+    for text in texts:
+        doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                              ('admin', 'lexical.txt', text)).lastrowid
+        index_document(conn, 'admin', doc_id, text)
+        ids.append(doc_id)
+    conn.commit()
+
+    scores = lexical_scores(conn, 'admin', ids[0])
+    assert scores[ids[1]]["jaccard"] == calculate_similarity(texts[0], texts[1])
+    assert abs(scores[ids[1]]["cosine"] - calculate_cosine_similarity(texts[0], texts[1])) < 1e-9
+    assert ids[2] not in scores
+    # Sharing only stopwords does not count towards the candidate filter.
+    assert (scores[ids[1]]["shared_content"], scores[ids[3]]["shared"], scores[ids[3]]["shared_content"]) == (2, 2, 0)
+
+def test_minhash_estimates_jaccard():
+    """MinHash signatures estimate the scanner's word-set Jaccard"""
+    from utils.minhash import minhash_signature, estimate_jaccard, MINHASH_PERM
+    from utils.scanner import calculate_similarity
+    doc1 = ' '.join(f"w{i}" for i in range(300))
+    doc2 = ' '.join(f"w{i}" for i in range(100, 400))
+    estimate = estimate_jaccard(minhash_signature(doc1.split()), [minhash_signature(doc2.split())])[0]
+    assert abs(estimate - calculate_similarity(doc1, doc2)) < 3 / MINHASH_PERM ** 0.5
+    assert estimate_jaccard(minhash_signature([]), [minhash_signature([])])[0] == 0
+
+def test_tfidf_model_matches_sklearn(client):
+    """The incremental per-user TF-IDF model scores like a TfidfVectorizer fitted on the corpus"""
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from utils.db import get_db
+    from utils.tfidf import add_document, refresh_stale_vectors, tfidf_scores
+    username = 'tfidf'
+    texts = ["apple banana apple cherry", "banana cherry durian", "apple durian elderberry fig", "fig grape"]
+    conn = get_db()
+    conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, 'x'))
+    ids = []
+    for text in texts:
+        doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                              (username, 'tfidf.txt', text)).lastrowid
+        add_document(conn, username, doc_id, text.split())
+        ids.append(doc_id)
+    assert refresh_stale_vectors(conn, tolerance=-1, username=username) == len(texts)
+
+    matrix = TfidfVectorizer(token_pattern=r'\S+').fit_transform(texts)
+    expected = (matrix[1:] @ matrix[0].T).toarray().ravel()
+    assert np.allclose(tfidf_scores(conn, username, ids[0], ids[1:]), expected, atol=1e-5)
+
+def test_text_artifacts_rederived_on_pipeline_bump(client, mocker):
+    """Derived text is computed once at ingest and recomputed lazily after a version bump"""
+    from utils.db import get_db
+    from utils import text_pipeline
+    from utils.scanner import index_document, refresh_document_indexes
+    stem = mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    conn = get_db()
+    doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                          ('admin', 'pipeline.txt', 'Hello, hello World!')).lastrowid
+    index_document(conn, 'admin', doc_id, 'Hello, hello World!')
+    conn.commit()
+
+    text = text_pipeline.load_document_texts(conn, [doc_id])[doc_id]
+    assert text["normalized"] == "hello hello world"
+    assert text["term_counts"] == {"hello": 2, "world": 1}
+    assert stem.call_count == 1
+
+    mocker.patch.object(text_pipeline, 'PIPELINE_VERSION', text_pipeline.PIPELINE_VERSION + 1)
+    refresh_document_indexes(conn, 'admin')
+    row = conn.execute('SELECT pipeline_version FROM document_text WHERE doc_id = ?', (doc_id,)).fetchone()
+    assert row["pipeline_version"] == text_pipeline.PIPELINE_VERSION
+
+    # Without NLTK the stored artifacts are used as they are, and TF-IDF
+    # falls back to the normalized text; stemming is retried once NLTK loads.
+    from utils.scanner import backfill_tfidf_model
+    from utils.tfidf import unvectorized_documents
+    stem.side_effect = LookupError('NLTK resources unavailable')
+    other_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                            ('admin', 'unstemmed.txt', 'Unstemmed words')).lastrowid
+    index_document(conn, 'admin', other_id, 'Unstemmed words')
+    conn.commit()
+    calls = stem.call_count
+    for _ in range(2):
+        refresh_document_indexes(conn, 'admin')
+        backfill_tfidf_model(conn, 'admin')
+        assert text_pipeline.load_document_texts(conn, [other_id])[other_id]["stemmed"] is None
+    assert stem.call_count == calls and other_id not in unvectorized_documents(conn, 'admin')
+
+    stem.side_effect = str.lower
+    mocker.patch('utils.text_pipeline.nltk_loaded', return_value=True)
+    refresh_document_indexes(conn, 'admin')
+    assert text_pipeline.load_document_texts(conn, [other_id])[other_id]["stemmed"] == 'unstemmed words'
+
+def test_stale_score_purge_keeps_other_backend(client):
+    """Only scores from older scorer versions are purged, not the other backend's"""
+    from utils.db import get_db
+    from utils.score_cache import purge_stale_scores, _version_prefix
+    conn = get_db()
+    ids = [conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                        ('admin', 'purge.txt', text)).lastrowid for text in ('first', 'second')]
+    current = _version_prefix()
+    for scorer in (current + 'tfidf', current + 'model@onnx', 'v0:p0:tfidf'):
+        conn.execute('INSERT OR REPLACE INTO pair_scores (doc_a, doc_b, scorer, score) VALUES (?, ?, ?, 0.5)',
+                     (*ids, scorer))
+    conn.commit()
+    purge_stale_scores(conn)
+    kept = {row[0] for row in conn.execute('SELECT scorer FROM pair_scores WHERE doc_a = ? AND doc_b = ?', ids)}
+    assert kept == {current + 'tfidf', current + 'model@onnx'}
+
+def test_scan_job_lifecycle(client, mocker):
+    """Queued scans are claimed, run and reported; orphaned jobs are requeued"""
+    from utils.db import get_db
+    from utils import jobs
+    mocker.patch('utils.ai_matcher.get_model', return_value=StubModel())
+    mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+
+    conn = get_db()
+    doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                          ('admin', 'job.txt', 'background scan text')).lastrowid
+    conn.commit()
+    assert client.post('/api/scans', json={'doc_id': 10 ** 9}).status_code == 404
+    response = client.post('/api/scans', json={'doc_id': doc_id})
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+    assert client.get(f'/api/scans/{job_id}').json['status'] == 'queued'
+
+    # Simulate a worker that died mid-scan: its stale heartbeat gets the job requeued.
+    job = jobs.claim_job(conn, 'crashed')
+    assert job["id"] == job_id
+    conn.execute("UPDATE scan_jobs SET heartbeat_at = datetime('now', '-1 hour') WHERE id = ?", (job_id,))
+    jobs.reclaim_orphaned_jobs(conn)
+    assert client.get(f'/api/scans/{job_id}').json['status'] == 'queued'
+
+    jobs.run_job(conn, jobs.claim_job(conn, 'test'))
+    status = client.get(f'/api/scans/{job_id}').json
+    assert status['status'] == 'done' and status['progress'] == 1
+    assert 'matches' in status
+
+def test_scan_workers_survive_database_errors(mocker):
+    """Failed heartbeats and failure writes are logged, not fatal; process workers share the wake event"""
+    import sqlite3
+    import threading
+    from utils.db import get_db
+    from utils import jobs
+    conn = get_db()
+    doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                          ('admin', 'flaky.txt', 'flaky scan text')).lastrowid
+    conn.commit()
+
+    class FlakyConnection:
+        """Connection whose writes matching `fail` raise, as under a held write lock"""
+        def __init__(self, fail):
+            self.fail, self.failures = fail, 0
+
+        def __getattr__(self, name):
+            return getattr(conn, name)
+
+        def execute(self, sql, *args):
+            if self.fail in sql:
+                self.failures += 1
+                raise sqlite3.OperationalError('database is locked')
+            return conn.execute(sql, *args)
+
+        def executemany(self, sql, *args):
+            return self.execute(sql, *args)
+
+    # The job stays running, without heartbeats, until reclaim_orphaned_jobs requeues it.
+    job_id = jobs.submit_scan('admin', doc_id)
+    mocker.patch('utils.scanner.get_matches', side_effect=RuntimeError('boom'))
+    jobs.run_job(FlakyConnection("status = 'failed'"), jobs.claim_job(conn, 'test'))
+    assert conn.execute('SELECT status FROM scan_jobs WHERE id = ?', (job_id,)).fetchone()[0] == 'running'
+
+    # The heartbeat keeps beating through failed writes; this one stops after the third.
+    flaky = FlakyConnection('heartbeat_at')
+    stop = threading.Event()
+    mocker.patch.object(stop, 'wait', side_effect=lambda timeout: flaky.failures >= 3)
+    mocker.patch.object(jobs, 'get_db', return_value=flaky)
+    mocker.patch.object(jobs, 'close_thread_db')
+    mocker.patch.object(jobs, '_active', {job_id})
+    jobs._heartbeat_loop(stop)
+    assert flaky.failures == 3
+
+    process = mocker.patch('utils.jobs.multiprocessing.Process')
+    mocker.patch.object(jobs, '_workers', [])
+    mocker.patch.object(jobs, '_stop', None)
+    mocker.patch.object(jobs, '_wake', jobs._wake)
+    jobs.start_workers(2, 'process')
+    wake = process.call_args.kwargs['args'][2]
+    assert wake is jobs._wake and not wake.is_set()
+    jobs.stop_workers()
+    assert wake.is_set()
+
+def test_document_bodies_move_to_blob_store(client):
+    """Inline bodies are migrated to compressed blobs and read back unchanged"""
+    import os
+    from utils.db import get_db
+    from utils import blob_store
+    conn = get_db()
+    body = "café blob body " * 100
+    doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                          ('admin', 'inline.txt', body)).lastrowid
+    conn.commit()
+    while blob_store.migrate_documents(conn, batch_size=50):
+        pass
+
+    row = conn.execute('SELECT content, blob_key FROM documents WHERE id = ?', (doc_id,)).fetchone()
+    assert row['content'] == ''
+    path = blob_store.blob_path(row['blob_key'], blob_store.WRITE_SUFFIX)
+    assert os.path.getsize(path) < len(body)
+    assert blob_store.document_body(conn, doc_id) == body
+    assert blob_store.put_text(body) == row['blob_key']
+
+    # Text artifacts stored inline by older releases move the same way.
+    from utils.text_pipeline import PIPELINE_VERSION, load_document_texts, migrate_document_texts
+    conn.execute('''
+        INSERT OR REPLACE INTO document_text (doc_id, pipeline_version, normalized, stemmed, term_counts)
+        VALUES (?, ?, 'blob body', 'blob bodi', '{"blob": 1, "body": 1}')
+    ''', (doc_id, PIPELINE_VERSION))
+    conn.commit()
+    while migrate_document_texts(conn, batch_size=50):
+        pass
+    row = conn.execute('SELECT normalized, stemmed, blob_key FROM document_text WHERE doc_id = ?', (doc_id,)).fetchone()
+    assert (row['normalized'], row['stemmed']) == ('', '') and row['blob_key']
+    text = load_document_texts(conn, [doc_id])[doc_id]
+    assert (text['normalized'], text['stemmed'], text['term_counts']) == ('blob body', 'blob bodi', {'blob': 1, 'body': 1})
+
+def test_connections_are_shared_and_analytics_read_only(client):
+    """One connection per app context, WAL journaling, read-only analytics pool"""
+    import sqlite3
+    from utils.db import get_db, read_db
+    with app.app_context():
+        conn = get_db()
+        assert get_db() is conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    with read_db() as reader:
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute("UPDATE users SET credits = credits WHERE username = 'admin'")
+
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+        sess['role'] = 'admin'
+    response = client.get('/admin/analytics')
+    assert response.status_code == 200
+    assert 'recent_matches' in response.json
+
+def test_migrations_upgrade_legacy_schema(tmp_path):
+    """A pre-versioning database is migrated in order, once"""
+    import sqlite3
+    from utils.migrations import migrate, schema_version, SCHEMA_VERSION
+    conn = sqlite3.connect(tmp_path / 'legacy.db')
+    conn.execute('CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT NOT NULL, role TEXT, '
+                 'created_at TIMESTAMP)')
+    conn.execute('CREATE TABLE documents (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, '
+                 'filename TEXT NOT NULL, content TEXT NOT NULL, scanned_at TIMESTAMP)')
+    conn.execute("INSERT INTO users VALUES ('old', 'hash', 'user', NULL)")
+    conn.commit()
+
+    migrate(conn)
+    migrate(conn)
+    assert schema_version(conn) == SCHEMA_VERSION
+    assert conn.execute("SELECT password_hash FROM users WHERE username = 'old'").fetchone()[0] == 'hash'
+    assert 'blob_key' in [row[1] for row in conn.execute('PRAGMA table_info(documents)')]
+    plan = ' '.join(str(row) for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM documents WHERE username = 'old'"))
+    assert 'idx_documents_user' in plan
+
+def test_admin_listings_paginate_by_keyset(client, mocker):
+    """Paging through a listing visits every row once, in order; NDJSON streams the same rows"""
+    import json
+    from utils.db import get_db
+    conn = get_db()
+    for i in range(5):
+        conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                     ('admin', f'page{i}.txt', f'page {i}'))
+    conn.commit()
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+        sess['role'] = 'admin'
+
+    everything = client.get('/admin/documents?limit=1000').json['documents']
+    seen, after = [], None
+    while True:
+        page = client.get('/admin/documents', query_string={'limit': 2, **({'after': after} if after else {})}).json
+        seen.extend(doc['id'] for doc in page['documents'])
+        after = page['next']
+        if not after:
+            break
+    assert seen == [doc['id'] for doc in everything] and len(seen) == 5
+
+    lines = client.get('/admin/documents?format=ndjson&limit=2').data.decode().splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert [row['id'] for row in rows[:2]] == seen[:2]
+    assert client.get('/admin/documents?after=bogus').status_code == 400
+
+    # With every pooled reader held, reads give up after the busy timeout with a 503.
+    import queue
+    from utils import db
+    mocker.patch.object(db, '_read_pool', queue.LifoQueue())
+    mocker.patch.object(db, '_read_pool_created', db.READ_POOL_SIZE)
+    mocker.patch.object(db, 'BUSY_TIMEOUT_MS', 10)
+    assert client.get('/admin/documents?format=ndjson').status_code == 503
+    response = client.get('/health/ready')
+    assert response.status_code == 503 and response.json['database'] == 'busy'
+
+def test_analytics_rollups_track_writes(client):
+    """Trigger-maintained rollups agree with a rebuild from the raw tables"""
+    from utils.db import get_db
+    from utils.analytics import rebuild_rollups
+    conn = get_db()
+    conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                 ('admin', 'rollup.txt', 'rollup'))
+    request_id = conn.execute("INSERT INTO credit_requests (username) VALUES ('admin')").lastrowid
+    conn.execute("UPDATE credit_requests SET status = 'approved' WHERE id = ?", (request_id,))
+    conn.commit()
+
+    snapshot = lambda: (conn.execute('SELECT * FROM analytics_totals ORDER BY name').fetchall(),
+                        conn.execute('SELECT * FROM daily_user_scans ORDER BY day, username').fetchall(),
+                        conn.execute('SELECT * FROM user_scan_totals ORDER BY username').fetchall())
+    maintained = [[tuple(row) for row in rows] for rows in snapshot()]
+    rebuild_rollups(conn)
+    conn.commit()
+    assert maintained == [[tuple(row) for row in rows] for rows in snapshot()]
+
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+        sess['role'] = 'admin'
+    data = client.get('/admin/analytics').json
+    assert data['total_scans'] == conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+    assert data['active_users'] == 1
+
+    # Active users count today only; the timeline covers seven days, today included.
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('yesterday', 'x')")
+    for days in (1, 6, 7):
+        conn.execute("INSERT INTO daily_user_scans (day, username, scans) VALUES (date('now', ?), 'yesterday', 1)",
+                     (f'-{days} days',))
+    conn.commit()
+    data = client.get('/admin/analytics').json
+    assert data['active_users'] == 1 and len(data['scan_timeline']) == 3
+
+    # Match details come a page at a time, newest first.
+    from utils.analytics import get_admin_analytics
+    other_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                            ('admin', 'other.txt', 'other')).lastrowid
+    for score in (0.1, 0.2, 0.3):
+        conn.execute('INSERT INTO scan_results (username, doc_id, matched_doc_id, final_score) VALUES (?, ?, ?, ?)',
+                     ('admin', other_id, other_id, score))
+    conn.commit()
+    first = get_admin_analytics(limit=2)
+    second = get_admin_analytics(limit=2, after=first['next'])
+    assert [m['final_score'] for m in first['match_details'] + second['match_details']] == [0.3, 0.2, 0.1]
+    assert second['next'] is None
+
+def test_admin_export_streams_formats(client):
+    """Exports stream every document in each format, gzip round-trips and bad input is rejected"""
+    import csv
+    import gzip
+    import json
+    from utils.db import get_db
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+        sess['role'] = 'admin'
+    expected = [row[0] for row in get_db().execute('SELECT id FROM documents ORDER BY id')]
+
+    response = client.get('/admin/export/documents?format=csv')
+    assert response.mimetype == 'text/csv'
+    assert 'documents.csv' in response.headers['Content-Disposition']
+    rows = list(csv.reader(response.data.decode().splitlines()))
+    assert rows[0][0] == 'id' and [int(row[0]) for row in rows[1:]] == expected
+
+    lines = client.get('/admin/export/documents?format=ndjson').data.decode().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == expected
+
+    response = client.get('/admin/export/documents?format=columnar&gzip=true')
+    assert response.mimetype == 'application/gzip'
+    batches = [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()]
+    assert [doc_id for batch in batches for doc_id in batch['id']] == expected
+
+    assert client.get('/admin/export/users').status_code == 400
+    assert client.get('/admin/export/documents?start=yesterday').status_code == 400
+
+def test_parquet_export_schema_from_declared_types(client):
+    """Parquet columns take their declared SQLite types, even when the first row group is all NULL"""
+    from utils.db import get_db
+    from utils.export import declared_types, export_stream
+    conn = get_db()
+    assert declared_types(conn, 'scan_results', with_filenames=True) == \
+        ['INTEGER', 'TEXT', 'INTEGER', 'INTEGER', 'REAL', 'INTEGER', 'TIMESTAMP', 'TEXT', 'TEXT']
+
+    pyarrow = pytest.importorskip('pyarrow')
+    import io
+    import pyarrow.parquet
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('parquet', 'x')")
+    for key in (None, 'abc'):
+        conn.execute('INSERT INTO documents (username, filename, content, blob_key) VALUES (?, ?, ?, ?)',
+                     ('parquet', 'parquet.txt', 'x', key))
+    conn.commit()
+    data = b''.join(export_stream(conn, 'documents', 'parquet', username='parquet', batch_size=1))
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    assert table.schema.field('blob_key').type == pyarrow.string()
+    assert table.column('blob_key').to_pylist() == [None, 'abc']
+
+def test_cold_start_defers_heavy_imports(client, mocker):
+    """Importing the app leaves NLTK and the model alone; readiness waits for warmup"""
+    import sys
+    import threading
+    import subprocess
+    from utils import ai_matcher
+    loaded = subprocess.run(
+        [sys.executable, '-c', "import sys, app; print(sorted({'nltk', 'sentence_transformers', 'sklearn'} & set(sys.modules)))"],
+        capture_output=True, text=True, check=True
+    ).stdout.strip().splitlines()[-1]
+    assert loaded == '[]'
+
+    assert client.get('/health/live').status_code == 200
+    mocker.patch('app.start_warmup')
+    mocker.patch.object(ai_matcher, '_warmed_up', threading.Event())
+    response = client.get('/health/ready')
+    assert response.status_code == 503 and response.json['database'] == 'ok'
+    ai_matcher._warmed_up.set()
+    assert client.get('/health/ready').status_code == 200
+
+# Largest allowed change in any pairwise chunk score relative to the torch backend.
+BACKEND_DRIFT = {"torch-int8": 0.05, "onnx": 1e-3, "onnx-int8": 0.05}
+
+@pytest.mark.parametrize('backend', sorted(BACKEND_DRIFT))
+def test_embedding_backend_parity(backend):
+    """Every embedding backend scores document pairs within a bounded drift of torch"""
+    import numpy as np
+    from utils.ai_matcher import MODEL_NAME, max_chunk_similarity_many
+    from utils.embedding_backends import backend_available, load_backend
+    if not (backend_available('torch') and backend_available(backend)):
+        pytest.skip(f"{backend} backend is not installed")
+    try:
+        reference, candidate = load_backend('torch', MODEL_NAME), load_backend(backend, MODEL_NAME)
+    except Exception as e:
+        pytest.skip(f"Could not load the model: {e}")
+
+    docs = [
+        ["the cat sat on the mat", "dogs bark at night"],
+        ["a cat was sitting on a mat"],
+        ["quarterly revenue grew by ten percent", "profits were flat"],
+        ["stock markets fell sharply today", "the dog barked all night long"]
+    ]
+    scores = {}
+    for name, model in (('torch', reference), (backend, candidate)):
+        embeddings = [model.encode(chunks) for chunks in docs]
+        scores[name] = np.array([max_chunk_similarity_many(emb, embeddings) for emb in embeddings])
+    assert np.abs(scores[backend] - scores['torch']).max() <= BACKEND_DRIFT[backend]
+
+def test_embedding_service_merges_concurrent_encodes():
+    """Concurrent encodes share model calls, each caller gets its own rows back, errors reach every caller"""
+    import threading
+    import numpy as np
+    from utils.embedding_service import EmbeddingService
+    calls = []
+    def encode(texts):
+        calls.append(len(texts))
+        if 'boom' in texts:
+            raise RuntimeError('boom')
+        return np.array([[float(text.split('-')[0]), float(text.split('-')[1])] for text in texts])
+
+    service = EmbeddingService(encode, batch_size=8, max_wait_ms=200)
+    results = {}
+    def caller(i):
+        results[i] = service.encode([f"{i}-0", f"{i}-1"])
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i in range(8):
+        assert results[i].tolist() == [[i, 0], [i, 1]]
+    assert len(calls) < 8 and max(calls) <= 8
+    stats = service.stats()
+    assert stats["requests"] == 8 and stats["texts"] == 16 and stats["queue_depth"] == 0
+    assert stats["avg_batch_size"] > 2
+
+    with pytest.raises(RuntimeError):
+        service.encode(['boom'])
+
+def test_match_cascade_prunes_and_selects(client, mocker):
+    """Cheap modes AI-score fewer candidates; top_k and min_score trim the response"""
+    from utils.db import get_db
+    from utils import scanner
+    mocker.patch('utils.ai_matcher.get_model', return_value=StubModel())
+    mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    mocker.patch.dict(scanner.MATCH_MODES, {"fast": {"prefilter": 1.1, "top_m": 1, "ann_top_m": 1}})
+    conn = get_db()
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('cascade', 'x')")
+    texts = ["red green blue yellow", "red green blue", "red green", "red", "red purple orange", "red pink"]
+    doc_ids = [conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                            ('cascade', f'c{i}.txt', text)).lastrowid for i, text in enumerate(texts)]
+    conn.commit()
+    with client.session_transaction() as sess:
+        sess['username'] = 'cascade'
+
+    fast = client.get(f'/api/matches/{doc_ids[0]}?mode=fast').json["cascade"]
+    assert fast["pruned_before_ai"] >= 1
+    assert fast["ai_scored"] + fast["ai_cached"] + fast["pruned_before_ai"] == fast["ai_candidates"]
+
+    full = client.get(f'/api/matches/{doc_ids[0]}?mode=exhaustive').json
+    assert full["cascade"]["pruned_before_ai"] == 0
+    scores = [match["similarity"] for match in full["matches"]]
+    assert scores == sorted(scores, reverse=True)
+
+    top = client.get(f'/api/matches/{doc_ids[0]}?mode=exhaustive&top_k=2&min_score=0.1').json
+    assert [m["id"] for m in top["matches"]] == [m["id"] for m in full["matches"] if m["similarity"] >= 0.1][:2]
+    assert top["cascade"]["returned"] == 2
+    assert client.get(f'/api/matches/{doc_ids[0]}?mode=slow').status_code == 400
+
+def test_benchmark_corpus_is_deterministic():
+    """The synthetic benchmark corpus depends only on its seed"""
+    from benchmarks.corpus import SyntheticCorpus
+    docs = SyntheticCorpus(seed=3).generate(60, duplicate_share=0.2, paraphrase_share=0.2, long_share=0.1,
+                                            long_words=(500, 600))
+    assert docs == SyntheticCorpus(seed=3).generate(60, duplicate_share=0.2, paraphrase_share=0.2,
+                                                    long_share=0.1, long_words=(500, 600))
+    assert {kind for kind, _ in docs} == {"original", "duplicate", "paraphrase", "long"}
+    texts = [text for kind, text in docs if kind == "original"]
+    assert any(text in texts for kind, text in docs if kind == "duplicate")
+
+def test_metrics_endpoint_reports_stages(client, mocker):
+    """Matching records per-stage latency, counters and gauges exposed in Prometheus format"""
+    from utils.db import get_db
+    mocker.patch('utils.ai_matcher.get_model', return_value=StubModel())
+    mocker.patch('utils.text_pipeline.stem_text', side_effect=str.lower)
+    conn = get_db()
+    doc_id = conn.execute('INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
+                          ('admin', 'metrics.txt', 'metrics stage timing text')).lastrowid
+    conn.commit()
+    with client.session_transaction() as sess:
+        sess['username'] = 'admin'
+    assert client.get(f'/api/matches/{doc_id}').status_code == 200
+
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.data.decode()
+    for line in ('# TYPE docscan_stage_seconds histogram',
+                 'docscan_stage_seconds_count{stage="lexical"}',
+                 'docscan_stage_seconds_bucket{stage="get_matches",le="+Inf"}',
+                 'docscan_sqlite_seconds_count{op="read"}',
+                 'docscan_match_requests_total{mode="balanced"}',
+                 'docscan_pair_cache_total{result="miss"}',
+                 'docscan_scan_jobs{status="queued"}',
+                 'docscan_model_loaded '):
+        assert line in text
+
+def test_sparse_tfidf_fallback_matches_sklearn():
+    """The dependency-free TF-IDF scorer agrees with sklearn, pairwise and one-vs-many"""
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    from utils.ai_matcher import custom_tfidf_similarity
+    from utils.tfidf import tfidf_similarity_many
+    docs = ["quick brown fox jumps over lazy dog", "lazy dog sleeps all day long",
+            "quick quick fox runs", "completely unrelated words here", ""]
+
+    matrix = TfidfVectorizer().fit_transform(docs[:2])
+    assert custom_tfidf_similarity(docs[0], docs[1]) == pytest.approx(cosine_similarity(matrix[0], matrix[1])[0][0], abs=1e-6)
+
+    matrix = TfidfVectorizer().fit_transform(docs)
+    expected = cosine_similarity(matrix[0], matrix[1:])[0]
+    scores = tfidf_similarity_many(docs[0].split(), [doc.split() for doc in docs[1:]])
+    assert np.allclose(scores, expected, atol=1e-6)
+
+def test_chunk_spans_window_and_pack_sentences(mocker):
+    """Chunks are offsets into the text: word windows, or whole sentences with overlap"""
+    from benchmarks.corpus import stub_nltk_tools
+    from utils.ai_matcher import chunk_spans, chunk_text
+    mocker.patch('utils.ai_matcher._nltk_tools', return_value=stub_nltk_tools())
+
+    text = ' '.join(f"w{i}" for i in range(250))
+    spans = list(chunk_spans(text, chunk_size=100, overlap=20))
+    words = [text[start:end].split() for start, end in spans]
+    assert [(w[0], w[-1]) for w in words] == [("w0", "w99"), ("w80", "w179"), ("w160", "w249")]
+    assert chunk_text(text, 100, 20) == [text[start:end] for start, end in spans]
+    assert list(chunk_spans("short text", 100, 20)) == [(0, 10)]
+
+    sentences = [' '.join(f"s{n}w{i}" for i in range(10)) + '.' for n in range(12)]
+    text = '  '.join(sentences)
+    chunks = chunk_text(text, chunk_size=45, overlap=15)
+    # Four sentences fit; each chunk repeats the last sentence of the one before.
+    assert chunks[0] == '  '.join(sentences[0:4])
+    assert chunks[1] == '  '.join(sentences[3:7])
+    assert chunks[-1].endswith(sentences[-1])
+    assert all(len(chunk.split()) <= 45 for chunk in chunks)
+
+    # Carried overlap shrinks rather than push a chunk past chunk_size; only a
+    # sentence that is longer on its own makes a longer chunk.
+    import random
+    rng = random.Random(4)
+    lengths = [rng.randint(3, 40) for _ in range(200)] + [60, 5, 5]
+    sentences = [' '.join(f"s{n}w{i}" for i in range(length)) + '.' for n, length in enumerate(lengths)]
+    text = ' '.join(sentences)
+    chunks = chunk_text(text, chunk_size=45, overlap=15)
+    assert all(len(chunk.split()) <= 45 or chunk == sentences[200] for chunk in chunks)
+    assert chunks[0].startswith(sentences[0]) and chunks[-1].endswith(sentences[-1])
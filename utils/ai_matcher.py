@@ -1,51 +1,165 @@
-import numpy as np
+import os
 import re
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import sent_tokenize, word_tokenize
-from nltk.stem import PorterStemmer
-
-def initialize_nltk():
-    """Ensure all required NLTK data is downloaded"""
-    required_resources = ['punkt', 'stopwords', 'punkt_tab']
-    for resource in required_resources:
-        try:
-            nltk.data.find(f'tokenizers/{resource}')
-        except LookupError:
-            nltk.download(resource)
+import bisect
+import threading
+import importlib.util
+import numpy as np
+from functools import partial
+from utils.parallel import score_segments, PARALLEL_MIN_CHUNKS
+from utils.tfidf import tfidf_similarity_many
+from utils.embedding_backends import BACKEND_REQUIREMENTS, backend_available, load_backend
+from utils.embedding_service import EmbeddingService, EMBED_BATCH_SIZE
+from utils.metrics import Gauge, stage, TEXTS_ENCODED
 
-initialize_nltk()
+MODEL_NAME = 'paraphrase-MiniLM-L6-v2'
+# torch, torch-int8, onnx or onnx-int8; see utils.embedding_backends.
+EMBEDDING_BACKEND = os.environ.get('DOCSCAN_EMBEDDING_BACKEND', 'torch')
+if EMBEDDING_BACKEND not in BACKEND_REQUIREMENTS:
+    raise ValueError(f"Unknown DOCSCAN_EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+# Stored embeddings, ANN indexes and cached scores are keyed by this, since
+# backends produce slightly different vectors.
+MODEL_KEY = MODEL_NAME if EMBEDDING_BACKEND == 'torch' else f"{MODEL_NAME}@{EMBEDDING_BACKEND}"
 
-try:
-    from sentence_transformers import SentenceTransformer
-    HAVE_TRANSFORMERS = True
-except ImportError:
-    HAVE_TRANSFORMERS = False
-    try:
-        from sklearn.feature_extraction.text import TfidfVectorizer
-        from sklearn.metrics.pairwise import cosine_similarity as sklearn_cosine_similarity
-        HAVE_SKLEARN = True
-    except ImportError:
-        HAVE_SKLEARN = False
+# NLTK, the embedding backend and scikit-learn are slow to import, so they
+# are only checked for here and imported on first use (or by warmup()).
+HAVE_TRANSFORMERS = backend_available(EMBEDDING_BACKEND)
+HAVE_SKLEARN = importlib.util.find_spec('sklearn') is not None
+
+# Merge concurrent encodes across requests into shared model calls.
+EMBED_BATCHING = os.environ.get('DOCSCAN_EMBED_BATCHING', '1') == '1'
+
+# NLTK data used by preprocessing and chunking, by resource path.
+NLTK_RESOURCES = {
+    'punkt': 'tokenizers/punkt',
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'stopwords': 'corpora/stopwords'
+}
+# Set to 0 where the data is baked into the image, so runtime never downloads.
+NLTK_DOWNLOAD = os.environ.get('DOCSCAN_NLTK_DOWNLOAD', '1') == '1'
 
 _model = None
+_model_error = None
+_model_lock = threading.Lock()
+_nltk = None
+_nltk_error = None
+_nltk_lock = threading.Lock()
+_warmed_up = threading.Event()
+_warmup_thread = None
+_service = None
+_service_pid = None
+
+def initialize_nltk(download=None):
+    """
+    Ensure the required NLTK data is present, downloading what is missing
+    unless downloads are disabled. Returns the names still missing.
+    """
+    import nltk
+    download = NLTK_DOWNLOAD if download is None else download
+    missing = []
+    for resource, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            if not (download and nltk.download(resource, quiet=True)):
+                missing.append(resource)
+    return missing
+
+def _nltk_tools():
+    """NLTK tokenizers, stopword set and stemmer, loaded on first use."""
+    global _nltk, _nltk_error
+    if _nltk is None:
+        with _nltk_lock:
+            if _nltk is None and _nltk_error is None:
+                try:
+                    initialize_nltk()
+                    from nltk.corpus import stopwords
+                    from nltk.tokenize import sent_tokenize, word_tokenize
+                    from nltk.stem import PorterStemmer
+                    _nltk = {
+                        "sent_tokenize": sent_tokenize,
+                        "word_tokenize": word_tokenize,
+                        "stop_words": set(stopwords.words('english')),
+                        "stemmer": PorterStemmer()
+                    }
+                except Exception as e:
+                    # Remember the failure rather than retrying downloads on every call.
+                    _nltk_error = e
+            if _nltk is None:
+                raise LookupError(f"NLTK resources unavailable: {_nltk_error}")
+    return _nltk
+
+def nltk_loaded():
+    """Whether the NLTK tools have loaded in this process."""
+    return _nltk is not None
 
 def get_model():
     """
     Initialize and return the model, loading it only once
     """
-    global _model
-    if HAVE_TRANSFORMERS and _model is None:
-        try:
-            _model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-        except Exception as e:
-            print(f"Error loading transformer model: {e}")
+    global _model, _model_error
+    if HAVE_TRANSFORMERS and _model is None and _model_error is None:
+        with _model_lock:
+            if _model is None and _model_error is None:
+                try:
+                    _model = load_backend(EMBEDDING_BACKEND, MODEL_NAME)
+                except Exception as e:
+                    _model_error = str(e)
+                    print(f"Error loading transformer model: {e}")
     
     return _model
 
-def ai_match(doc1, doc2):
+def warmup():
+    """
+    Load everything matching needs up front - NLTK data, the transformer
+    model and one encode - so the first request does not pay for it.
+    Safe to call from several threads; returns model_status().
+    """
+    try:
+        _nltk_tools()
+    except Exception as e:
+        print(f"NLTK warmup error: {e}")
+    model = get_model()
+    if model is not None:
+        try:
+            model.encode(["warmup"])
+        except Exception as e:
+            print(f"Model warmup error: {e}")
+    elif HAVE_SKLEARN:
+        # Pay for the fallback scorer's import now rather than on first match.
+        import sklearn.feature_extraction.text
+    _warmed_up.set()
+    return model_status()
+
+def start_warmup():
+    """Run warmup() in a background thread (once per process)."""
+    global _warmup_thread
+    with _nltk_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+            _warmup_thread.start()
+
+def model_status():
+    """Whether warmup has finished and which scorer backend is loaded."""
+    if _model is not None:
+        model = "loaded"
+    elif _model_error is not None:
+        model = "failed"
+    elif HAVE_TRANSFORMERS:
+        model = "not_loaded"
+    else:
+        model = "unavailable"
+    return {
+        "warmed_up": _warmed_up.is_set(),
+        "model": model,
+        "model_name": MODEL_KEY if HAVE_TRANSFORMERS else None,
+        "backend": MODEL_KEY if _model is not None else ('sklearn' if HAVE_SKLEARN else 'tfidf'),
+        "nltk": "loaded" if _nltk is not None else ("failed" if _nltk_error is not None else "not_loaded")
+    }
+
+def ai_match(doc1, doc2, embeddings1=None, embeddings2=None):
     """
     Perform AI-based similarity matching between two documents.
+    Precomputed chunk embeddings (see encode_document) skip re-encoding.
     Returns a similarity score between 0 and 1.
     """
     if not isinstance(doc1, str) or not isinstance(doc2, str):
@@ -54,6 +168,9 @@ def ai_match(doc1, doc2):
     if not doc1.strip() or not doc2.strip():
         return 0.0
     
+    if embeddings1 is not None and embeddings2 is not None:
+        return embedding_similarity(embeddings1, embeddings2)
+    
     doc1_clean = preprocess_text(doc1)
     doc2_clean = preprocess_text(doc2)
     
@@ -66,6 +183,45 @@ def ai_match(doc1, doc2):
     
     return custom_tfidf_similarity(doc1_clean, doc2_clean)
 
+def _encode_direct(texts):
+    TEXTS_ENCODED.inc(len(texts))
+    with stage("encode"):
+        return np.asarray(get_model().encode(texts), dtype=np.float32)
+
+def embedding_service():
+    """The process's shared EmbeddingService (recreated after a fork)."""
+    global _service, _service_pid
+    if _service is None or _service_pid != os.getpid():
+        with _model_lock:
+            if _service is None or _service_pid != os.getpid():
+                _service = EmbeddingService(_encode_direct)
+                _service_pid = os.getpid()
+    return _service
+
+def encode_chunks(chunks):
+    """
+    Embed a list of chunks as a float32 matrix, through the shared
+    micro-batching service unless DOCSCAN_EMBED_BATCHING=0.
+    """
+    if not EMBED_BATCHING:
+        return _encode_direct(chunks)
+    return embedding_service().encode(chunks)
+
+def encode_spans(text, spans):
+    """
+    Embed text[start:end] for each (start, end) span as a float32 matrix,
+    slicing out one encoder batch of chunks at a time.
+    """
+    parts, batch = [], []
+    for start, end in spans:
+        batch.append(text[start:end])
+        if len(batch) == EMBED_BATCH_SIZE:
+            parts.append(encode_chunks(batch))
+            batch = []
+    if batch:
+        parts.append(encode_chunks(batch))
+    return parts[0] if len(parts) == 1 else np.vstack(parts)
+
 def transformer_similarity(doc1, doc2, chunk_size=1000, overlap=200):
     """
     Calculate semantic similarity using transformer model.
@@ -79,25 +235,161 @@ def transformer_similarity(doc1, doc2, chunk_size=1000, overlap=200):
         doc1_chunks = chunk_text(doc1, chunk_size, overlap)
         doc2_chunks = chunk_text(doc2, chunk_size, overlap)
         
-        embeddings1 = model.encode(doc1_chunks)
-        embeddings2 = model.encode(doc2_chunks)
-        
-        best_similarity = 0
-        for emb1 in embeddings1:
-            for emb2 in embeddings2:
-                similarity = np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2))
-                best_similarity = max(best_similarity, similarity)
+        embeddings = encode_chunks(doc1_chunks + doc2_chunks)
+        embeddings1, embeddings2 = embeddings[:len(doc1_chunks)], embeddings[len(doc1_chunks):]
         
-        return float(best_similarity)
+        return embedding_similarity(embeddings1, embeddings2)
     except Exception as e:
         print(f"Transformer similarity error: {e}")
         return None
 
+def embedding_similarity(embeddings1, embeddings2):
+    """
+    Best chunk-to-chunk cosine similarity between two embedding matrices
+    """
+    return float(max_chunk_similarity_many(embeddings1, [embeddings2])[0])
+
+def best_chunk_pair(embeddings1, embeddings2):
+    """
+    (i, j, score) for the most similar pair of chunks, row i of embeddings1
+    and row j of embeddings2; pair with stored chunk offsets to locate them.
+    """
+    sims = normalize_rows(embeddings1) @ normalize_rows(embeddings2).T
+    i, j = np.unravel_index(int(np.argmax(sims)), sims.shape)
+    return int(i), int(j), float(sims[i, j])
+
+def normalize_rows(matrix):
+    """
+    L2-normalize the rows of a matrix, leaving all-zero rows at zero
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def chunk_max_kernel(segmented, offsets, target, block_size=8192):
+    """
+    Segmented max of target-chunk x candidate-chunk cosines over stacked,
+    normalized candidate rows; one score per candidate, clipped at zero.
+    """
+    stacked, = segmented
+    chunk_best = np.concatenate([
+        (target @ stacked[start:start + block_size].T).max(axis=0)
+        for start in range(0, len(stacked), block_size)
+    ])
+    return np.maximum(np.maximum.reduceat(chunk_best, offsets), 0)
+
+def max_chunk_similarity_many(target_embeddings, candidate_embeddings, block_size=8192, workers=None):
+    """
+    Best chunk-to-chunk cosine similarity of one embedding matrix against
+    many. Candidate chunks are stacked into one matrix, scored with a single
+    matrix multiply per block, and reduced per candidate with a segmented max.
+    Large candidate sets are sharded across the scoring process pool.
+    """
+    scores = np.zeros(len(candidate_embeddings), dtype=np.float32)
+    present = [i for i, emb in enumerate(candidate_embeddings) if emb is not None and len(emb)]
+    if target_embeddings is None or not len(target_embeddings) or not present:
+        return scores
+    
+    target = normalize_rows(target_embeddings)
+    stacked = normalize_rows(np.vstack([candidate_embeddings[i] for i in present]))
+    lengths = [len(candidate_embeddings[i]) for i in present]
+
+    with stage("pairwise"):
+        scores[present] = score_segments(
+            partial(chunk_max_kernel, block_size=block_size), [stacked], lengths,
+            broadcast=[target], min_rows=PARALLEL_MIN_CHUNKS, workers=workers
+        )
+    return scores
+
+def ai_match_many(target, candidates, target_embeddings=None, candidate_embeddings=None):
+    """
+    Score one document against many in a single pass.
+    Returns a list of similarity scores aligned with candidates.
+    """
+    scores = [0.0] * len(candidates)
+    if not isinstance(target, str) or not target.strip():
+        return scores
+    
+    valid = [i for i, doc in enumerate(candidates) if isinstance(doc, str) and doc.strip()]
+    if not valid:
+        return scores
+    
+    if candidate_embeddings is None:
+        candidate_embeddings = [None] * len(candidates)
+    
+    if target_embeddings is None:
+        target_embeddings = encode_document(target)
+    
+    if target_embeddings is not None:
+        embeddings = []
+        for i in valid:
+            emb = candidate_embeddings[i]
+            if emb is None:
+                emb = encode_document(candidates[i])
+            embeddings.append(emb)
+        
+        if all(emb is not None for emb in embeddings):
+            best = max_chunk_similarity_many(target_embeddings, embeddings)
+            for i, score in zip(valid, best):
+                scores[i] = float(score)
+            return scores
+    
+    # No transformer: one TF-IDF pass over the target and every candidate,
+    # with the batch as the IDF corpus.
+    target_tokens = preprocess_text(target).split()
+    best = tfidf_similarity_many(target_tokens, [preprocess_text(candidates[i]).split() for i in valid])
+    for i, score in zip(valid, best):
+        scores[i] = float(score)
+    return scores
+
+def encode_document(doc, chunk_size=1000, overlap=200):
+    """
+    Encode a raw document into a float32 matrix of chunk embeddings,
+    using the same preprocessing and chunking as ai_match.
+    Returns None when the transformer model is unavailable.
+    """
+    if get_model() is None or not isinstance(doc, str):
+        return None
+    
+    try:
+        return encode_preprocessed(preprocess_text(doc), chunk_size, overlap)
+    except Exception as e:
+        print(f"Document encoding error: {e}")
+        return None
+
+def encode_with_offsets(doc_clean, chunk_size=1000, overlap=200):
+    """
+    Encode already-preprocessed text (see preprocess_text) into a float32
+    matrix of chunk embeddings, returned with an int32 (n_chunks, 2) array
+    of each chunk's character offsets in doc_clean; None when the model is
+    unavailable.
+    """
+    if get_model() is None or not isinstance(doc_clean, str):
+        return None
+    
+    try:
+        offsets = np.array(list(chunk_spans(doc_clean, chunk_size, overlap)), dtype=np.int32)
+        return encode_spans(doc_clean, offsets.tolist()), offsets
+    except Exception as e:
+        print(f"Document encoding error: {e}")
+        return None
+
+def encode_preprocessed(doc_clean, chunk_size=1000, overlap=200):
+    """
+    Encode already-preprocessed text (see preprocess_text) into a float32
+    matrix of chunk embeddings, or None when the model is unavailable.
+    """
+    encoded = encode_with_offsets(doc_clean, chunk_size, overlap)
+    return None if encoded is None else encoded[0]
+
 def tfidf_similarity(doc1, doc2):
     """
     Calculate TF-IDF cosine similarity using sklearn
     """
     try:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.metrics.pairwise import cosine_similarity as sklearn_cosine_similarity
         vectorizer = TfidfVectorizer()
         
         tfidf_matrix = vectorizer.fit_transform([doc1, doc2])
@@ -111,39 +403,11 @@ def tfidf_similarity(doc1, doc2):
 
 def custom_tfidf_similarity(doc1, doc2):
     """
-    Custom implementation of TF-IDF similarity without external libraries
+    TF-IDF cosine similarity without external libraries, from hashed sparse
+    vectors; linear in document length. With the two documents as the
+    corpus it weighs terms the way sklearn's TfidfVectorizer does.
     """
-    words1 = doc1.split()
-    words2 = doc2.split()
-    
-    all_words = set(words1 + words2)
-    doc_freq = {}
-    for word in all_words:
-        doc_freq[word] = (1 if word in words1 else 0) + (1 if word in words2 else 0)
-    
-    vector1 = {}
-    vector2 = {}
-    
-    word_count1 = len(words1) or 1  
-    word_count2 = len(words2) or 1
-    
-    for word in all_words:
-        tf1 = words1.count(word) / word_count1
-        tf2 = words2.count(word) / word_count2
-        
-        idf = 1.0 / doc_freq[word] if doc_freq[word] > 0 else 0
-        
-        vector1[word] = tf1 * idf
-        vector2[word] = tf2 * idf
-    
-    dot_product = sum(vector1.get(word, 0) * vector2.get(word, 0) for word in all_words)
-    magnitude1 = np.sqrt(sum(value ** 2 for value in vector1.values()))
-    magnitude2 = np.sqrt(sum(value ** 2 for value in vector2.values()))
-    
-    if magnitude1 == 0 or magnitude2 == 0:
-        return 0.0
-    
-    return dot_product / (magnitude1 * magnitude2)
+    return float(tfidf_similarity_many(doc1.split(), [doc2.split()])[0])
 
 def preprocess_text(text):
     """
@@ -153,75 +417,91 @@ def preprocess_text(text):
     - Remove stopwords
     - Apply stemming
     """
+    with stage("preprocess"):
+        return _preprocess(text)
+
+def _preprocess(text):
     text = re.sub(r'[^\w\s]', ' ', text.lower())
     
-    tokens = word_tokenize(text)
+    tools = _nltk_tools()
+    tokens = tools["word_tokenize"](text)
     
-    stop_words = set(stopwords.words('english'))
+    stop_words = tools["stop_words"]
     tokens = [word for word in tokens if word not in stop_words and len(word) > 1]
     
-    stemmer = PorterStemmer()
+    stemmer = tools["stemmer"]
     tokens = [stemmer.stem(word) for word in tokens]
     
     return ' '.join(tokens)
 
+_WORD_RE = re.compile(r'\S+')
+
+def _sentence_bounds(text, word_starts):
+    """
+    Word index ranges (first, last) of the sentences NLTK finds in text, or
+    None when a sentence cannot be located in it. Sentences come back as
+    slices of the text, so each is searched for after the previous one.
+    """
+    bounds, pos, first = [], 0, 0
+    for sentence in _nltk_tools()["sent_tokenize"](text):
+        start = text.find(sentence, pos)
+        if start < 0:
+            return None
+        pos = start + len(sentence)
+        last = bisect.bisect_left(word_starts, pos, first)
+        if last > first:
+            bounds.append((first, last))
+            first = last
+    if bounds and first < len(word_starts):
+        bounds[-1] = (bounds[-1][0], len(word_starts))
+    return bounds
+
+def chunk_spans(text, chunk_size=1000, overlap=200):
+    """
+    Yield (start, end) character offsets of overlapping chunks of at most
+    chunk_size words. Whole sentences are packed into chunks, each one
+    repeating up to overlap words of sentences from the end of the last
+    (fewer when the chunk would not fit otherwise); only a single sentence
+    longer than chunk_size makes a longer chunk, on its own. Text with fewer than three
+    sentences is cut into word windows instead. The text is tokenized once
+    and nothing is copied, so callers slice out only the chunks they use.
+    """
+    words = [match.span() for match in _WORD_RE.finditer(text)]
+    if len(words) <= chunk_size:
+        yield 0, len(text)
+        return
+
+    sentences = _sentence_bounds(text, [start for start, _ in words])
+    if sentences is None or len(sentences) < 3:
+        step = max(chunk_size - overlap, 1)
+        for first in range(0, len(words), step):
+            last = min(first + chunk_size, len(words))
+            yield words[first][0], words[last - 1][1]
+            if last == len(words):
+                return
+
+    # The current chunk is sentences[lo:hi], holding length words.
+    lo = hi = length = 0
+    for first, last in sentences:
+        if hi > lo and length + last - first > chunk_size:
+            yield words[sentences[lo][0]][0], words[sentences[hi - 1][1] - 1][1]
+            # Carry back whole sentences, as long as the next chunk still fits.
+            start, lo, length = lo, hi, 0
+            room = min(overlap, chunk_size - (last - first))
+            while lo > start and length + sentences[lo - 1][1] - sentences[lo - 1][0] <= room:
+                lo -= 1
+                length += sentences[lo][1] - sentences[lo][0]
+        hi += 1
+        length += last - first
+    yield words[sentences[lo][0]][0], words[sentences[hi - 1][1] - 1][1]
+
 def chunk_text(text, chunk_size=1000, overlap=200):
     """
-    Split long text into overlapping chunks for processing
+    Split long text into overlapping chunks for processing (see chunk_spans)
     """
-    if len(text) < chunk_size:
-        return [text]
-    
-    sentences = sent_tokenize(text)
-    
-    if len(sentences) < 3:
-        words = text.split()
-        chunks = []
-        
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            if chunk:
-                chunks.append(chunk)
-        
-        return chunks
-    
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    for sentence in sentences:
-        sentence_words = sentence.split()
-        sentence_length = len(sentence_words)
-        
-        if current_length + sentence_length <= chunk_size:
-            current_chunk.append(sentence)
-            current_length += sentence_length
-        else:
-            if current_chunk:
-                chunks.append(' '.join(current_chunk))
-            
-            if current_length > 0 and overlap > 0:
-                overlap_size = 0
-                overlap_chunk = []
-                
-                for s in reversed(current_chunk):
-                    s_len = len(s.split())
-                    if overlap_size + s_len <= overlap:
-                        overlap_chunk.insert(0, s)
-                        overlap_size += s_len
-                    else:
-                        break
-                
-                current_chunk = overlap_chunk
-                current_length = overlap_size
-            else:
-                current_chunk = []
-                current_length = 0
-            
-            current_chunk.append(sentence)
-            current_length += sentence_length
-    
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
-    
-    return chunks
\ No newline at end of file
+    return [text[start:end] for start, end in chunk_spans(text, chunk_size, overlap)]
+
+Gauge('docscan_model_loaded', 'Whether the embedding model is loaded (1) or not (0).',
+      lambda: int(_model is not None))
+Gauge('docscan_embedding_queue_depth', 'Encode requests waiting for the embedding service.',
+      lambda: embedding_service().stats()["queue_depth"])
@@ -1,31 +1,122 @@
-from utils.db import get_db
+from utils.db import read_db
+from utils.pagination import keyset_rows, encode_cursor, decode_cursor
 
-def get_admin_analytics():
-    conn = get_db()
+# Rollups kept by the triggers of migration 5: daily_user_scans (documents per
+# user per day), user_scan_totals (documents per user) and analytics_totals
+# (running counters: documents, scan_results, pending_credits, role:<role>).
 
-    cursor = conn.execute('SELECT COUNT(*) as total_scans FROM documents')
-    total_scans = cursor.fetchone()["total_scans"]
+def rebuild_rollups(conn):
+    """Recompute every rollup from the raw tables; the caller commits."""
+    conn.execute('DELETE FROM daily_user_scans')
+    conn.execute('DELETE FROM user_scan_totals')
+    conn.execute('DELETE FROM analytics_totals')
+    conn.execute('''
+        INSERT INTO daily_user_scans (day, username, scans)
+        SELECT COALESCE(date(scanned_at), date('now')), username, COUNT(*)
+        FROM documents GROUP BY 1, 2
+    ''')
+    conn.execute('''
+        INSERT INTO user_scan_totals (username, scans)
+        SELECT username, COUNT(*) FROM documents GROUP BY username
+    ''')
+    conn.execute('''
+        INSERT INTO analytics_totals (name, value) VALUES
+            ('documents', (SELECT COUNT(*) FROM documents)),
+            ('scan_results', (SELECT COUNT(*) FROM scan_results)),
+            ('pending_credits', (SELECT COUNT(*) FROM credit_requests WHERE status = 'pending'))
+    ''')
+    conn.execute('''
+        INSERT INTO analytics_totals (name, value)
+        SELECT 'role:' || IFNULL(role, 'none'), COUNT(*) FROM users GROUP BY 1
+    ''')
 
-    cursor = conn.execute('SELECT username, COUNT(*) as scans FROM documents GROUP BY username ORDER BY scans DESC')
-    rows = cursor.fetchall()
-    top_users = [(r["username"], r["scans"]) for r in rows]
+def _totals(conn):
+    return {row["name"]: row["value"] for row in conn.execute('SELECT name, value FROM analytics_totals')}
 
-    cursor = conn.execute('SELECT * FROM scan_results')
-    scan_rows = cursor.fetchall()
+def dashboard_analytics(conn):
+    """The admin dashboard's figures, read from the rollups."""
+    totals = _totals(conn)
 
-    match_details = []
-    for row in scan_rows:
-        match_details.append({
+    # The rollups have day granularity: active users are those with uploads
+    # today (UTC), and the timeline covers today and the six days before.
+    cursor = conn.execute('''
+        SELECT COUNT(DISTINCT username) AS active_users
+        FROM daily_user_scans
+        WHERE day > date('now', '-1 day')
+    ''')
+    active_users = cursor.fetchone()["active_users"]
+
+    cursor = conn.execute('''
+        SELECT day AS date, SUM(scans) AS count
+        FROM daily_user_scans
+        WHERE day >= date('now', '-6 days')
+        GROUP BY day
+        ORDER BY day
+    ''')
+    scan_timeline = [dict(row) for row in cursor.fetchall()]
+
+    user_distribution = [
+        {"role": name[len('role:'):], "count": value}
+        for name, value in sorted(totals.items()) if name.startswith('role:') and value > 0
+    ]
+
+    cursor = conn.execute('''
+        SELECT sr.id, sr.username, sr.doc_id, sr.matched_doc_id, sr.final_score as similarity,
+               sr.scanned_at as timestamp, d.filename
+        FROM scan_results sr
+        JOIN documents d ON sr.doc_id = d.id
+        ORDER BY sr.scanned_at DESC
+        LIMIT 10
+    ''')
+    recent_matches = []
+    for row in cursor.fetchall():
+        recent_matches.append({
+            "id": row["id"],
             "username": row["username"],
             "doc_id": row["doc_id"],
-            "matched_doc_id": row["matched_doc_id"],
-            "final_score": row["final_score"],
-            "is_similar": row["is_similar"],
-            "scanned_at": row["scanned_at"]
+            "filename": row["filename"],
+            "similarity": row["similarity"],
+            "timestamp": row["timestamp"]
         })
 
+    return {
+        "total_scans": totals.get("documents", 0),
+        "active_users": active_users,
+        "pending_credits": totals.get("pending_credits", 0),
+        "scan_timeline": scan_timeline,
+        "user_distribution": user_distribution,
+        "recent_matches": recent_matches
+    }
+
+def get_admin_analytics(limit=100, after=None):
+    """
+    Totals, the top users and one page of match details, newest first.
+    Pass the returned "next" cursor as `after` for the following page; it
+    is None on the last one. /admin/export/scan_results streams them all.
+    """
+    after = decode_cursor(after) if after else None
+    with read_db() as conn:
+        total_scans = _totals(conn).get("documents", 0)
+
+        cursor = conn.execute('SELECT username, scans FROM user_scan_totals ORDER BY scans DESC LIMIT 10')
+        top_users = [(r["username"], r["scans"]) for r in cursor.fetchall()]
+
+        rows = keyset_rows(conn, 'SELECT * FROM scan_results', 'scanned_at', 'id', after, limit + 1).fetchall()
+        next_cursor = encode_cursor(rows[limit - 1], 'scanned_at', 'id') if len(rows) > limit else None
+        match_details = []
+        for row in rows[:limit]:
+            match_details.append({
+                "username": row["username"],
+                "doc_id": row["doc_id"],
+                "matched_doc_id": row["matched_doc_id"],
+                "final_score": row["final_score"],
+                "is_similar": row["is_similar"],
+                "scanned_at": row["scanned_at"]
+            })
+
     return {
         "total_scans": total_scans,
         "top_users": top_users,
-        "match_details": match_details
+        "match_details": match_details,
+        "next": next_cursor
     }
@@ -0,0 +1,341 @@
+import os
+import json
+import shutil
+import hashlib
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking of the index files.
+    fcntl = None
+import threading
+from contextlib import contextmanager
+import numpy as np
+from utils.ai_matcher import MODEL_KEY, normalize_rows
+
+ANN_INDEX_FOLDER = os.path.join('data', 'ann')
+
+# Users with fewer documents than this are searched exhaustively.
+ANN_MIN_DOCS = int(os.environ.get('DOCSCAN_ANN_MIN_DOCS', 1000))
+# Number of candidate documents handed to the exact scorers.
+ANN_TOP_K = int(os.environ.get('DOCSCAN_ANN_TOP_K', 200))
+# Inverted lists probed per query chunk: higher means better recall, more latency.
+ANN_NPROBE = int(os.environ.get('DOCSCAN_ANN_NPROBE', 8))
+
+TRAIN_MIN_VECTORS = 256
+RETRAIN_GROWTH = 4
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class IVFIndex:
+    """
+    Inverted-file index over L2-normalized chunk embeddings.
+
+    Vectors are grouped under k-means centroids; a query only scores the
+    chunks in its `nprobe` nearest lists. Vectors, ids and list assignments
+    are append-only files, so adding a document never rewrites the index.
+    Writers hold an exclusive lock on the folder's lock file and first
+    catch up with whatever other processes wrote.
+    """
+
+    def __init__(self, dim, path=None):
+        self.dim = dim
+        self.path = path
+        self._clear()
+        # What of the files this copy has seen: rows, and retrains/rewrites.
+        self.disk_rows = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def _clear(self):
+        self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.lists = np.zeros(0, dtype=np.int32)
+        self.centroids = None
+        self.trained_size = 0
+        self.pending = []
+        self.pending_size = 0
+        self.known = set()
+
+    @property
+    def doc_ids(self):
+        with self.lock:
+            return set(self.known)
+
+    def add(self, doc_id, embeddings):
+        """Add one document's chunk embeddings to the index, unless it is already in it."""
+        vectors = normalize_rows(embeddings).reshape(-1, self.dim)
+        with self.lock, self._file_lock():
+            self._sync()
+            if doc_id in self.known:
+                return
+            ids = np.full(len(vectors), doc_id, dtype=np.int64)
+            lists = self._assign(vectors)
+            self.pending.append((vectors, ids, lists))
+            self.pending_size += len(vectors)
+            self.known.add(doc_id)
+            self._append(vectors, ids, lists)
+
+            size = len(self.ids) + self.pending_size
+            if self.centroids is None and size >= TRAIN_MIN_VECTORS:
+                self.train()
+            elif self.centroids is not None and size >= RETRAIN_GROWTH * self.trained_size:
+                self.train()
+
+    @contextmanager
+    def _file_lock(self):
+        if not self.path or fcntl is None:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file('lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self):
+        # Under the file lock: reload if another process appended or retrained.
+        if not self.path:
+            return
+        meta = _read_meta(self.path)
+        if meta is None or meta.get("model_name") != MODEL_KEY or meta.get("dim") != self.dim:
+            # Dropped, never written or another model's: start an empty index.
+            self._clear()
+            self.save()
+            return
+        ids_file = self._file('ids.i64')
+        rows = os.path.getsize(ids_file) // 8 if os.path.exists(ids_file) else 0
+        if rows != self.disk_rows or meta.get("generation", 0) != self.generation:
+            self._read_files(meta)
+
+    def _consolidate(self):
+        # Uploads only queue their rows; they are merged on the next read.
+        if not self.pending:
+            return
+        vectors, ids, lists = zip(*self.pending)
+        self.vectors = np.vstack((self.vectors,) + vectors)
+        self.ids = np.concatenate((self.ids,) + ids)
+        self.lists = np.concatenate((self.lists,) + lists)
+        self.pending = []
+        self.pending_size = 0
+
+    def train(self, iterations=10, seed=0):
+        """(Re)build the coarse centroids with spherical k-means."""
+        self._consolidate()
+        n_lists = max(1, int(np.sqrt(len(self.vectors))))
+        rng = np.random.default_rng(seed)
+        sample = self.vectors
+        if len(sample) > 50 * n_lists:
+            sample = sample[rng.choice(len(sample), 50 * n_lists, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+
+        self.centroids = centroids
+        self.trained_size = len(self.vectors)
+        self.lists = self._assign(self.vectors)
+        self._rewrite()
+
+    def search(self, query_embeddings, k=None, nprobe=None, exclude=None):
+        """
+        Return up to k (doc_id, score) pairs ranked by best chunk-to-chunk
+        cosine similarity against the query chunks.
+        """
+        k = ANN_TOP_K if k is None else k
+        nprobe = ANN_NPROBE if nprobe is None else nprobe
+        queries = normalize_rows(query_embeddings).reshape(-1, self.dim)
+        with self.lock:
+            self._consolidate()
+            vectors, ids, lists, centroids = self.vectors, self.ids, self.lists, self.centroids
+
+        if centroids is None or nprobe >= len(centroids):
+            rows = np.arange(len(vectors))
+        else:
+            probes = np.argsort(-(queries @ centroids.T), axis=1)[:, :nprobe]
+            rows = np.flatnonzero(np.isin(lists, np.unique(probes)))
+
+        if exclude is not None:
+            rows = rows[ids[rows] != exclude]
+        if not len(rows):
+            return []
+
+        chunk_best = (queries @ vectors[rows].T).max(axis=0)
+        row_ids = ids[rows]
+        order = np.lexsort((-chunk_best, row_ids))
+        first = np.concatenate(([True], row_ids[order][1:] != row_ids[order][:-1]))
+        doc_ids = row_ids[order][first]
+        doc_scores = chunk_best[order][first]
+
+        top = np.argsort(-doc_scores, kind='stable')[:k]
+        return [(int(doc_ids[i]), float(doc_scores[i])) for i in top]
+
+    def _assign(self, vectors):
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int32)
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _append(self, vectors, ids, lists):
+        if not self.path:
+            return
+        # vectors first and ids last: a row only counts once its id is on disk.
+        with open(self._file('vectors.f32'), 'ab') as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        with open(self._file('lists.i32'), 'ab') as f:
+            f.write(lists.tobytes())
+        with open(self._file('ids.i64'), 'ab') as f:
+            f.write(ids.tobytes())
+        self.disk_rows += len(ids)
+
+    def _rewrite(self):
+        if not self.path:
+            return
+        np.save(self._file('centroids.npy'), self.centroids)
+        tmp = self._file('lists.i32.tmp')
+        self.lists.tofile(tmp)
+        os.replace(tmp, self._file('lists.i32'))
+        self._write_meta()
+
+    def _write_meta(self):
+        self.generation += 1
+        meta = {
+            "model_name": MODEL_KEY, "dim": self.dim, "trained_size": self.trained_size,
+            "generation": self.generation
+        }
+        tmp = self._file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._file('meta.json'))
+
+    def save(self):
+        """Write the full index to its folder."""
+        self._consolidate()
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors.tofile(self._file('vectors.f32'))
+        self.lists.tofile(self._file('lists.i32'))
+        self.ids.tofile(self._file('ids.i64'))
+        self.disk_rows = len(self.ids)
+        if self.centroids is not None:
+            np.save(self._file('centroids.npy'), self.centroids)
+        elif os.path.exists(self._file('centroids.npy')):
+            os.remove(self._file('centroids.npy'))
+        self._write_meta()
+
+    def _read_files(self, meta):
+        vectors = np.fromfile(self._file('vectors.f32'), dtype=np.float32)
+        ids = np.fromfile(self._file('ids.i64'), dtype=np.int64)
+        lists = np.fromfile(self._file('lists.i32'), dtype=np.int32)
+        # A crash between appends can leave the files at different lengths.
+        n = min(len(vectors) // self.dim, len(ids), len(lists))
+        self.vectors = vectors[:n * self.dim].reshape(n, self.dim)
+        self.ids = ids[:n]
+        self.lists = lists[:n]
+        self.pending = []
+        self.pending_size = 0
+        self.known = set(self.ids.tolist())
+        self.disk_rows = n
+        self.generation = meta.get("generation", 0)
+        self.centroids = None
+        self.trained_size = 0
+        if os.path.exists(self._file('centroids.npy')):
+            self.centroids = np.load(self._file('centroids.npy'))
+            self.trained_size = meta.get("trained_size", n)
+        if n != len(ids) or n != len(lists) or n * self.dim != len(vectors):
+            self.save()
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save/add, or return None if unusable."""
+        meta = _read_meta(path)
+        if meta is None or meta.get("model_name") != MODEL_KEY:
+            return None
+
+        index = cls(meta["dim"], path)
+        with index.lock, index._file_lock():
+            index._sync()
+        return index
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def index_path(username):
+    return os.path.join(ANN_INDEX_FOLDER, hashlib.sha1(username.encode()).hexdigest())
+
+def get_user_index(conn, username):
+    """
+    Return the user's ANN index, loading it from disk or building it from
+    stored embeddings, and adding any documents the index has not seen yet.
+    """
+    from utils.embeddings import load_document_embeddings
+
+    with _indexes_lock:
+        index = _indexes.get(username)
+        if index is None:
+            index = IVFIndex.load(index_path(username))
+            _indexes[username] = index
+
+    cursor = conn.execute('SELECT id FROM documents WHERE username = ?', (username,))
+    known = index.doc_ids if index is not None else set()
+    missing = [row["id"] for row in cursor.fetchall() if row["id"] not in known]
+    if not missing:
+        return index
+
+    # Another thread or process may add some of these first; add() skips them.
+    for start in range(0, len(missing), 500):
+        embeddings = load_document_embeddings(conn, missing[start:start + 500])
+        if not embeddings:
+            return index
+        for doc_id, emb in embeddings.items():
+            index = add_to_index(username, doc_id, emb)
+    return index
+
+def add_to_index(username, doc_id, embeddings):
+    """Incrementally add a document to the user's ANN index."""
+    with _indexes_lock:
+        index = _indexes.get(username)
+        if index is None:
+            path = index_path(username)
+            index = IVFIndex.load(path)
+            if index is None or index.dim != embeddings.shape[1]:
+                # Created on disk by its first add, unless another process got there first.
+                index = IVFIndex(embeddings.shape[1], path)
+            _indexes[username] = index
+    index.add(doc_id, embeddings)
+    return index
+
+def drop_user_index(username):
+    """Discard the user's index; it is rebuilt from stored embeddings on demand."""
+    with _indexes_lock:
+        _indexes.pop(username, None)
+        shutil.rmtree(index_path(username), ignore_errors=True)
+
+def ann_candidates(conn, username, doc_id, target_embeddings, k=None, nprobe=None):
+    """
+    Ids of the top-k documents nearest to the target, or None when the
+    user's corpus is small enough for exhaustive matching.
+    """
+    if target_embeddings is None:
+        return None
+
+    cursor = conn.execute('SELECT COUNT(*) FROM documents WHERE username = ?', (username,))
+    if cursor.fetchone()[0] < ANN_MIN_DOCS:
+        return None
+
+    index = get_user_index(conn, username)
+    if index is None:
+        return None
+    return [candidate for candidate, _ in index.search(target_embeddings, k, nprobe, exclude=doc_id)]
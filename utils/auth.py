@@ -32,15 +32,8 @@ def register_user(data):
         
     conn = get_db()
     try:
-        # Check if the table has password_hash or password column
-        cursor = conn.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        # Use correct column name based on what exists in the database
-        password_column = "password_hash" if "password_hash" in columns else "password"
-        
-        query = f'''
-            INSERT INTO users (username, {password_column}, role, credits, phone, first_name, last_name, dob)
+        query = '''
+            INSERT INTO users (username, password_hash, role, credits, phone, first_name, last_name, dob)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         '''
         
@@ -69,14 +62,7 @@ def login_user(data):
     
     conn = get_db()
     
-    # Check if the table has password_hash or password column
-    cursor = conn.execute("PRAGMA table_info(users)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    # Use correct column name based on what exists in the database
-    password_column = "password_hash" if "password_hash" in columns else "password"
-    
-    query = f'SELECT * FROM users WHERE username=? AND {password_column}=?'
+    query = 'SELECT * FROM users WHERE username=? AND password_hash=?'
     
     cursor = conn.execute(query, (username, hash_password(password)))
     user = cursor.fetchone()
@@ -121,24 +107,17 @@ def change_password(username, data):
 
     conn = get_db()
     
-    # Check if the table has password_hash or password column
-    cursor = conn.execute("PRAGMA table_info(users)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    # Use correct column name based on what exists in the database
-    password_column = "password_hash" if "password_hash" in columns else "password"
-    
-    query = f'SELECT {password_column} FROM users WHERE username=?'
+    query = 'SELECT password_hash FROM users WHERE username=?'
     
     cursor = conn.execute(query, (username,))
     row = cursor.fetchone()
     if not row:
         return {"error": "User not found"}, 404
 
-    if row[password_column] != hash_password(old_password):
+    if row["password_hash"] != hash_password(old_password):
         return {"error": "Old password is incorrect"}, 401
 
-    update_query = f'UPDATE users SET {password_column}=? WHERE username=?'
+    update_query = 'UPDATE users SET password_hash=? WHERE username=?'
     conn.execute(update_query, (hash_password(new_password), username))
     conn.commit()
     return {"message": "Password changed successfully"}, 200
\ No newline at end of file
@@ -0,0 +1,83 @@
+import os
+import mmap
+import zlib
+import hashlib
+import tempfile
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+# Document bodies live here, compressed and named by the SHA-256 of their text.
+BLOB_FOLDER = os.environ.get('DOCSCAN_BLOB_FOLDER', os.path.join('data', 'blobs'))
+
+# Codec by file suffix; blobs written by either can always be read back.
+_CODECS = {
+    '.zst': (lambda data: zstandard.ZstdCompressor(level=10).compress(data),
+             lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)),
+    '.z': (lambda data: zlib.compress(data, 6), zlib.decompress)
+}
+WRITE_SUFFIX = '.zst' if HAVE_ZSTD else '.z'
+
+def blob_path(key, suffix):
+    return os.path.join(BLOB_FOLDER, key[:2], key[2:4], key + suffix)
+
+def _readable_suffixes():
+    return [suffix for suffix in _CODECS if suffix != '.zst' or HAVE_ZSTD]
+
+def put_text(text):
+    """Store a document body; returns its key. Identical bodies share one blob."""
+    data = text.encode('utf-8')
+    key = hashlib.sha256(data).hexdigest()
+    if any(os.path.exists(blob_path(key, suffix)) for suffix in _readable_suffixes()):
+        return key
+
+    path = blob_path(key, WRITE_SUFFIX)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    compress, _ = _CODECS[WRITE_SUFFIX]
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compress(data))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return key
+
+def get_text(key):
+    """Read a document body back, decompressing straight from a memory map."""
+    for suffix in _readable_suffixes():
+        path = blob_path(key, suffix)
+        if os.path.exists(path):
+            _, decompress = _CODECS[suffix]
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return decompress(data).decode('utf-8')
+    if os.path.exists(blob_path(key, '.zst')):
+        raise RuntimeError(f"Blob {key} is zstd-compressed but zstandard is not installed")
+    raise FileNotFoundError(f"Blob {key} not found in {BLOB_FOLDER}")
+
+def document_body(conn, doc_id):
+    """A document's full text, whether it is in the blob store or still inline."""
+    row = conn.execute('SELECT content, blob_key FROM documents WHERE id = ?', (doc_id,)).fetchone()
+    if row is None:
+        return None
+    return get_text(row["blob_key"]) if row["blob_key"] else row["content"]
+
+def migrate_documents(conn, batch_size=500):
+    """
+    Move a batch of inline document bodies into the blob store, leaving
+    only the key in the row. Returns the number moved.
+    """
+    rows = conn.execute(
+        'SELECT id, content FROM documents WHERE blob_key IS NULL LIMIT ?', (batch_size,)
+    ).fetchall()
+    for row in rows:
+        conn.execute(
+            "UPDATE documents SET blob_key = ?, content = '' WHERE id = ?",
+            (put_text(row["content"]), row["id"])
+        )
+    conn.commit()
+    return len(rows)
@@ -1,14 +1,37 @@
 import os
+import queue
+import time
 import sqlite3
 import logging
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context
+from utils.migrations import migrate
+from utils.metrics import METRICS_ENABLED, SQLITE_SECONDS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DB_PATH = os.path.join('data', 'document_scanner.db')
 
+# Connection tuning; journal mode is persistent and applied by init_db.
+JOURNAL_MODE = os.environ.get('DOCSCAN_SQLITE_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('DOCSCAN_SQLITE_SYNCHRONOUS', 'NORMAL')
+BUSY_TIMEOUT_MS = int(os.environ.get('DOCSCAN_SQLITE_BUSY_TIMEOUT_MS', 5000))
+# Negative values are KiB, as in PRAGMA cache_size.
+CACHE_SIZE = int(os.environ.get('DOCSCAN_SQLITE_CACHE_SIZE', -64000))
+MMAP_SIZE = int(os.environ.get('DOCSCAN_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+STATEMENT_CACHE_SIZE = int(os.environ.get('DOCSCAN_SQLITE_STATEMENT_CACHE', 256))
+# Read-only connections kept for analytics queries.
+READ_POOL_SIZE = int(os.environ.get('DOCSCAN_SQLITE_READ_POOL', 4))
+
+_local = threading.local()
+_read_pool = queue.LifoQueue()
+_read_pool_lock = threading.Lock()
+_read_pool_created = 0
+
 def init_db():
-    """Initialize the database with required tables."""
+    """Initialize the database: apply pending schema migrations and seed the admin."""
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     
     logger.info(f"Initializing database at {os.path.abspath(DB_PATH)}")
@@ -19,59 +42,9 @@ def init_db():
         logger.info("Database connection established")
         
         conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
         
-         # Create tables
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password_hash TEXT NOT NULL,
-            role TEXT DEFAULT 'user',
-            credits INTEGER DEFAULT 10,
-            phone TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            dob TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            content TEXT NOT NULL,
-            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (username) REFERENCES users(username)
-        )
-        ''')
-        
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS scan_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            doc_id INTEGER NOT NULL,
-            matched_doc_id INTEGER NOT NULL,
-            final_score REAL NOT NULL,
-            is_similar INTEGER,
-            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (username) REFERENCES users(username),
-            FOREIGN KEY (doc_id) REFERENCES documents(id)
-        )
-        ''')
-        
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS credit_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL,
-            amount INTEGER DEFAULT 5,
-            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'pending',
-            processed_at TIMESTAMP,
-            FOREIGN KEY (username) REFERENCES users(username)
-        )
-
-        ''')
+        migrate(conn)
         
         cursor = conn.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('admin',))
         if cursor.fetchone()[0] == 0:
@@ -96,13 +69,118 @@ def init_db():
         if conn:
             conn.close()
 
+_READ_STATEMENTS = ('SELECT', 'PRAGMA', 'EXPLAIN', 'WITH')
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection that times statements into docscan_sqlite_seconds, by read,
+    write or commit. Only execution up to the first row is timed; rows
+    fetched later are not.
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            op = 'read' if sql.lstrip()[:7].upper().startswith(_READ_STATEMENTS) else 'write'
+            SQLITE_SECONDS.observe(time.perf_counter() - start, op=op)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - start, op='write')
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - start, op='commit')
+
+def connect(read_only=False):
+    """Open a tuned connection; read-only ones cannot take the write lock."""
+    factory = TimedConnection if METRICS_ENABLED else sqlite3.Connection
+    if read_only:
+        conn = sqlite3.connect(f"file:{os.path.abspath(DB_PATH)}?mode=ro", uri=True,
+                               timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=factory)
+    else:
+        conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=factory)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    return conn
+
 def get_db():
-    """Get a database connection."""
+    """
+    Get the database connection of the current Flask app context, or of the
+    current thread outside one (background workers, CLI scripts). Callers
+    share it, so they must not close it.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON")
-        return conn
+        if has_app_context():
+            if 'db' not in g:
+                g.db = connect()
+            return g.db
+
+        # A forked worker must not reuse its parent's connection.
+        if getattr(_local, 'pid', None) != os.getpid():
+            _local.conn, _local.pid = connect(), os.getpid()
+        return _local.conn
     except Exception as e:
         logger.error(f"Database connection error: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def close_db(exception=None):
+    """Close the app context's connection, rolling back anything uncommitted."""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+
+def close_thread_db():
+    """Close the current thread's connection (background workers on exit)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn, _local.pid = None, None
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+
+@contextmanager
+def read_db():
+    """
+    Borrow a read-only connection from the pool. Under WAL, readers see a
+    consistent snapshot and never block the writer. Raises queue.Empty when
+    none is returned within BUSY_TIMEOUT_MS (the app answers 503).
+    """
+    global _read_pool_created
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        with _read_pool_lock:
+            create = _read_pool_created < READ_POOL_SIZE
+            if create:
+                _read_pool_created += 1
+        if not create:
+            conn = _read_pool.get(timeout=BUSY_TIMEOUT_MS / 1000)
+        else:
+            try:
+                conn = connect(read_only=True)
+            except Exception:
+                with _read_pool_lock:
+                    _read_pool_created -= 1
+                raise
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _read_pool.put(conn)
@@ -0,0 +1,149 @@
+import os
+import json
+import importlib.util
+import numpy as np
+
+# Where ONNX exports of the embedding model (and their int8 variants) live.
+ONNX_FOLDER = os.environ.get('DOCSCAN_ONNX_FOLDER', os.path.join('data', 'models', 'onnx'))
+# ONNX Runtime intra-op threads; 0 lets it use every core.
+ONNX_THREADS = int(os.environ.get('DOCSCAN_ONNX_THREADS', 0))
+ENCODE_BATCH_SIZE = 32
+
+# Packages each backend needs at runtime.
+BACKEND_REQUIREMENTS = {
+    "torch": ('sentence_transformers',),
+    "torch-int8": ('sentence_transformers', 'torch'),
+    "onnx": ('onnxruntime', 'tokenizers'),
+    "onnx-int8": ('onnxruntime', 'tokenizers')
+}
+
+def backend_available(name):
+    """Whether the packages a backend needs are installed (without importing them)."""
+    return all(importlib.util.find_spec(module) is not None for module in BACKEND_REQUIREMENTS[name])
+
+class TorchBackend:
+    """The sentence-transformers model on PyTorch, optionally with int8 dynamic quantization."""
+
+    def __init__(self, model_name, quantize=False):
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device='cpu')
+        if quantize:
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.name = 'torch-int8' if quantize else 'torch'
+
+    def encode(self, texts):
+        return np.asarray(
+            self.model.encode(texts, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True), dtype=np.float32
+        )
+
+def _onnx_paths(model_name, folder):
+    base = os.path.join(folder, model_name)
+    return {
+        "onnx": os.path.join(base, 'model.onnx'),
+        "onnx-int8": os.path.join(base, 'model.int8.onnx'),
+        "tokenizer": os.path.join(base, 'tokenizer.json'),
+        "meta": os.path.join(base, 'meta.json')
+    }
+
+def export_onnx(model_name, folder=ONNX_FOLDER):
+    """
+    Export the sentence-transformers model to ONNX, plus an int8 dynamically
+    quantized copy, with its tokenizer. Needs torch, onnx and onnxruntime;
+    meant for build time so the runtime only needs onnxruntime and tokenizers.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    paths = _onnx_paths(model_name, folder)
+    os.makedirs(os.path.dirname(paths["onnx"]), exist_ok=True)
+    model = SentenceTransformer(model_name, device='cpu')
+    pooling = model[1].get_pooling_mode_str()
+    if pooling != 'mean':
+        raise ValueError(f"Only mean pooling is supported by the ONNX backend, not {pooling}")
+
+    transformer = model[0].auto_model.eval()
+    inputs = dict(model.tokenizer(["warmup export"], return_tensors='pt'))
+    input_names = list(inputs)
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer, (inputs,), paths["onnx"],
+            input_names=input_names,
+            output_names=['last_hidden_state'],
+            dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']},
+            opset_version=14
+        )
+    quantize_dynamic(paths["onnx"], paths["onnx-int8"], weight_type=QuantType.QInt8)
+
+    model.tokenizer.save_pretrained(os.path.dirname(paths["onnx"]))
+    with open(paths["meta"], 'w') as f:
+        json.dump({"model_name": model_name, "max_seq_length": model.max_seq_length}, f)
+    return paths
+
+class OnnxBackend:
+    """The exported model on ONNX Runtime, fp32 or int8, with mean pooling done in numpy."""
+
+    def __init__(self, model_name, quantize=False, folder=ONNX_FOLDER):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.name = 'onnx-int8' if quantize else 'onnx'
+        paths = _onnx_paths(model_name, folder)
+        if not os.path.exists(paths[self.name]):
+            if not backend_available('torch'):
+                raise FileNotFoundError(f"No ONNX export at {paths[self.name]}; run bootstrap_resources.py")
+            export_onnx(model_name, folder)
+
+        with open(paths["meta"]) as f:
+            meta = json.load(f)
+        self.tokenizer = Tokenizer.from_file(paths["tokenizer"])
+        self.tokenizer.enable_truncation(meta["max_seq_length"])
+        pad_id = self.tokenizer.token_to_id('[PAD]') or 0
+        self.tokenizer.enable_padding(pad_id=pad_id, pad_token='[PAD]')
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = ONNX_THREADS
+        self.session = onnxruntime.InferenceSession(
+            paths[self.name], options, providers=['CPUExecutionProvider']
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": mask,
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64)
+        }
+        hidden, = self.session.run(['last_hidden_state'], {k: v for k, v in feeds.items() if k in self.input_names})
+        weights = mask[:, :, None].astype(np.float32)
+        return (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+
+    def encode(self, texts):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        # Batch texts of similar length together to keep padding down.
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        parts = [
+            self._encode_batch([texts[i] for i in order[start:start + ENCODE_BATCH_SIZE]])
+            for start in range(0, len(texts), ENCODE_BATCH_SIZE)
+        ]
+        embeddings = np.empty((len(texts), parts[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.vstack(parts)
+        return embeddings
+
+_LOADERS = {
+    "torch": lambda model_name: TorchBackend(model_name),
+    "torch-int8": lambda model_name: TorchBackend(model_name, quantize=True),
+    "onnx": lambda model_name: OnnxBackend(model_name),
+    "onnx-int8": lambda model_name: OnnxBackend(model_name, quantize=True)
+}
+
+def load_backend(name, model_name):
+    """Load an embedding backend by name; it has .name and .encode(texts) -> float32 matrix."""
+    if name not in _LOADERS:
+        raise ValueError(f"Unknown embedding backend: {name} (choose from {', '.join(_LOADERS)})")
+    return _LOADERS[name](model_name)
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+from collections import deque
+from utils.metrics import Histogram
+
+# Most texts encoded in one model call, summed over the merged requests.
+EMBED_BATCH_SIZE = int(os.environ.get('DOCSCAN_EMBED_BATCH_SIZE', 64))
+# Longest the oldest queued request waits for others to join its batch.
+EMBED_MAX_WAIT_MS = float(os.environ.get('DOCSCAN_EMBED_MAX_WAIT_MS', 5))
+
+BATCH_TEXTS = Histogram(
+    'docscan_embedding_batch_size', 'Texts encoded per merged embedding batch.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+)
+QUEUE_WAIT = Histogram('docscan_embedding_wait_seconds', 'Time encode requests queued before their batch ran.')
+
+class _Request:
+    __slots__ = ('texts', 'queued_at', 'done', 'result', 'error')
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.queued_at = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class EmbeddingService:
+    """
+    Merges encode requests from all threads into shared model calls. A
+    background thread takes queued requests until their texts reach
+    batch_size or the oldest has waited max_wait_ms, encodes them in one
+    call and hands each caller back its own rows. A request larger than
+    batch_size is encoded on its own.
+    """
+
+    def __init__(self, encode, batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_MAX_WAIT_MS):
+        self._encode = encode
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = deque()
+        self._queued_texts = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stats = {
+            "requests": 0, "batches": 0, "texts": 0, "errors": 0,
+            "max_batch_size": 0, "max_queue_depth": 0,
+            "wait_seconds": 0.0, "max_wait_seconds": 0.0, "encode_seconds": 0.0
+        }
+
+    def encode(self, texts):
+        """Encode a list of texts; blocks until its batch has run."""
+        texts = list(texts)
+        request = _Request(texts)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+                self._thread.start()
+            self._queue.append(request)
+            self._queued_texts += len(texts)
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+            self._cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0].queued_at + self.max_wait
+            while self._queued_texts < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = [self._queue.popleft()]
+            size = len(batch[0].texts)
+            while self._queue and size + len(self._queue[0].texts) <= self.batch_size:
+                request = self._queue.popleft()
+                batch.append(request)
+                size += len(request.texts)
+            self._queued_texts -= size
+            return batch, size
+
+    def _run(self):
+        while True:
+            batch, size = self._next_batch()
+            started = time.monotonic()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                embeddings = self._encode(texts) if texts else []
+                error = None
+            except Exception as e:
+                embeddings, error = None, e
+            finished = time.monotonic()
+
+            start = 0
+            for request in batch:
+                if error is None:
+                    request.result = embeddings[start:start + len(request.texts)]
+                else:
+                    request.error = error
+                start += len(request.texts)
+                request.done.set()
+
+            waits = [started - request.queued_at for request in batch]
+            BATCH_TEXTS.observe(size)
+            for wait in waits:
+                QUEUE_WAIT.observe(wait)
+            with self._cond:
+                stats = self._stats
+                stats["requests"] += len(batch)
+                stats["batches"] += 1
+                stats["texts"] += size
+                stats["errors"] += error is not None
+                stats["max_batch_size"] = max(stats["max_batch_size"], size)
+                stats["wait_seconds"] += sum(waits)
+                stats["max_wait_seconds"] = max(stats["max_wait_seconds"], max(waits))
+                stats["encode_seconds"] += finished - started
+
+    def stats(self):
+        """Queue depth, batch sizes and queueing/encode times so far."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._queue)
+            stats["queued_texts"] = self._queued_texts
+        batches, requests = stats["batches"], stats["requests"]
+        stats["avg_batch_size"] = round(stats["texts"] / batches, 2) if batches else 0.0
+        stats["avg_requests_per_batch"] = round(requests / batches, 2) if batches else 0.0
+        stats["avg_wait_ms"] = round(1000 * stats["wait_seconds"] / requests, 3) if requests else 0.0
+        stats["max_wait_ms"] = round(1000 * stats.pop("max_wait_seconds"), 3)
+        stats["batch_size_limit"] = self.batch_size
+        stats["max_wait_limit_ms"] = self.max_wait * 1000
+        return stats
@@ -0,0 +1,98 @@
+import numpy as np
+from utils.ai_matcher import MODEL_KEY, get_model, encode_with_offsets, chunk_spans
+from utils.text_pipeline import load_document_texts
+
+def encode_document(stemmed):
+    """
+    Encode a document's chunks from its stemmed text (see text_pipeline),
+    without touching the database. Returns (embeddings, chunk offsets), or
+    None when the transformer model is unavailable.
+    """
+    encoded = encode_with_offsets(stemmed)
+    if encoded is None or encoded[0].ndim != 2:
+        return None
+    return encoded
+
+def store_document_embeddings(conn, doc_id, encoded):
+    """
+    Store encode_document's output as a float32 blob keyed by document id
+    and model name, with each chunk's offsets in the stemmed text. Returns
+    the embedding matrix.
+    """
+    embeddings, offsets = encoded
+    conn.execute('''
+        INSERT OR REPLACE INTO document_embeddings (doc_id, model_name, n_chunks, dim, embeddings, chunk_offsets)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (doc_id, MODEL_KEY, embeddings.shape[0], embeddings.shape[1], embeddings.tobytes(), offsets.tobytes()))
+    return embeddings
+
+def save_document_embeddings(conn, doc_id, stemmed):
+    """Encode and store a document's chunk embeddings; None without a model."""
+    encoded = encode_document(stemmed)
+    return None if encoded is None else store_document_embeddings(conn, doc_id, encoded)
+
+def load_chunk_offsets(conn, doc_id):
+    """
+    (start, end) character offsets in the stemmed text of each stored
+    chunk embedding, as an int32 (n_chunks, 2) array, or None. Rows saved
+    before offsets were kept are re-chunked, if that gives as many chunks.
+    """
+    row = conn.execute(
+        'SELECT n_chunks, chunk_offsets FROM document_embeddings WHERE doc_id = ? AND model_name = ?',
+        (doc_id, MODEL_KEY)
+    ).fetchone()
+    if row is None:
+        return None
+    if row["chunk_offsets"] is not None:
+        return np.frombuffer(row["chunk_offsets"], dtype=np.int32).reshape(row["n_chunks"], 2)
+
+    text = load_document_texts(conn, [doc_id]).get(doc_id)
+    if text is None or text["stemmed"] is None:
+        return None
+    offsets = np.array(list(chunk_spans(text["stemmed"])), dtype=np.int32)
+    return offsets if len(offsets) == row["n_chunks"] else None
+
+def load_document_embeddings(conn, doc_ids):
+    """
+    Load stored chunk embeddings for the given document ids, keyed by id.
+    Documents stored before embeddings existed are encoded from their
+    stored text artifacts and saved on first use.
+    """
+    embeddings = {}
+
+    for start in range(0, len(doc_ids), 500):
+        batch = doc_ids[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(f'''
+            SELECT doc_id, n_chunks, dim, embeddings
+            FROM document_embeddings
+            WHERE model_name = ? AND doc_id IN ({placeholders})
+        ''', (MODEL_KEY, *batch))
+        for row in cursor.fetchall():
+            embeddings[row["doc_id"]] = np.frombuffer(
+                row["embeddings"], dtype=np.float32
+            ).reshape(row["n_chunks"], row["dim"])
+
+    if len(embeddings) == len(doc_ids) or get_model() is None:
+        # Nothing to backfill, or no model; callers fall back to TF-IDF scoring.
+        return embeddings
+
+    texts = load_document_texts(conn, [doc_id for doc_id in doc_ids if doc_id not in embeddings])
+    if conn.in_transaction:
+        conn.commit()
+    # Encode the whole batch before writing, so the write lock is not held
+    # through model inference.
+    encoded = {}
+    for doc_id, text in texts.items():
+        if text["stemmed"] is None:
+            continue
+        document = encode_document(text["stemmed"])
+        if document is None:
+            break
+        encoded[doc_id] = document
+
+    for doc_id, document in encoded.items():
+        embeddings[doc_id] = store_document_embeddings(conn, doc_id, document)
+    if encoded:
+        conn.commit()
+    return embeddings
@@ -0,0 +1,176 @@
+import io
+import csv
+import json
+import zlib
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+# Rows fetched from SQLite (and written as one columnar chunk) at a time.
+EXPORT_BATCH_SIZE = 5000
+
+EXPORT_TABLES = {
+    "scan_results": {
+        "columns": ['id', 'username', 'doc_id', 'matched_doc_id', 'final_score', 'is_similar', 'scanned_at'],
+        "select": 'SELECT sr.id, sr.username, sr.doc_id, sr.matched_doc_id, sr.final_score, sr.is_similar, sr.scanned_at',
+        "from": 'FROM scan_results sr',
+        "joined_columns": ['filename', 'matched_filename'],
+        "joined_select": ', d.filename AS filename, m.filename AS matched_filename',
+        "joined_from": ('LEFT JOIN documents d ON d.id = sr.doc_id '
+                        'LEFT JOIN documents m ON m.id = sr.matched_doc_id'),
+        "alias": 'sr',
+        "table": 'scan_results',
+        "joined_sources": {"filename": ('documents', 'filename'), "matched_filename": ('documents', 'filename')}
+    },
+    "documents": {
+        "columns": ['id', 'username', 'filename', 'scanned_at', 'blob_key'],
+        "select": 'SELECT d.id, d.username, d.filename, d.scanned_at, d.blob_key',
+        "from": 'FROM documents d',
+        "alias": 'd',
+        "table": 'documents'
+    }
+}
+
+EXPORT_FORMATS = {
+    "csv": ('text/csv', 'csv'),
+    "ndjson": ('application/x-ndjson', 'ndjson'),
+    "columnar": ('application/x-ndjson', 'columns.ndjson'),
+    "parquet": ('application/vnd.apache.parquet', 'parquet')
+}
+
+def export_columns(table, with_filenames=False):
+    spec = EXPORT_TABLES[table]
+    return spec["columns"] + (spec.get("joined_columns", []) if with_filenames else [])
+
+def declared_types(conn, table, with_filenames=False):
+    """Declared SQLite type of each exported column, e.g. INTEGER or TIMESTAMP."""
+    spec = EXPORT_TABLES[table]
+    types = {}
+    for source in {spec["table"], *(t for t, _ in spec.get("joined_sources", {}).values())}:
+        for row in conn.execute(f'PRAGMA table_info({source})'):
+            types[source, row["name"]] = row["type"].upper()
+    sources = {column: (spec["table"], column) for column in spec["columns"]}
+    sources.update(spec.get("joined_sources", {}))
+    return [types[sources[column]] for column in export_columns(table, with_filenames)]
+
+def export_batches(conn, table, start=None, end=None, username=None, with_filenames=False,
+                   batch_size=EXPORT_BATCH_SIZE):
+    """
+    Rows of an exportable table in id order, as lists of tuples of at most
+    batch_size rows. SQLite steps the cursor lazily, so only one batch is
+    held in memory. start and end are inclusive YYYY-MM-DD days.
+    """
+    spec = EXPORT_TABLES[table]
+    alias = spec["alias"]
+    query = spec["select"]
+    joins = ''
+    if with_filenames and "joined_select" in spec:
+        query += spec["joined_select"]
+        joins = spec["joined_from"]
+
+    conditions, params = [], []
+    if start:
+        conditions.append(f'{alias}.scanned_at >= date(?)')
+        params.append(start)
+    if end:
+        conditions.append(f"{alias}.scanned_at < date(?, '+1 day')")
+        params.append(end)
+    if username:
+        conditions.append(f'{alias}.username = ?')
+        params.append(username)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    cursor = conn.execute(f'{query} {spec["from"]} {joins} {where} ORDER BY {alias}.id', params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield [tuple(row) for row in rows]
+
+def _csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def _ndjson_chunks(columns, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows).encode('utf-8')
+
+def _columnar_chunks(columns, batches):
+    # One JSON object of column arrays per batch, like a row group.
+    for rows in batches:
+        yield (json.dumps(dict(zip(columns, map(list, zip(*rows))))) + '\n').encode('utf-8')
+
+def _arrow_type(declared):
+    # SQLite's affinity rules; timestamps are stored and exported as text.
+    if 'INT' in declared:
+        return pyarrow.int64()
+    if any(name in declared for name in ('REAL', 'FLOA', 'DOUB')):
+        return pyarrow.float64()
+    return pyarrow.string()
+
+def _parquet_chunks(columns, batches, types):
+    # The schema comes from the declared column types, not the first batch,
+    # where an all-NULL column would be typed null and fail later batches.
+    schema = pyarrow.schema([(column, _arrow_type(declared)) for column, declared in zip(columns, types)])
+    sink = io.BytesIO()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+        # Each batch becomes one row group, flushed to the client as written.
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def check_export(table, fmt):
+    """Raise ValueError unless the table and format can be exported."""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export table: {table}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == 'parquet' and not HAVE_PYARROW:
+        raise ValueError("Parquet export needs pyarrow; use the columnar format instead")
+
+def export_stream(conn, table, fmt='csv', gzip=False, start=None, end=None, username=None,
+                  with_filenames=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Encoded export of a table as a stream of byte chunks, in csv, ndjson,
+    columnar (one JSON object of column arrays per batch) or parquet (one
+    row group per batch, needs pyarrow), optionally gzip-compressed.
+    """
+    check_export(table, fmt)
+    columns = export_columns(table, with_filenames)
+    batches = export_batches(conn, table, start, end, username, with_filenames, batch_size)
+    encode = {
+        "csv": _csv_chunks,
+        "ndjson": _ndjson_chunks,
+        "columnar": _columnar_chunks,
+        "parquet": _parquet_chunks
+    }[fmt]
+    if fmt == 'parquet':
+        chunks = encode(columns, batches, declared_types(conn, table, with_filenames))
+    else:
+        chunks = encode(columns, batches)
+    return _gzip_chunks(chunks) if gzip else chunks
@@ -0,0 +1,88 @@
+import codecs
+import hashlib
+from collections import Counter
+from utils.text_pipeline import normalize_text
+from utils.blob_store import document_body
+
+READ_CHUNK_SIZE = 64 * 1024
+
+def _word_tail(text):
+    """Start of the trailing run of word characters, which may continue in the next chunk."""
+    i = len(text)
+    while i and (text[i - 1].isalnum() or text[i - 1] == '_'):
+        i -= 1
+    return i
+
+def read_upload(stream, chunk_size=READ_CHUNK_SIZE):
+    """
+    Read an upload stream in a single pass: decode it incrementally (utf-8,
+    falling back to latin-1), hash the raw bytes with SHA-256 and tokenize
+    as it goes. Returns the content, its hash, the normalized text and the
+    term counts, matching what normalize_text would produce.
+    """
+    digest = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parts, pieces, counts = [], [], Counter()
+    carry = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        final = not chunk
+        digest.update(chunk)
+        try:
+            text = decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            # Not utf-8: re-decode what was read so far as latin-1, which cannot fail.
+            pending, _ = decoder.getstate()
+            text = (''.join(parts).encode('utf-8') + pending + chunk).decode('latin-1')
+            decoder = codecs.getincrementaldecoder('latin-1')()
+            parts, pieces, counts = [], [], Counter()
+            carry = ''
+
+        parts.append(text)
+        text = carry + text
+        cut = len(text) if final else _word_tail(text)
+        text, carry = text[:cut], text[cut:]
+
+        tokens = normalize_text(text).split()
+        if tokens:
+            pieces.append(' '.join(tokens))
+            counts.update(tokens)
+        if final:
+            break
+
+    return {
+        "content": ''.join(parts),
+        "sha256": digest.hexdigest(),
+        "normalized": ' '.join(pieces),
+        "term_counts": counts
+    }
+
+def store_content_hash(conn, username, doc_id, sha256):
+    conn.execute(
+        'INSERT OR REPLACE INTO document_hashes (doc_id, username, sha256) VALUES (?, ?, ?)',
+        (doc_id, username, sha256)
+    )
+
+def backfill_content_hashes(conn, username):
+    """
+    Hash the user's documents stored before uploads were hashed. Their raw
+    bytes are gone, so the hash is taken over the utf-8 encoded content,
+    which matches the upload for every utf-8 file.
+    """
+    cursor = conn.execute('''
+        SELECT d.id FROM documents d
+        WHERE d.username = ?
+          AND NOT EXISTS (SELECT 1 FROM document_hashes h WHERE h.doc_id = d.id)
+    ''', (username,))
+    for row in cursor.fetchall():
+        content = document_body(conn, row["id"])
+        store_content_hash(conn, username, row["id"], hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+def find_duplicate(conn, username, sha256):
+    """The user's earliest document with exactly this content, or None."""
+    return conn.execute('''
+        SELECT d.id, d.filename FROM document_hashes h
+        JOIN documents d ON d.id = h.doc_id
+        WHERE h.username = ? AND h.sha256 = ?
+        ORDER BY d.id LIMIT 1
+    ''', (username, sha256)).fetchone()
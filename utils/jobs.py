@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import multiprocessing
+from utils.db import get_db, read_db, close_thread_db
+from utils.metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Number of background scan workers started with the app (0 disables them).
+SCAN_WORKERS = int(os.environ.get('DOCSCAN_SCAN_WORKERS', 2))
+# "thread" runs workers inside the web process; "process" forks one process each.
+SCAN_WORKER_KIND = os.environ.get('DOCSCAN_SCAN_WORKER_KIND', 'thread')
+# A running job whose heartbeat is older than this is considered orphaned.
+JOB_TIMEOUT_SECONDS = int(os.environ.get('DOCSCAN_JOB_TIMEOUT', 60))
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 10.0
+
+_workers = []
+_stop = None
+# Set to wake idle workers; a multiprocessing.Event once process workers start.
+_wake = threading.Event()
+_active = set()
+_active_lock = threading.Lock()
+
+def submit_scan(username, doc_id):
+    """Queue a match computation for a document; returns the job id."""
+    conn = get_db()
+    cursor = conn.execute(
+        'INSERT INTO scan_jobs (username, doc_id) VALUES (?, ?)', (username, doc_id)
+    )
+    conn.commit()
+    _wake.set()
+    return cursor.lastrowid
+
+def get_scan(username, job_id):
+    """Status of one of the user's jobs, with its matches once done."""
+    conn = get_db()
+    row = conn.execute(
+        'SELECT * FROM scan_jobs WHERE id = ? AND username = ?', (job_id, username)
+    ).fetchone()
+    if not row:
+        return None
+
+    job = {
+        "job_id": row["id"],
+        "doc_id": row["doc_id"],
+        "status": row["status"],
+        "progress": round(row["progress"], 2),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"]
+    }
+    if row["status"] == 'done':
+        job.update(json.loads(row["result"]))
+    elif row["status"] == 'failed':
+        job["error"] = row["error"]
+    return job
+
+def reclaim_orphaned_jobs(conn):
+    """
+    Requeue running jobs whose worker stopped heartbeating (it crashed or
+    the app restarted); jobs that already used every attempt are failed.
+    """
+    conn.execute('''
+        UPDATE scan_jobs
+        SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+            error = CASE WHEN attempts >= ? THEN 'Worker stopped responding' ELSE error END,
+            worker = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE status = 'running' AND heartbeat_at < datetime('now', ?)
+    ''', (MAX_ATTEMPTS, MAX_ATTEMPTS, f'-{JOB_TIMEOUT_SECONDS} seconds'))
+    conn.commit()
+
+def claim_job(conn, worker):
+    """Atomically move the oldest queued job to running; returns its row or None."""
+    row = conn.execute('''
+        UPDATE scan_jobs
+        SET status = 'running', worker = ?, attempts = attempts + 1, progress = 0,
+            heartbeat_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+        WHERE id = (SELECT id FROM scan_jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+          AND status = 'queued'
+        RETURNING id, username, doc_id
+    ''', (worker,)).fetchone()
+    conn.commit()
+    return row
+
+def run_job(conn, job):
+    """Compute the matches for a claimed job and store the outcome."""
+    from utils.scanner import get_matches
+
+    def report(progress):
+        conn.execute('''
+            UPDATE scan_jobs SET progress = ?, heartbeat_at = CURRENT_TIMESTAMP,
+                                 updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (progress, job["id"]))
+        conn.commit()
+
+    try:
+        result = get_matches(job["username"], job["doc_id"], progress=report)
+        if isinstance(result, dict) and 'matches' in result:
+            conn.execute('''
+                UPDATE scan_jobs SET status = 'done', progress = 1, result = ?,
+                                     updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (json.dumps(result), job["id"]))
+        else:
+            conn.execute('''
+                UPDATE scan_jobs SET status = 'failed', error = 'Document not found',
+                                     updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (job["id"],))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Scan job {job['id']} failed: {e}")
+        try:
+            conn.rollback()
+            conn.execute('''
+                UPDATE scan_jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (str(e), job["id"]))
+            conn.commit()
+        except Exception as write_error:
+            # Left running without heartbeats: reclaim_orphaned_jobs requeues it.
+            logger.error(f"Could not record the failure of scan job {job['id']}: {write_error}")
+            conn.rollback()
+
+def _heartbeat_loop(stop):
+    # Keeps jobs of this process alive even while a single step runs long.
+    conn = get_db()
+    while not stop.wait(HEARTBEAT_SECONDS):
+        with _active_lock:
+            active = list(_active)
+        if not active:
+            continue
+        try:
+            conn.executemany(
+                'UPDATE scan_jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ?',
+                [(job_id,) for job_id in active]
+            )
+            conn.commit()
+        except Exception as e:
+            # A missed beat is retried on the next one, well within JOB_TIMEOUT_SECONDS.
+            logger.error(f"Scan job heartbeat failed: {e}")
+            conn.rollback()
+    close_thread_db()
+
+def _worker_loop(name, stop, wake, own_heartbeat=False):
+    conn = get_db()
+    worker = f"{socket.gethostname()}:{os.getpid()}:{name}"
+    if own_heartbeat:
+        # A worker process of its own: load the models before taking jobs.
+        from utils.ai_matcher import warmup
+        warmup()
+        threading.Thread(target=_heartbeat_loop, args=(stop,), daemon=True).start()
+
+    last_reclaim = 0
+    while not stop.is_set():
+        try:
+            if time.monotonic() - last_reclaim >= HEARTBEAT_SECONDS:
+                reclaim_orphaned_jobs(conn)
+                last_reclaim = time.monotonic()
+            job = claim_job(conn, worker)
+        except Exception as e:
+            logger.error(f"Scan worker {worker} could not claim a job: {e}")
+            job = None
+
+        if job is None:
+            wake.wait(POLL_SECONDS)
+            wake.clear()
+            continue
+
+        with _active_lock:
+            _active.add(job["id"])
+        try:
+            run_job(conn, job)
+        except Exception as e:
+            logger.error(f"Scan worker {worker} lost job {job['id']}: {e}")
+        finally:
+            with _active_lock:
+                _active.discard(job["id"])
+    close_thread_db()
+
+def start_workers(count=None, kind=None):
+    """Start the background scan worker pool (once per process)."""
+    global _stop, _wake
+    count = SCAN_WORKERS if count is None else count
+    kind = SCAN_WORKER_KIND if kind is None else kind
+    if _workers or count <= 0:
+        return
+
+    if kind == 'process':
+        _stop = multiprocessing.Event()
+        # Shared with the worker processes, so submit_scan and stop_workers reach them.
+        _wake = multiprocessing.Event()
+        for i in range(count):
+            worker = multiprocessing.Process(
+                target=_worker_loop, args=(f"p{i}", _stop, _wake, True), daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+    else:
+        _stop = threading.Event()
+        threading.Thread(target=_heartbeat_loop, args=(_stop,), daemon=True).start()
+        for i in range(count):
+            worker = threading.Thread(
+                target=_worker_loop, args=(f"t{i}", _stop, _wake), daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+    logger.info(f"Started {count} scan {kind} worker(s)")
+
+def stop_workers(timeout=5):
+    """Signal the workers to stop and wait for them."""
+    if _stop is None:
+        return
+    _stop.set()
+    _wake.set()
+    for worker in _workers:
+        worker.join(timeout)
+    _workers.clear()
+
+def _job_counts():
+    with read_db() as conn:
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM scan_jobs WHERE status IN ('queued', 'running') GROUP BY status"
+        ).fetchall())
+    return [((status,), counts.get(status, 0)) for status in ('queued', 'running')]
+
+Gauge('docscan_scan_jobs', 'Scan jobs waiting or running, by status.', _job_counts, labels=('status',))
@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Set to 0 to turn instrumentation into no-ops.
+METRICS_ENABLED = os.environ.get('DOCSCAN_METRICS', '1') == '1'
+
+# Latency buckets in seconds, from sub-millisecond SQLite reads to slow scans.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_NULL = nullcontext()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        # An unlabelled counter is exported as 0 before its first increment.
+        self._values = {} if labels else {(): 0}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _label_text(self.labels, key), value) for key, value in sorted(values.items())]
+
+class Histogram:
+    """Observed values counted into cumulative buckets, per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def _timer(self, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def time(self, **labels):
+        """Context manager observing the seconds its block takes."""
+        return self._timer(labels) if METRICS_ENABLED else _NULL
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([*state[0]], state[1], state[2]) for key, state in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append((f'{self.name}_bucket', _label_text(self.labels, key, f'le="{bound}"'), cumulative))
+            samples.append((f'{self.name}_bucket', _label_text(self.labels, key, 'le="+Inf"'), count))
+            samples.append((f'{self.name}_sum', _label_text(self.labels, key), total))
+            samples.append((f'{self.name}_count', _label_text(self.labels, key), count))
+        return samples
+
+class Gauge:
+    """
+    A current value read at scrape time from a callback, which returns a
+    number or a list of (label values, number) pairs.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.read = read
+        _registry.append(self)
+
+    def samples(self):
+        value = self.read()
+        if not isinstance(value, list):
+            value = [((), value)]
+        return [(self.name, _label_text(self.labels, key), v) for key, v in value]
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            lines.append(f"# {metric.name} unavailable: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+STAGE_SECONDS = Histogram(
+    'docscan_stage_seconds', 'Time spent in each stage of scanning and matching.', labels=('stage',)
+)
+SQLITE_SECONDS = Histogram(
+    'docscan_sqlite_seconds', 'Time spent executing SQLite statements, by kind.', labels=('op',)
+)
+DOCUMENTS_SCANNED = Counter('docscan_documents_scanned_total', 'Documents uploaded and indexed.')
+MATCH_REQUESTS = Counter('docscan_match_requests_total', 'Match computations run, by cascade mode.', labels=('mode',))
+PAIRS_SCORED = Counter('docscan_pairs_scored_total', 'Document pairs scored, by scorer.', labels=('scorer',))
+PAIR_CACHE = Counter('docscan_pair_cache_total', 'Pair score cache lookups, by result.', labels=('result',))
+TEXTS_ENCODED = Counter('docscan_texts_encoded_total', 'Chunks run through the embedding model.')
+
+def stage(name):
+    """Context manager timing a named stage into docscan_stage_seconds."""
+    return STAGE_SECONDS.time(stage=name) if METRICS_ENABLED else _NULL
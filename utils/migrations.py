@@ -0,0 +1,343 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _baseline(conn):
+    # Every table as it existed before the schema was versioned; IF NOT
+    # EXISTS lets this adopt databases created by older releases.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password_hash TEXT NOT NULL,
+        role TEXT DEFAULT 'user',
+        credits INTEGER DEFAULT 10,
+        phone TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        dob TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        content TEXT NOT NULL,
+        scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        blob_key TEXT,
+        FOREIGN KEY (username) REFERENCES users(username)
+    )
+    ''')
+
+    # Bodies now live in the blob store; older databases gain the key column.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(documents)")]
+    if 'blob_key' not in columns:
+        conn.execute('ALTER TABLE documents ADD COLUMN blob_key TEXT')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS scan_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        doc_id INTEGER NOT NULL,
+        matched_doc_id INTEGER NOT NULL,
+        final_score REAL NOT NULL,
+        is_similar INTEGER,
+        scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (username) REFERENCES users(username),
+        FOREIGN KEY (doc_id) REFERENCES documents(id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS credit_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        amount INTEGER DEFAULT 5,
+        requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending',
+        processed_at TIMESTAMP,
+        FOREIGN KEY (username) REFERENCES users(username)
+    )
+
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS document_text (
+        doc_id INTEGER PRIMARY KEY,
+        pipeline_version INTEGER NOT NULL,
+        normalized TEXT NOT NULL,
+        stemmed TEXT,
+        term_counts TEXT NOT NULL,
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS document_hashes (
+        doc_id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_document_hashes_user ON document_hashes (username, sha256)')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS document_embeddings (
+        doc_id INTEGER NOT NULL,
+        model_name TEXT NOT NULL,
+        n_chunks INTEGER NOT NULL,
+        dim INTEGER NOT NULL,
+        embeddings BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (doc_id, model_name),
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS term_postings (
+        username TEXT NOT NULL,
+        term TEXT NOT NULL,
+        doc_id INTEGER NOT NULL,
+        tf INTEGER NOT NULL,
+        PRIMARY KEY (username, term, doc_id),
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_term_postings_doc ON term_postings (doc_id)')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS document_terms (
+        doc_id INTEGER PRIMARY KEY,
+        n_terms INTEGER NOT NULL,
+        norm REAL NOT NULL,
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS minhash_signatures (
+        doc_id INTEGER PRIMARY KEY,
+        scheme TEXT NOT NULL,
+        signature BLOB NOT NULL,
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS lsh_buckets (
+        username TEXT NOT NULL,
+        scheme TEXT NOT NULL,
+        band INTEGER NOT NULL,
+        bucket INTEGER NOT NULL,
+        doc_id INTEGER NOT NULL,
+        PRIMARY KEY (username, scheme, band, bucket, doc_id),
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_lsh_buckets_doc ON lsh_buckets (doc_id, scheme, band)')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS tfidf_corpus (
+        username TEXT PRIMARY KEY,
+        n_docs INTEGER NOT NULL
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS tfidf_df (
+        username TEXT NOT NULL,
+        feature INTEGER NOT NULL,
+        df INTEGER NOT NULL,
+        PRIMARY KEY (username, feature)
+    ) WITHOUT ROWID
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS tfidf_vectors (
+        doc_id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        n_docs INTEGER NOT NULL,
+        features BLOB NOT NULL,
+        counts BLOB NOT NULL,
+        weights BLOB NOT NULL,
+        FOREIGN KEY (doc_id) REFERENCES documents(id) ON DELETE CASCADE
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pair_scores (
+        doc_a INTEGER NOT NULL,
+        doc_b INTEGER NOT NULL,
+        scorer TEXT NOT NULL,
+        score REAL,
+        PRIMARY KEY (doc_a, doc_b, scorer),
+        FOREIGN KEY (doc_a) REFERENCES documents(id) ON DELETE CASCADE,
+        FOREIGN KEY (doc_b) REFERENCES documents(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pair_scores_doc_b ON pair_scores (doc_b)')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS scan_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        doc_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress REAL NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        worker TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        heartbeat_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (username) REFERENCES users(username),
+        FOREIGN KEY (doc_id) REFERENCES documents(id)
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_jobs_status ON scan_jobs (status, id)')
+
+def _hot_query_indexes(conn):
+    # get_matches and the per-user index maintenance filter documents by user.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_user ON documents (username, id)')
+    # Analytics: activity windows and the daily timeline over scanned_at.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_scanned ON documents (scanned_at, username)')
+    # request_credits looks for a pending request of the user; analytics counts pending ones.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_credit_requests_user ON credit_requests (username, status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_credit_requests_status ON credit_requests (status, requested_at)')
+    # /admin/analytics joins recent scan_results to documents through doc_id.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_results_doc ON scan_results (doc_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_results_scanned ON scan_results (scanned_at, doc_id)')
+
+def _password_hash_column(conn):
+    # Very old databases named the column "password"; settle on password_hash.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    if 'password_hash' not in columns and 'password' in columns:
+        conn.execute('ALTER TABLE users RENAME COLUMN password TO password_hash')
+
+def _listing_indexes(conn):
+    # Keyset pagination of the admin listings: newest first, ties by key.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, username)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_documents_listing ON documents (scanned_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_credit_requests_listing ON credit_requests (requested_at, id)')
+
+def _analytics_rollups(conn):
+    # Counters maintained by triggers in the same transaction as each write,
+    # so the analytics endpoints read a handful of rows.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS daily_user_scans (
+        day TEXT NOT NULL,
+        username TEXT NOT NULL,
+        scans INTEGER NOT NULL,
+        PRIMARY KEY (day, username)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS user_scan_totals (
+        username TEXT PRIMARY KEY,
+        scans INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_scan_totals_scans ON user_scan_totals (scans)')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_totals (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+
+    def bump(name, delta, when='1'):
+        return f'''
+        INSERT INTO analytics_totals (name, value) SELECT {name}, {delta} WHERE {when}
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;'''
+
+    def scans(row, delta):
+        return f'''
+        INSERT INTO daily_user_scans (day, username, scans)
+            VALUES (COALESCE(date({row}.scanned_at), date('now')), {row}.username, {delta})
+            ON CONFLICT(day, username) DO UPDATE SET scans = scans + excluded.scans;
+        INSERT INTO user_scan_totals (username, scans) VALUES ({row}.username, {delta})
+            ON CONFLICT(username) DO UPDATE SET scans = scans + excluded.scans;''' + bump("'documents'", delta)
+
+    triggers = {
+        'rollup_documents_insert': ('AFTER INSERT ON documents', scans('NEW', 1)),
+        'rollup_documents_delete': ('AFTER DELETE ON documents', scans('OLD', -1)),
+        'rollup_scan_results_insert': ('AFTER INSERT ON scan_results', bump("'scan_results'", 1)),
+        'rollup_scan_results_delete': ('AFTER DELETE ON scan_results', bump("'scan_results'", -1)),
+        'rollup_credit_requests_insert': ('AFTER INSERT ON credit_requests',
+                                          bump("'pending_credits'", 1, "NEW.status = 'pending'")),
+        'rollup_credit_requests_update': ('AFTER UPDATE OF status ON credit_requests',
+                                          bump("'pending_credits'", "(NEW.status = 'pending') - (OLD.status = 'pending')")),
+        'rollup_credit_requests_delete': ('AFTER DELETE ON credit_requests',
+                                          bump("'pending_credits'", -1, "OLD.status = 'pending'")),
+        'rollup_users_insert': ('AFTER INSERT ON users', bump("'role:' || IFNULL(NEW.role, 'none')", 1)),
+        'rollup_users_update': ('AFTER UPDATE OF role ON users',
+                                bump("'role:' || IFNULL(OLD.role, 'none')", -1) + bump("'role:' || IFNULL(NEW.role, 'none')", 1)),
+        'rollup_users_delete': ('AFTER DELETE ON users', bump("'role:' || IFNULL(OLD.role, 'none')", -1)),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body}\n    END')
+
+    from utils.analytics import rebuild_rollups
+    rebuild_rollups(conn)
+
+def _export_indexes(conn):
+    # Exports filter scan_results by user and date range.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_results_user ON scan_results (username, scanned_at)')
+
+def _chunk_offsets_column(conn):
+    # Character offsets of each embedded chunk in the document's stemmed text.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(document_embeddings)")]
+    if 'chunk_offsets' not in columns:
+        conn.execute('ALTER TABLE document_embeddings ADD COLUMN chunk_offsets BLOB')
+
+def _text_artifact_blobs(conn):
+    # Normalized and stemmed text and term counts move to the blob store.
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(document_text)")]
+    if 'blob_key' not in columns:
+        conn.execute('ALTER TABLE document_text ADD COLUMN blob_key TEXT')
+
+# Ordered schema steps; append new ones, never edit or reorder applied ones.
+MIGRATIONS = [
+    (1, "Baseline schema", _baseline),
+    (2, "Indexes for the hot queries", _hot_query_indexes),
+    (3, "Settle the users password column", _password_hash_column),
+    (4, "Indexes for paginated admin listings", _listing_indexes),
+    (5, "Analytics rollups maintained by triggers", _analytics_rollups),
+    (6, "Index for per-user exports", _export_indexes),
+    (7, "Chunk offsets for stored embeddings", _chunk_offsets_column),
+    (8, "Text artifacts in the blob store", _text_artifact_blobs),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn):
+    """The schema version recorded in the database header."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """Apply the pending migrations in order, each in its own transaction."""
+    current = schema_version(conn)
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {current} is newer than this release ({SCHEMA_VERSION})")
+
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            # Another process may have migrated while this one waited for the lock.
+            conn.execute('BEGIN IMMEDIATE')
+            if schema_version(conn) >= version:
+                conn.commit()
+                continue
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied migration {version}: {description}")
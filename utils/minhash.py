@@ -0,0 +1,144 @@
+import os
+import zlib
+import hashlib
+import numpy as np
+
+# Signature length; the standard error of the Jaccard estimate is about 1/sqrt(MINHASH_PERM).
+MINHASH_PERM = int(os.environ.get('DOCSCAN_MINHASH_PERM', 128))
+# Words per shingle. 1 estimates the same word-set Jaccard as scanner.calculate_similarity.
+SHINGLE_SIZE = int(os.environ.get('DOCSCAN_SHINGLE_SIZE', 1))
+# Similarity at which a pair should become an LSH candidate (the is_similar cutoff).
+LSH_THRESHOLD = float(os.environ.get('DOCSCAN_LSH_THRESHOLD', 0.5))
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, _PRIME, size=MINHASH_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, size=MINHASH_PERM, dtype=np.uint64)
+
+def lsh_params(threshold=LSH_THRESHOLD, num_perm=MINHASH_PERM):
+    """
+    Choose (bands, rows) with bands * rows <= num_perm minimising the
+    probability mass of false positives below the threshold plus false
+    negatives above it, for the S-curve 1 - (1 - s^rows)^bands.
+    """
+    s = np.linspace(0, 1, 201)
+    best, best_error = (1, num_perm), None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        p = 1 - (1 - s ** rows) ** bands
+        error = np.where(s < threshold, p, 1 - p).mean()
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+LSH_BANDS, LSH_ROWS = lsh_params()
+LSH_BANDS = int(os.environ.get('DOCSCAN_LSH_BANDS', LSH_BANDS))
+LSH_ROWS = int(os.environ.get('DOCSCAN_LSH_ROWS', LSH_ROWS))
+
+SIGNATURE_SCHEME = f"{MINHASH_PERM}:{SHINGLE_SIZE}"
+LSH_SCHEME = f"{SIGNATURE_SCHEME}:{LSH_BANDS}x{LSH_ROWS}"
+
+def shingles(tokens, size=SHINGLE_SIZE):
+    """Distinct word shingles of the given size."""
+    if size <= 1:
+        return set(tokens)
+    return {' '.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+def minhash_signature(tokens, block_size=4096):
+    """
+    MinHash signature of a token stream as a uint32 array. Each distinct
+    shingle is hashed once; the permutations are applied with NumPy.
+    """
+    values = np.fromiter(
+        (zlib.crc32(s.encode()) & _PRIME for s in shingles(tokens)), dtype=np.uint64
+    )
+    signature = np.full(MINHASH_PERM, _PRIME, dtype=np.uint64)
+    for start in range(0, len(values), block_size):
+        block = values[start:start + block_size, None]
+        np.minimum(signature, ((block * _A + _B) % _PRIME).min(axis=0), out=signature)
+    return signature.astype(np.uint32)
+
+def estimate_jaccard(signature, signatures):
+    """
+    Estimated Jaccard similarity of one signature against a matrix of them.
+    Empty documents (all slots unset) score 0, as in the exact scorer.
+    """
+    if not len(signatures):
+        return np.zeros(0)
+    signatures = np.asarray(signatures)
+    estimates = (signatures == signature).mean(axis=1)
+    if (signature == _PRIME).all():
+        return np.zeros(len(signatures))
+    estimates[(signatures == _PRIME).all(axis=1)] = 0
+    return estimates
+
+def band_buckets(signature):
+    """One signed 64-bit bucket key per LSH band."""
+    return [
+        int.from_bytes(hashlib.blake2b(
+            signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes(), digest_size=8
+        ).digest(), 'big', signed=True)
+        for band in range(LSH_BANDS)
+    ]
+
+def index_minhash(conn, username, doc_id, tokens):
+    """Store a document's signature and its LSH band buckets."""
+    signature = minhash_signature(tokens)
+    conn.execute(
+        'INSERT OR REPLACE INTO minhash_signatures (doc_id, scheme, signature) VALUES (?, ?, ?)',
+        (doc_id, SIGNATURE_SCHEME, signature.tobytes())
+    )
+    conn.execute('DELETE FROM lsh_buckets WHERE doc_id = ?', (doc_id,))
+    conn.executemany(
+        'INSERT INTO lsh_buckets (username, scheme, band, bucket, doc_id) VALUES (?, ?, ?, ?, ?)',
+        [(username, LSH_SCHEME, band, bucket, doc_id) for band, bucket in enumerate(band_buckets(signature))]
+    )
+    return signature
+
+def unhashed_documents(conn, username):
+    """Ids of the user's documents without buckets for the current LSH scheme."""
+    cursor = conn.execute('''
+        SELECT d.id FROM documents d
+        WHERE d.username = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM lsh_buckets b
+              WHERE b.doc_id = d.id AND b.scheme = ? AND b.band = 0
+          )
+    ''', (username, LSH_SCHEME))
+    return [row["id"] for row in cursor.fetchall()]
+
+def load_signatures(conn, doc_ids):
+    """Map document ids to their stored signatures."""
+    signatures = {}
+    for start in range(0, len(doc_ids), 500):
+        batch = doc_ids[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(f'''
+            SELECT doc_id, signature FROM minhash_signatures
+            WHERE scheme = ? AND doc_id IN ({placeholders})
+        ''', (SIGNATURE_SCHEME, *batch))
+        for row in cursor.fetchall():
+            signatures[row["doc_id"]] = np.frombuffer(row["signature"], dtype=np.uint32)
+    return signatures
+
+def lsh_candidates(conn, username, doc_id):
+    """
+    Near-duplicate candidates of a document: the user's documents sharing
+    at least one LSH band bucket with it, mapped to their estimated Jaccard.
+    """
+    cursor = conn.execute('''
+        SELECT DISTINCT other.doc_id
+        FROM lsh_buckets own
+        JOIN lsh_buckets other
+          ON other.username = own.username AND other.scheme = own.scheme
+         AND other.band = own.band AND other.bucket = own.bucket
+        WHERE own.doc_id = ? AND own.username = ? AND own.scheme = ? AND other.doc_id != own.doc_id
+    ''', (doc_id, username, LSH_SCHEME))
+    candidate_ids = [row["doc_id"] for row in cursor.fetchall()]
+
+    signatures = load_signatures(conn, [doc_id] + candidate_ids)
+    if doc_id not in signatures:
+        return {}
+    candidate_ids = [i for i in candidate_ids if i in signatures]
+    estimates = estimate_jaccard(signatures[doc_id], [signatures[i] for i in candidate_ids])
+    return dict(zip(candidate_ids, estimates.tolist()))
@@ -0,0 +1,90 @@
+import json
+import base64
+import binascii
+from contextlib import ExitStack
+from flask import request, jsonify, Response, stream_with_context
+from utils.db import read_db
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(row, sort_column, key_column):
+    """Opaque cursor pointing just past a row."""
+    return base64.urlsafe_b64encode(json.dumps([row[sort_column], row[key_column]]).encode()).decode()
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    return values
+
+def keyset_rows(conn, select, sort_column, key_column, after=None, limit=None):
+    """
+    Rows of `select` (which must not have its own WHERE) newest first by
+    sort_column, ties broken by the unique key_column, starting after the
+    (sort value, key) cursor. Rows with a NULL sort value come last.
+    """
+    where, params = '', []
+    if after is not None:
+        sort_value, key_value = after
+        if sort_value is None:
+            where = f'WHERE {sort_column} IS NULL AND {key_column} < ?'
+            params = [key_value]
+        else:
+            where = (f'WHERE ({sort_column} < ? OR ({sort_column} = ? AND {key_column} < ?) '
+                     f'OR {sort_column} IS NULL)')
+            params = [sort_value, sort_value, key_value]
+
+    query = f'{select} {where} ORDER BY {sort_column} DESC, {key_column} DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return conn.execute(query, params)
+
+def listing_response(name, select, sort_column, key_column):
+    """
+    Serve one page of a listing from a read-only connection. `limit` and
+    `after` select the page; the JSON body carries the cursor of the next
+    page. With format=ndjson (or an application/x-ndjson Accept header)
+    rows are streamed one per line as the cursor yields them, followed by
+    a {"next": cursor} line if a limit cut the listing short.
+    """
+    ndjson = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    try:
+        limit = request.args.get('limit', type=int)
+        after = request.args.get('after')
+        after = decode_cursor(after) if after else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if limit is None and not ndjson:
+        limit = DEFAULT_PAGE_SIZE
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+    fetch = limit + 1 if limit is not None else None
+    if ndjson:
+        # Borrowed before streaming starts, so a busy pool is still a 503.
+        reader = ExitStack()
+        conn = reader.enter_context(read_db())
+
+        def generate():
+            cursor = keyset_rows(conn, select, sort_column, key_column, after, fetch)
+            last = None
+            for i, row in enumerate(cursor):
+                if limit is not None and i == limit:
+                    yield json.dumps({"next": encode_cursor(last, sort_column, key_column)}) + '\n'
+                    break
+                last = row
+                yield json.dumps(dict(row)) + '\n'
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.call_on_close(reader.close)
+        return response
+
+    with read_db() as conn:
+        rows = keyset_rows(conn, select, sort_column, key_column, after, fetch).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1], sort_column, key_column) if len(rows) > limit else None
+    return jsonify({name: [dict(row) for row in rows[:limit]], "next": next_cursor})
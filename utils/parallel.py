@@ -0,0 +1,127 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+    HAVE_THREADPOOLCTL = True
+except ImportError:
+    HAVE_THREADPOOLCTL = False
+
+logger = logging.getLogger(__name__)
+
+# Processes used to score large candidate sets (1 disables the pool).
+SCORE_WORKERS = int(os.environ.get('DOCSCAN_SCORE_WORKERS', os.cpu_count() or 1))
+# Below these many candidate rows the pool's dispatch overhead outweighs the
+# extra cores, so scoring stays in-process.
+PARALLEL_MIN_CHUNKS = int(os.environ.get('DOCSCAN_PARALLEL_MIN_CHUNKS', 50000))
+PARALLEL_MIN_FEATURES = int(os.environ.get('DOCSCAN_PARALLEL_MIN_FEATURES', 2000000))
+
+_pool = None
+_pool_size = 0
+
+def _init_worker():
+    # One BLAS thread per process, otherwise the workers oversubscribe the cores.
+    if HAVE_THREADPOOLCTL:
+        threadpool_limits(1)
+
+def get_pool(workers):
+    """
+    The shared scoring pool, (re)created with the requested size. It is
+    created lazily while other threads are running, so workers come from a
+    forkserver rather than a fork of this process; the kernels only need
+    NumPy and the shared memory blocks.
+    """
+    global _pool, _pool_size
+    if _pool is None or _pool_size != workers:
+        shutdown_pool()
+        _pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, mp_context=multiprocessing.get_context('forkserver')
+        )
+        _pool_size = workers
+    return _pool
+
+def shutdown_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+    _pool, _pool_size = None, 0
+
+def _share(array):
+    """Copy an array into a new shared memory block; returns (block, spec)."""
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def _attach(spec, blocks):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _score_shard(kernel, segmented_specs, broadcast_specs, row_start, row_end, offsets):
+    blocks = []
+    try:
+        segmented = [_attach(spec, blocks)[row_start:row_end] for spec in segmented_specs]
+        broadcast = [_attach(spec, blocks) for spec in broadcast_specs]
+        result = kernel(segmented, offsets, *broadcast)
+        del segmented, broadcast
+        return result
+    finally:
+        for block in blocks:
+            block.close()
+
+def shard_bounds(lengths, n_shards):
+    """Split segments into contiguous shards holding roughly equal row counts."""
+    ends = np.cumsum(lengths)
+    targets = ends[-1] * np.arange(1, n_shards) / n_shards
+    cuts = np.unique(np.concatenate(([0], np.searchsorted(ends, targets, side='right'), [len(lengths)])))
+    return list(zip(cuts[:-1].tolist(), cuts[1:].tolist()))
+
+def score_segments(kernel, segmented, lengths, broadcast=(), min_rows=0, workers=None):
+    """
+    Score variable-length segments of row arrays, one score per segment.
+
+    `segmented` arrays are stacked row-wise with segment i spanning
+    lengths[i] rows; `broadcast` arrays are passed whole. `kernel` is called
+    as kernel(segmented_slices, offsets, *broadcast) and must return one
+    score per segment. With enough rows the segments are sharded across the
+    process pool, which reads every array from shared memory instead of
+    having it pickled; otherwise, or if the pool fails, it runs in-process.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    workers = SCORE_WORKERS if workers is None else workers
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    if workers <= 1 or len(lengths) < 2 or lengths.sum() < max(min_rows, 1):
+        return kernel(list(segmented), offsets, *broadcast)
+
+    blocks = []
+    try:
+        segmented_specs, broadcast_specs = [], []
+        for array, specs in [(a, segmented_specs) for a in segmented] + [(a, broadcast_specs) for a in broadcast]:
+            block, spec = _share(array)
+            blocks.append(block)
+            specs.append(spec)
+
+        pool = get_pool(workers)
+        futures = []
+        for start, end in shard_bounds(lengths, workers):
+            row_start = int(offsets[start])
+            row_end = int(offsets[end - 1] + lengths[end - 1])
+            futures.append(pool.submit(
+                _score_shard, kernel, segmented_specs, broadcast_specs,
+                row_start, row_end, offsets[start:end] - row_start
+            ))
+        return np.concatenate([future.result() for future in futures])
+    except Exception as e:
+        logger.error(f"Parallel scoring failed, scoring in-process: {e}")
+        shutdown_pool()
+        return kernel(list(segmented), offsets, *broadcast)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
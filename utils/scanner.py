@@ -1,42 +1,92 @@
 import os
-import re
+import time
+import heapq
 from collections import Counter
 import math
 from utils.db import get_db
-from utils.ai_matcher import ai_match
+from utils.ai_matcher import max_chunk_similarity_many
+from utils.text_pipeline import (normalize_text, prepare_text, store_document_text, load_document_texts,
+                                 stale_documents, scoring_text)
+from utils.embeddings import encode_document, store_document_embeddings, load_document_embeddings
+from utils.ann_index import add_to_index, drop_user_index, ann_candidates
+from utils.term_index import MIN_SHARED_TERMS, index_terms, lexical_scores
+from utils.minhash import LSH_THRESHOLD, index_minhash, unhashed_documents, lsh_candidates
+from utils.tfidf import add_document as add_to_tfidf, unvectorized_documents, tfidf_scores
+from utils.blob_store import put_text
+from utils.score_cache import scorer_key, cached_scores, store_scores
+from utils.ingest import read_upload, store_content_hash, backfill_content_hashes, find_duplicate
+from utils.metrics import stage, STAGE_SECONDS, DOCUMENTS_SCANNED, MATCH_REQUESTS, PAIRS_SCORED, PAIR_CACHE
 from werkzeug.utils import secure_filename
-from flask import current_app
 
 DOCUMENTS_FOLDER = os.path.join('data', 'documents')
 
+# Scoring cascade per mode. Lexical scores are computed for every candidate;
+# the AI scorer then only runs on candidates whose lexical score reaches
+# `prefilter`, the `top_m` best by lexical score, the first `ann_top_m` of
+# the ANN shortlist and LSH near-duplicates. None AI-scores every candidate.
+MATCH_MODES = {
+    "fast": {"prefilter": 0.3, "top_m": 20, "ann_top_m": 20},
+    "balanced": {"prefilter": 0.1, "top_m": 100, "ann_top_m": 200},
+    "exhaustive": None
+}
+MATCH_MODE = os.environ.get('DOCSCAN_MATCH_MODE', 'balanced')
+if MATCH_MODE not in MATCH_MODES:
+    raise ValueError(f"Unknown DOCSCAN_MATCH_MODE: {MATCH_MODE}")
+# Final score at which a match counts as similar.
+SIMILAR_THRESHOLD = 0.5
+
 def scan_document(username, file):
+    """
+    Store an uploaded document and build its indexes, reading the upload
+    once. An upload identical to one of the user's documents is not stored
+    again; it resolves to that document as a 1.0 match.
+    """
     conn = get_db()
     
     try:
         filename = secure_filename(file.filename)
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        
-        file.save(file_path)
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            try:
-                with open(file_path, 'r', encoding='latin-1') as f:
-                    content = f.read()
-            except Exception:
-                with open(file_path, 'rb') as f:
-                    content = f.read().decode('utf-8', errors='replace')
+        with stage("read_upload"):
+            upload = read_upload(file.stream)
 
-        cursor = conn.execute(
-            'INSERT INTO documents (username, filename, content) VALUES (?, ?, ?)',
-            (username, filename, content))
-        doc_id = cursor.lastrowid
-        conn.commit()
-        
-        conn.execute('UPDATE users SET credits = credits - 1 WHERE username = ?', (username,))
-        conn.commit()
+        backfill_content_hashes(conn, username)
+        if conn.in_transaction:
+            conn.commit()
+        duplicate = find_duplicate(conn, username, upload["sha256"])
+        if duplicate:
+            conn.execute('UPDATE users SET credits = credits - 1 WHERE username = ?', (username,))
+            conn.commit()
+            DOCUMENTS_SCANNED.inc()
+            return {
+                "success": True,
+                "document_id": duplicate["id"],
+                "duplicate_of": duplicate["id"],
+                "matches": [{
+                    "id": duplicate["id"],
+                    "filename": duplicate["filename"],
+                    "similarity": 1.0,
+                    "is_similar": 1,
+                    "metrics": {"jaccard": 1.0, "cosine": 1.0, "ai": 1.0}
+                }]
+            }
+
+        # Derive and encode before the first write: the write lock is then
+        # held for the inserts only, not through model inference.
+        with stage("index_document"):
+            prepared = prepare_document(upload["content"], upload["normalized"], upload["term_counts"])
+        blob_key = put_text(upload["content"])
+
+        with stage("store_document"):
+            cursor = conn.execute(
+                "INSERT INTO documents (username, filename, content, blob_key) VALUES (?, ?, '', ?)",
+                (username, filename, blob_key))
+            doc_id = cursor.lastrowid
+            store_content_hash(conn, username, doc_id, upload["sha256"])
+            embeddings = index_document(conn, username, doc_id, upload["content"], prepared=prepared)
+            conn.execute('UPDATE users SET credits = credits - 1 WHERE username = ?', (username,))
+            conn.commit()
+        if embeddings is not None:
+            add_to_index(username, doc_id, embeddings)
+        DOCUMENTS_SCANNED.inc()
         
         return {"success": True, "document_id": doc_id}
     except Exception as e:
@@ -44,45 +94,224 @@ def scan_document(username, file):
         return {"error": str(e)}
 
 
-def get_matches(username, doc_id):
+def prepare_document(content, normalized=None, term_counts=None):
+    """
+    Derive a document's text artifacts and encode its chunks without
+    touching the database. Returns (text, encoded), encoded being None
+    without a model or stemmed text.
+    """
+    text = prepare_text(content, normalized, term_counts)
+    encoded = encode_document(text["stemmed"]) if text["stemmed"] is not None else None
+    return text, encoded
+
+
+def index_document(conn, username, doc_id, content, normalized=None, term_counts=None, prepared=None):
+    """
+    Compute and store the per-document artifacts that get_matches reuses,
+    so matching never has to re-derive them from the raw content. Pass
+    prepare_document's output as `prepared` to keep that work outside the
+    caller's write transaction. Returns the chunk embeddings, or None; the
+    caller adds them to the ANN index once the document is committed.
+    """
+    text, encoded = prepared or prepare_document(content, normalized, term_counts)
+    store_document_text(conn, doc_id, text)
+    return index_text(conn, username, doc_id, text, encoded)
+
+
+def index_text(conn, username, doc_id, text, encoded=None):
+    """
+    Build the per-document indexes from a document's text artifacts and,
+    when given, its encoded chunks (see prepare_document; encoded here
+    otherwise). Each index replaces the document's previous entry, so this
+    is safe to re-run. Returns the chunk embeddings, or None without a model.
+    """
+    index_terms(conn, username, doc_id, text["term_counts"])
+    index_minhash(conn, username, doc_id, text["normalized"].split())
+
+    add_to_tfidf(conn, username, doc_id, scoring_text(text).split())
+    if text["stemmed"] is None:
+        # Re-indexed by refresh_document_indexes once NLTK has loaded.
+        return None
+    if encoded is None:
+        encoded = encode_document(text["stemmed"])
+    return None if encoded is None else store_document_embeddings(conn, doc_id, encoded)
+
+
+def refresh_document_indexes(conn, username):
+    """
+    Re-derive the user's documents that were stored before the text
+    pipeline existed, under an older PIPELINE_VERSION, or without stemmed
+    text before NLTK loaded, and rebuild their indexes. Documents hashed
+    under different LSH parameters are re-hashed.
+    """
+    stale = stale_documents(conn, username)
+    for doc_id in stale:
+        text = load_document_texts(conn, [doc_id])[doc_id]
+        # Encode outside the transaction and commit per document, so the
+        # write lock is never held through model inference.
+        if conn.in_transaction:
+            conn.commit()
+        encoded = encode_document(text["stemmed"]) if text["stemmed"] is not None else None
+        index_text(conn, username, doc_id, text, encoded)
+        conn.commit()
+    if stale:
+        # Rebuilt from the refreshed embeddings on the next ANN query.
+        drop_user_index(username)
+
+    unhashed = unhashed_documents(conn, username)
+    texts = load_document_texts(conn, unhashed)
+    for doc_id in unhashed:
+        index_minhash(conn, username, doc_id, texts[doc_id]["normalized"].split())
+
+    if stale or unhashed:
+        conn.commit()
+
+
+def backfill_tfidf_model(conn, username):
+    """
+    Add documents indexed before they could be vectorized to the TF-IDF
+    model.
+    """
+    missing = unvectorized_documents(conn, username)
+    texts = load_document_texts(conn, missing)
+    for doc_id in missing:
+        if doc_id in texts:
+            add_to_tfidf(conn, username, doc_id, scoring_text(texts[doc_id]).split())
+    if missing:
+        conn.commit()
+
+
+def find_near_duplicates(username, doc_id, threshold=LSH_THRESHOLD, verify=False):
+    """
+    Near-duplicates of a document found through the LSH band table, with
+    MinHash-estimated Jaccard. With verify, candidates are re-scored with
+    the exact Jaccard from the term index before thresholding.
+    """
+    conn = get_db()
+    if not conn.execute('SELECT id FROM documents WHERE id = ? AND username = ?',
+                        (doc_id, username)).fetchone():
+        return None
+
+    refresh_document_indexes(conn, username)
+    estimates = lsh_candidates(conn, username, doc_id)
+    exact = lexical_scores(conn, username, doc_id, only=list(estimates)) if verify else {}
+
+    docs = {doc["id"]: doc["filename"] for doc in fetch_documents(conn, username, list(estimates))}
+    duplicates = []
+    for candidate, estimate in estimates.items():
+        jaccard = exact.get(candidate, {}).get("jaccard", 0) if verify else estimate
+        if jaccard >= threshold and candidate in docs:
+            duplicates.append({
+                "id": candidate,
+                "filename": docs[candidate],
+                "jaccard": round(jaccard, 2),
+                "estimated_jaccard": round(estimate, 2)
+            })
+    return sorted(duplicates, key=lambda x: x["jaccard"], reverse=True)
+
+
+def get_matches(username, doc_id, progress=None, top_k=None, min_score=0.0, mode=None):
+    """
+    Score the target document against the user's other documents through
+    the cascade of MATCH_MODES[mode], and return the top_k matches scoring
+    at least min_score, best first. `progress`, if given, is called with
+    the completed fraction (0-1) as the stages finish.
+    """
+    report = progress or (lambda fraction: None)
+    mode = mode or MATCH_MODE
+    if mode not in MATCH_MODES:
+        raise ValueError(f"Unknown match mode: {mode}")
+    MATCH_REQUESTS.inc(mode=mode)
+    with stage("get_matches"):
+        return _get_matches(username, doc_id, report, top_k, min_score, mode)
+
+
+def _get_matches(username, doc_id, report, top_k, min_score, mode):
     conn = get_db()
 
-    cursor = conn.execute('SELECT content, filename FROM documents WHERE id = ?', (doc_id,))
+    cursor = conn.execute('SELECT id, filename FROM documents WHERE id = ?', (doc_id,))
     target_doc = cursor.fetchone()
     if not target_doc:
         return {"error": "Document not found"}, 404
 
-    target_content = target_doc["content"]
     target_filename = target_doc["filename"]
 
-    cursor = conn.execute(
-        'SELECT id, filename, content FROM documents WHERE username = ? AND id != ?',
-        (username, doc_id)
-    )
-    docs = cursor.fetchall()
+    with stage("refresh_indexes"):
+        refresh_document_indexes(conn, username)
+    report(0.2)
+    with stage("lexical"):
+        lexical = lexical_scores(conn, username, doc_id)
+        candidate_ids = [i for i, scores in lexical.items() if scores["shared_content"] >= MIN_SHARED_TERMS]
+        # Near-duplicates are always scored, whatever the term threshold or ANN cut.
+        near_duplicates = set(lsh_candidates(conn, username, doc_id))
+        candidate_ids = list(dict.fromkeys(candidate_ids + list(near_duplicates)))
+
+    with stage("ann"):
+        target_embeddings = load_document_embeddings(conn, [doc_id]).get(doc_id)
+        ai_ids = ann_candidates(conn, username, doc_id, target_embeddings)
+    ann_ranked = ai_ids is not None
+    if ai_ids is None:
+        ai_ids = candidate_ids
+    else:
+        candidate_ids = list(dict.fromkeys(candidate_ids + ai_ids))
+
+    report(0.4)
+    docs = fetch_documents(conn, username, candidate_ids)
+    fetched = {doc["id"] for doc in docs}
+    ai_ids = [i for i in ai_ids if i in fetched]
+    basic_scores = {
+        i: (metrics.get("jaccard", 0) + metrics.get("cosine", 0)) / 2 for i, metrics in lexical.items()
+    }
+    selected = cascade_ai_ids(ai_ids, basic_scores, near_duplicates, ann_ranked, mode)
+
+    # Only pairs never seen under this scorer (or seen but not AI-scored
+    # then) are scored; everything else comes from the pair cache.
+    scorer = scorer_key()
+    with stage("cache_lookup"):
+        cached = cached_scores(conn, doc_id, [doc["id"] for doc in docs], scorer)
+    to_score = [i for i in selected if cached.get(i) is None]
+    with stage("ai_scoring"):
+        fresh = dict(zip(to_score, score_ai(conn, username, doc_id, target_embeddings, to_score)))
+    PAIRS_SCORED.inc(len(docs), scorer="lexical")
+    PAIRS_SCORED.inc(len(to_score), scorer="ai")
+    # Reported before this connection starts writing, so a progress hook on
+    # another connection is never blocked by its transaction.
+    report(0.8)
+    new_ids = {doc["id"] for doc in docs if doc["id"] not in cached or doc["id"] in fresh}
+    PAIR_CACHE.inc(len(docs) - len(new_ids), result="hit")
+    PAIR_CACHE.inc(len(new_ids), result="miss")
+    # Pair cache and scan_results writes, up to the commit.
+    store_started = time.perf_counter()
+    store_scores(conn, doc_id, {i: fresh.get(i) for i in new_ids}, scorer)
+    ai_scores = {i: score for i, score in cached.items() if score is not None}
+    ai_scores.update(fresh)
 
     matches = []
     for doc in docs:
-        jaccard_sim = calculate_similarity(target_content, doc["content"])
-        cosine_sim = calculate_cosine_similarity(target_content, doc["content"])
+        metrics = lexical.get(doc["id"], {})
+        jaccard_sim = metrics.get("jaccard", 0)
+        cosine_sim = metrics.get("cosine", 0)
+        ai_score = ai_scores.get(doc["id"], 0.0)
         
-        ai_score = ai_match(target_content, doc["content"])
-        
-        basic_score = (jaccard_sim + cosine_sim) / 2
+        basic_score = basic_scores.get(doc["id"], 0)
         final_score = max(basic_score, ai_score)
 
-        is_similar = 1 if final_score >= 0.5 else 0
+        is_similar = 1 if final_score >= SIMILAR_THRESHOLD else 0
 
-        conn.execute('''
-            INSERT INTO scan_results (username, doc_id, matched_doc_id, final_score, is_similar)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (username, doc_id, doc["id"], final_score, is_similar))
+        if doc["id"] in new_ids:
+            conn.execute('''
+                INSERT INTO scan_results (username, doc_id, matched_doc_id, final_score, is_similar)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (username, doc_id, doc["id"], final_score, is_similar))
 
+        if final_score < min_score:
+            continue
         matches.append({
             "id": doc["id"],
             "filename": doc["filename"],
             "similarity": round(final_score, 2),
             "is_similar": is_similar,
+            "score": final_score,
             "metrics": {
                 "jaccard": round(jaccard_sim, 2),
                 "cosine": round(cosine_sim, 2),
@@ -90,10 +319,85 @@ def get_matches(username, doc_id):
             }
         })
 
-    matches = sorted(matches, key=lambda x: x["similarity"], reverse=True)
+    above_min_score = len(matches)
+    if top_k is not None and top_k < len(matches):
+        # Bounded heap: O(n log k) instead of sorting every match.
+        matches = heapq.nlargest(top_k, matches, key=lambda x: x["score"])
+    else:
+        matches.sort(key=lambda x: x["score"], reverse=True)
+    for match in matches:
+        del match["score"]
     
     conn.commit()
-    return {"matches": matches, "source": target_filename}
+    STAGE_SECONDS.observe(time.perf_counter() - store_started, stage="store_results")
+    return {
+        "matches": matches,
+        "source": target_filename,
+        "cache": {"hits": len(docs) - len(new_ids), "misses": len(new_ids)},
+        "cascade": {
+            "mode": mode,
+            "candidates": len(docs),
+            "ai_candidates": len(ai_ids),
+            "pruned_before_ai": len(ai_ids) - len(selected),
+            "ai_cached": len(selected) - len(to_score),
+            "ai_scored": len(to_score),
+            "below_min_score": len(docs) - above_min_score,
+            "beyond_top_k": above_min_score - len(matches),
+            "returned": len(matches)
+        }
+    }
+
+
+def cascade_ai_ids(ai_ids, basic_scores, always, ann_ranked, mode):
+    """
+    The candidates (in ai_ids order) the AI scorer runs on under a cascade
+    mode. `always` are scored regardless; `ann_ranked` means ai_ids is an
+    ANN shortlist, nearest first.
+    """
+    settings = MATCH_MODES[mode]
+    if settings is None:
+        return list(ai_ids)
+
+    keep = {i for i in ai_ids if i in always or basic_scores.get(i, 0) >= settings["prefilter"]}
+    keep.update(heapq.nlargest(settings["top_m"], ai_ids, key=lambda i: basic_scores.get(i, 0)))
+    if ann_ranked:
+        keep.update(ai_ids[:settings["ann_top_m"]])
+    return [i for i in ai_ids if i in keep]
+
+
+def score_ai(conn, username, doc_id, target_embeddings, candidate_ids):
+    """
+    AI similarity of the target against each candidate, from stored chunk
+    embeddings, or from the user's TF-IDF model when no transformer is
+    available.
+    """
+    if not candidate_ids:
+        return []
+
+    if target_embeddings is None:
+        backfill_tfidf_model(conn, username)
+        return [float(score) for score in tfidf_scores(conn, username, doc_id, candidate_ids)]
+
+    embeddings = load_document_embeddings(conn, candidate_ids)
+    return [float(score) for score in
+            max_chunk_similarity_many(target_embeddings, [embeddings.get(i) for i in candidate_ids])]
+
+
+def fetch_documents(conn, username, doc_ids):
+    """
+    Load id and filename of the given documents owned by username, in
+    batches that stay under SQLite's bound-parameter limit.
+    """
+    docs = []
+    for start in range(0, len(doc_ids), 500):
+        batch = doc_ids[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(
+            f'SELECT id, filename FROM documents WHERE username = ? AND id IN ({placeholders})',
+            (username, *batch)
+        )
+        docs.extend(cursor.fetchall())
+    return docs
 
 
 def calculate_similarity(doc1, doc2):
@@ -149,11 +453,4 @@ def preprocess_text(text):
     """
     Basic text preprocessing for similarity calculation
     """
-    if not isinstance(text, str):
-        return ""
-    
-    text = re.sub(r'[^\w\s]', ' ', text.lower())
-    
-    text = re.sub(r'\s+', ' ', text).strip()
-    
-    return text
+    return normalize_text(text)
@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import OrderedDict
+from utils.ai_matcher import MODEL_KEY, get_model
+from utils.text_pipeline import PIPELINE_VERSION
+
+# Bump whenever get_matches scores pairs differently; cached scores from
+# older versions are ignored and purged. Scores from the other backend
+# (model or TF-IDF) are kept: processes can disagree on whether the model is
+# loaded, e.g. while one is still warming up.
+SCORER_VERSION = 1
+# Pair scores kept in the in-process LRU in front of the pair_scores table.
+SCORE_CACHE_SIZE = int(os.environ.get('DOCSCAN_SCORE_CACHE_SIZE', 100000))
+
+_lru = OrderedDict()
+_lock = threading.Lock()
+_stats = {"lru_hits": 0, "db_hits": 0, "misses": 0}
+_purged = set()
+
+def _version_prefix():
+    return f"v{SCORER_VERSION}:p{PIPELINE_VERSION}:"
+
+def scorer_key():
+    """Identity of the current scorer: version, text pipeline and AI backend."""
+    backend = MODEL_KEY if get_model() is not None else 'tfidf'
+    return _version_prefix() + backend
+
+def _pair(doc_id, other_id):
+    return (doc_id, other_id) if doc_id < other_id else (other_id, doc_id)
+
+def _remember(key, score):
+    _lru[key] = score
+    _lru.move_to_end(key)
+    while len(_lru) > SCORE_CACHE_SIZE:
+        _lru.popitem(last=False)
+
+def purge_stale_scores(conn):
+    """Drop cached scores written under another scorer or pipeline version."""
+    prefix = _version_prefix()
+    conn.execute('DELETE FROM pair_scores WHERE substr(scorer, 1, ?) != ?', (len(prefix), prefix))
+    # Committed even when nothing matched: the DELETE still opened a write
+    # transaction, which would otherwise stay open through scoring.
+    conn.commit()
+    with _lock:
+        for key in [key for key in _lru if not key[2].startswith(prefix)]:
+            del _lru[key]
+
+def cached_scores(conn, doc_id, candidate_ids, scorer):
+    """
+    Cached AI scores of the target against each candidate pair seen before,
+    from the LRU or the pair_scores table, in either direction. A None score
+    means the pair was seen but not AI-scored. Unseen pairs are left out.
+    """
+    if _version_prefix() not in _purged:
+        purge_stale_scores(conn)
+        _purged.add(_version_prefix())
+
+    found, missing = {}, []
+    with _lock:
+        for other_id in candidate_ids:
+            key = (*_pair(doc_id, other_id), scorer)
+            if key in _lru:
+                _lru.move_to_end(key)
+                found[other_id] = _lru[key]
+            else:
+                missing.append(other_id)
+
+    db_found = {}
+    for start in range(0, len(missing), 500):
+        batch = missing[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(f'''
+            SELECT doc_b AS other_id, score FROM pair_scores
+            WHERE doc_a = ? AND doc_b IN ({placeholders}) AND scorer = ?
+            UNION ALL
+            SELECT doc_a AS other_id, score FROM pair_scores
+            WHERE doc_b = ? AND doc_a IN ({placeholders}) AND scorer = ?
+        ''', (doc_id, *batch, scorer, doc_id, *batch, scorer))
+        for row in cursor.fetchall():
+            db_found[row["other_id"]] = row["score"]
+
+    with _lock:
+        for other_id, score in db_found.items():
+            _remember((*_pair(doc_id, other_id), scorer), score)
+        _stats["lru_hits"] += len(found)
+        _stats["db_hits"] += len(db_found)
+        _stats["misses"] += len(missing) - len(db_found)
+    found.update(db_found)
+    return found
+
+def store_scores(conn, doc_id, scores, scorer):
+    """Cache the target's scores ({other_id: score or None}) for both directions."""
+    rows = [(*_pair(doc_id, other_id), scorer, score) for other_id, score in scores.items()]
+    conn.executemany(
+        'INSERT OR REPLACE INTO pair_scores (doc_a, doc_b, scorer, score) VALUES (?, ?, ?, ?)',
+        rows
+    )
+    with _lock:
+        for doc_a, doc_b, key_scorer, score in rows:
+            _remember((doc_a, doc_b, key_scorer), score)
+
+def cache_stats():
+    """Lookups served by the LRU, by SQLite and not at all, with hit rates."""
+    with _lock:
+        stats = dict(_stats)
+    lookups = sum(stats.values())
+    stats["lru_size"] = len(_lru)
+    stats["hit_rate"] = round((stats["lru_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+    stats["lru_hit_rate"] = round(stats["lru_hits"] / lookups, 4) if lookups else 0.0
+    return stats
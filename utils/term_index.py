@@ -0,0 +1,85 @@
+import os
+import math
+
+# Documents must share at least this many distinct terms with the target,
+# not counting stopwords, to be considered by a match request. The floor is
+# 1: only documents sharing a posting are scored at all, so lower values act
+# as 1.
+MIN_SHARED_TERMS = max(1, int(os.environ.get('DOCSCAN_MIN_SHARED_TERMS', 1)))
+
+# English function words shared by almost any two texts; they still count
+# towards Jaccard and cosine, just not towards MIN_SHARED_TERMS. Kept here
+# rather than taken from NLTK so matching does not need its data.
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have
+having he her here hers herself him himself his how i if in into is it its itself just me more most
+my myself no nor not now of off on once only or other our ours ourselves out over own same she should
+so some such than that the their theirs them themselves then there these they this those through to
+too under until up very was we were what when where which while who whom why will with would you
+your yours yourself yourselves
+""".split())
+_STOP_WORDS_SQL = ','.join(f"'{word}'" for word in sorted(STOP_WORDS))
+
+def index_terms(conn, username, doc_id, counts):
+    """
+    Store a document's postings (term -> term frequency) and its exact
+    term statistics. `counts` maps each normalized term to its frequency.
+    """
+    conn.execute('DELETE FROM term_postings WHERE doc_id = ?', (doc_id,))
+    conn.executemany(
+        'INSERT INTO term_postings (username, term, doc_id, tf) VALUES (?, ?, ?, ?)',
+        [(username, term, doc_id, tf) for term, tf in counts.items()]
+    )
+    norm = math.sqrt(sum(tf * tf for tf in counts.values()))
+    conn.execute(
+        'INSERT OR REPLACE INTO document_terms (doc_id, n_terms, norm) VALUES (?, ?, ?)',
+        (doc_id, len(counts), norm)
+    )
+
+def lexical_scores(conn, username, doc_id, only=None):
+    """
+    Jaccard and term-frequency cosine similarity of the target against every
+    document of the user that shares at least one term with it (or only the
+    given document ids), computed from postings and stored norms alone.
+    Returns {doc_id: {"shared", "shared_content", "jaccard", "cosine"}},
+    where shared_content leaves out STOP_WORDS.
+    """
+    target = conn.execute(
+        'SELECT n_terms, norm FROM document_terms WHERE doc_id = ?', (doc_id,)
+    ).fetchone()
+    if not target or not target["n_terms"]:
+        return {}
+
+    query = f'''
+        SELECT p.doc_id, COUNT(*) AS shared, SUM(t.term NOT IN ({_STOP_WORDS_SQL})) AS shared_content,
+               SUM(p.tf * t.tf) AS dot, dt.n_terms, dt.norm
+        FROM term_postings t
+        JOIN term_postings p
+          ON p.username = t.username AND p.term = t.term AND p.doc_id != t.doc_id
+        JOIN document_terms dt ON dt.doc_id = p.doc_id
+        WHERE t.doc_id = ? AND t.username = ?
+    '''
+    if only is None:
+        rows = conn.execute(query + ' GROUP BY p.doc_id', (doc_id, username)).fetchall()
+    else:
+        rows = []
+        for start in range(0, len(only), 500):
+            batch = only[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows.extend(conn.execute(
+                query + f' AND p.doc_id IN ({placeholders}) GROUP BY p.doc_id',
+                (doc_id, username, *batch)
+            ).fetchall())
+
+    scores = {}
+    for row in rows:
+        union = target["n_terms"] + row["n_terms"] - row["shared"]
+        magnitude = target["norm"] * row["norm"]
+        scores[row["doc_id"]] = {
+            "shared": row["shared"],
+            "shared_content": row["shared_content"],
+            "jaccard": row["shared"] / union if union > 0 else 0,
+            "cosine": row["dot"] / magnitude if magnitude > 0 else 0
+        }
+    return scores
@@ -0,0 +1,153 @@
+import re
+import json
+from collections import Counter
+from utils.ai_matcher import preprocess_text as stem_text, nltk_loaded
+from utils.blob_store import document_body, put_text, get_text
+
+# Bump whenever normalize_text or the stemming step changes output; documents
+# derived with an older version are re-derived the next time they are used.
+PIPELINE_VERSION = 1
+
+def normalize_text(text):
+    """
+    Basic text preprocessing for similarity calculation
+    """
+    if not isinstance(text, str):
+        return ""
+
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+
+    text = re.sub(r'\s+', ' ', text).strip()
+
+    return text
+
+def derive_text(content, normalized=None, term_counts=None):
+    """
+    Run the full preprocessing pipeline over a document once: the
+    normalized text used by the lexical scorers, its term counts, and the
+    stopword-filtered, stemmed text used by the AI scorers (None if the
+    NLTK resources are unavailable). Normalized text and term counts
+    already produced while reading the upload are reused.
+    """
+    if normalized is None:
+        normalized = normalize_text(content)
+    if term_counts is None:
+        term_counts = Counter(normalized.split())
+    try:
+        stemmed = stem_text(normalized)
+    except Exception as e:
+        print(f"Stemming error: {e}")
+        stemmed = None
+
+    return {
+        "normalized": normalized,
+        "stemmed": stemmed,
+        "term_counts": term_counts
+    }
+
+def scoring_text(text):
+    """The stemmed text, or the normalized text when stemming was unavailable."""
+    return text["normalized"] if text["stemmed"] is None else text["stemmed"]
+
+def _put_artifacts(text):
+    # One compressed blob per document; the row keeps only placeholders, with
+    # stemmed NULL when it could not be produced (see load_document_texts).
+    return put_text(json.dumps({
+        "normalized": text["normalized"],
+        "stemmed": text["stemmed"],
+        "term_counts": text["term_counts"]
+    }))
+
+def _inline_artifacts(row):
+    return {"normalized": row["normalized"], "stemmed": row["stemmed"], "term_counts": json.loads(row["term_counts"])}
+
+def prepare_text(content, normalized=None, term_counts=None):
+    """
+    Derive a document's text artifacts and write them to the blob store,
+    without touching the database; store them with store_document_text.
+    """
+    text = derive_text(content, normalized, term_counts)
+    text["blob_key"] = _put_artifacts(text)
+    return text
+
+def store_document_text(conn, doc_id, text):
+    """Point a document's document_text row at artifacts from prepare_text."""
+    conn.execute('''
+        INSERT OR REPLACE INTO document_text (doc_id, pipeline_version, normalized, stemmed, term_counts, blob_key)
+        VALUES (?, ?, '', ?, '', ?)
+    ''', (doc_id, PIPELINE_VERSION, None if text["stemmed"] is None else '', text["blob_key"]))
+    return text
+
+def save_document_text(conn, doc_id, content, normalized=None, term_counts=None):
+    """Derive and store a document's text artifacts; returns them."""
+    return store_document_text(conn, doc_id, prepare_text(content, normalized, term_counts))
+
+def load_document_texts(conn, doc_ids):
+    """
+    Text artifacts for the given document ids, keyed by id. Missing or
+    out-of-date artifacts are derived from the document content and stored.
+    Stored artifacts without stemmed text are returned as they are until
+    NLTK has loaded, and only then derived again.
+    """
+    retry_stemming = nltk_loaded()
+    texts = {}
+    for start in range(0, len(doc_ids), 500):
+        batch = doc_ids[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(f'''
+            SELECT doc_id, normalized, stemmed, term_counts, blob_key FROM document_text
+            WHERE pipeline_version = ? AND (stemmed IS NOT NULL OR NOT ?) AND doc_id IN ({placeholders})
+        ''', (PIPELINE_VERSION, retry_stemming, *batch))
+        for row in cursor.fetchall():
+            # Rows written before migrate_document_texts still hold the text inline.
+            text = json.loads(get_text(row["blob_key"])) if row["blob_key"] else _inline_artifacts(row)
+            texts[row["doc_id"]] = {
+                "normalized": text["normalized"],
+                "stemmed": text["stemmed"],
+                "term_counts": Counter(text["term_counts"])
+            }
+
+    # Derive everything first, so the write lock is only taken for the inserts.
+    derived = {}
+    for doc_id in doc_ids:
+        if doc_id in texts:
+            continue
+        content = document_body(conn, doc_id)
+        if content is not None:
+            derived[doc_id] = prepare_text(content)
+    for doc_id, text in derived.items():
+        texts[doc_id] = store_document_text(conn, doc_id, text)
+    return texts
+
+def migrate_document_texts(conn, batch_size=500):
+    """
+    Move a batch of inline text artifacts into the blob store, leaving only
+    the key in the row. Returns the number moved.
+    """
+    rows = conn.execute(
+        'SELECT doc_id, normalized, stemmed, term_counts FROM document_text WHERE blob_key IS NULL LIMIT ?',
+        (batch_size,)
+    ).fetchall()
+    for row in rows:
+        text = _inline_artifacts(row)
+        conn.execute(
+            "UPDATE document_text SET blob_key = ?, normalized = '', stemmed = ?, term_counts = '' WHERE doc_id = ?",
+            (_put_artifacts(text), None if row["stemmed"] is None else '', row["doc_id"])
+        )
+    conn.commit()
+    return len(rows)
+
+def stale_documents(conn, username):
+    """
+    Ids of the user's documents with no text artifacts for the current
+    pipeline, or, once NLTK has loaded, none with stemmed text.
+    """
+    cursor = conn.execute('''
+        SELECT d.id FROM documents d
+        WHERE d.username = ?
+          AND NOT EXISTS (
+              SELECT 1 FROM document_text t
+              WHERE t.doc_id = d.id AND t.pipeline_version = ? AND (t.stemmed IS NOT NULL OR NOT ?)
+          )
+    ''', (username, PIPELINE_VERSION, nltk_loaded()))
+    return [row["id"] for row in cursor.fetchall()]
@@ -0,0 +1,200 @@
+import os
+import zlib
+from collections import Counter
+import numpy as np
+from utils.parallel import score_segments, PARALLEL_MIN_FEATURES
+
+# Terms are hashed into this many features, so the model needs no vocabulary.
+N_FEATURES = 1 << 20
+# Stored vectors are recomputed once the corpus size has drifted by more than
+# this fraction since they were weighted.
+IDF_DRIFT_TOLERANCE = float(os.environ.get('DOCSCAN_TFIDF_DRIFT', 0.2))
+
+def hashed_counts(tokens):
+    """Term counts of a token stream as sorted (feature, count) arrays."""
+    counts = Counter(zlib.crc32(token.encode()) % N_FEATURES for token in tokens)
+    features = np.array(sorted(counts), dtype=np.int32)
+    return features, np.array([counts[f] for f in features.tolist()], dtype=np.float32)
+
+def idf_weights(df, n_docs):
+    """Smoothed IDF, as sklearn's TfidfVectorizer computes it."""
+    return np.log((1 + n_docs) / (1 + np.asarray(df, dtype=np.float64))) + 1
+
+def weigh(counts, idf):
+    """L2-normalized TF-IDF weights."""
+    weights = (counts * idf).astype(np.float32)
+    norm = np.linalg.norm(weights)
+    return weights / norm if norm > 0 else weights
+
+def corpus_size(conn, username):
+    row = conn.execute('SELECT n_docs FROM tfidf_corpus WHERE username = ?', (username,)).fetchone()
+    return row["n_docs"] if row else 0
+
+def document_frequencies(conn, username, features):
+    """Document frequency of each hashed feature in the user's corpus."""
+    df = {}
+    features = features.tolist()
+    for start in range(0, len(features), 500):
+        batch = features[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(
+            f'SELECT feature, df FROM tfidf_df WHERE username = ? AND feature IN ({placeholders})',
+            (username, *batch)
+        )
+        df.update((row["feature"], row["df"]) for row in cursor.fetchall())
+    return np.array([df.get(f, 0) for f in features], dtype=np.float64)
+
+def add_document(conn, username, doc_id, tokens):
+    """
+    Add a document to the user's TF-IDF model: bump the corpus size and the
+    document frequency of each of its features, then store its vector.
+    Re-adding a document first withdraws its previous features.
+    """
+    features, counts = hashed_counts(tokens)
+    previous = conn.execute('SELECT features FROM tfidf_vectors WHERE doc_id = ?', (doc_id,)).fetchone()
+    if previous:
+        conn.executemany(
+            'UPDATE tfidf_df SET df = df - 1 WHERE username = ? AND feature = ?',
+            [(username, f) for f in np.frombuffer(previous["features"], dtype=np.int32).tolist()]
+        )
+    else:
+        conn.execute('''
+            INSERT INTO tfidf_corpus (username, n_docs) VALUES (?, 1)
+            ON CONFLICT(username) DO UPDATE SET n_docs = n_docs + 1
+        ''', (username,))
+    conn.executemany('''
+        INSERT INTO tfidf_df (username, feature, df) VALUES (?, ?, 1)
+        ON CONFLICT(username, feature) DO UPDATE SET df = df + 1
+    ''', [(username, f) for f in features.tolist()])
+    store_vector(conn, username, doc_id, features, counts)
+
+def store_vector(conn, username, doc_id, features, counts):
+    """Weigh a document's counts with the current IDF and store the vector."""
+    n_docs = corpus_size(conn, username)
+    weights = weigh(counts, idf_weights(document_frequencies(conn, username, features), n_docs))
+    conn.execute('''
+        INSERT OR REPLACE INTO tfidf_vectors (doc_id, username, n_docs, features, counts, weights)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (doc_id, username, n_docs, features.tobytes(), counts.tobytes(), weights.tobytes()))
+
+def unvectorized_documents(conn, username):
+    """Ids of the user's documents that are not in the TF-IDF model yet."""
+    cursor = conn.execute('''
+        SELECT d.id FROM documents d
+        WHERE d.username = ?
+          AND NOT EXISTS (SELECT 1 FROM tfidf_vectors v WHERE v.doc_id = d.id)
+    ''', (username,))
+    return [row["id"] for row in cursor.fetchall()]
+
+def sparse_dot_kernel(segmented, offsets, target):
+    """Dot product of a dense target with each stacked sparse vector."""
+    features, weights = segmented
+    return np.add.reduceat(target[features] * weights, offsets)
+
+def tfidf_scores(conn, username, doc_id, candidate_ids, workers=None):
+    """
+    Cosine similarity of the target's TF-IDF vector against each candidate,
+    computed as one sparse matrix-vector product over the stored vectors
+    (sharded across the scoring pool for large candidate sets).
+    """
+    rows = {}
+    ids = [doc_id] + list(candidate_ids)
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        placeholders = ','.join('?' * len(batch))
+        cursor = conn.execute(
+            f'SELECT doc_id, features, counts, weights FROM tfidf_vectors WHERE doc_id IN ({placeholders})',
+            batch
+        )
+        rows.update((row["doc_id"], row) for row in cursor.fetchall())
+
+    scores = np.zeros(len(candidate_ids), dtype=np.float32)
+    if doc_id not in rows:
+        return scores
+
+    # The target is re-weighted with the current IDF; candidates use their stored weights.
+    target_features = np.frombuffer(rows[doc_id]["features"], dtype=np.int32)
+    target_counts = np.frombuffer(rows[doc_id]["counts"], dtype=np.float32)
+    idf = idf_weights(document_frequencies(conn, username, target_features), corpus_size(conn, username))
+    target = np.zeros(N_FEATURES, dtype=np.float32)
+    target[target_features] = weigh(target_counts, idf)
+
+    present = [i for i, c in enumerate(candidate_ids) if c in rows and rows[c]["features"]]
+    if not present:
+        return scores
+    features = np.concatenate([np.frombuffer(rows[candidate_ids[i]]["features"], dtype=np.int32) for i in present])
+    weights = np.concatenate([np.frombuffer(rows[candidate_ids[i]]["weights"], dtype=np.float32) for i in present])
+    lengths = [len(rows[candidate_ids[i]]["features"]) // 4 for i in present]
+
+    scores[present] = score_segments(
+        sparse_dot_kernel, [features, weights], lengths, broadcast=[target],
+        min_rows=PARALLEL_MIN_FEATURES, workers=workers
+    )
+    return scores
+
+def batch_vectors(token_lists):
+    """
+    L2-normalized TF-IDF vectors of a batch of token lists, weighted with
+    the IDF of the batch itself as the corpus. Returns (features, weights)
+    array pairs; cost is linear in the total number of tokens.
+    """
+    vectors = [hashed_counts(tokens) for tokens in token_lists]
+    if not vectors:
+        return []
+    vocabulary, df = np.unique(np.concatenate([features for features, _ in vectors]), return_counts=True)
+    idf = idf_weights(df, len(vectors))
+    return [(features, weigh(counts, idf[np.searchsorted(vocabulary, features)]))
+            for features, counts in vectors]
+
+def tfidf_similarity_many(target_tokens, candidate_token_lists, workers=None):
+    """
+    Cosine similarity of one token list against many, in memory: hashed
+    sparse TF-IDF vectors with the IDF of the target and candidates, and
+    one sparse matrix-vector product. Needs no stored model.
+    """
+    scores = np.zeros(len(candidate_token_lists), dtype=np.float32)
+    vectors = batch_vectors([target_tokens] + list(candidate_token_lists))
+    target_features, target_weights = vectors[0]
+    candidates = vectors[1:]
+    present = [i for i, (features, _) in enumerate(candidates) if len(features)]
+    if not len(target_features) or not present:
+        return scores
+
+    if len(present) == 1:
+        # One pair: intersecting the sorted features beats a dense target.
+        features, weights = candidates[present[0]]
+        _, ti, ci = np.intersect1d(target_features, features, assume_unique=True, return_indices=True)
+        scores[present[0]] = float(np.dot(target_weights[ti], weights[ci]))
+        return scores
+
+    target = np.zeros(N_FEATURES, dtype=np.float32)
+    target[target_features] = target_weights
+    scores[present] = score_segments(
+        sparse_dot_kernel,
+        [np.concatenate([candidates[i][0] for i in present]), np.concatenate([candidates[i][1] for i in present])],
+        [len(candidates[i][0]) for i in present], broadcast=[target],
+        min_rows=PARALLEL_MIN_FEATURES, workers=workers
+    )
+    return scores
+
+def refresh_stale_vectors(conn, tolerance=IDF_DRIFT_TOLERANCE, batch_size=1000, username=None):
+    """
+    Re-weigh stored vectors (of every user, or just the given one) whose
+    corpus size has drifted past the tolerance since they were computed.
+    Returns the number refreshed.
+    """
+    cursor = conn.execute('''
+        SELECT v.doc_id, v.username, v.features, v.counts
+        FROM tfidf_vectors v
+        JOIN tfidf_corpus c ON c.username = v.username
+        WHERE ABS(c.n_docs - v.n_docs) > ? * MAX(v.n_docs, 1)
+          AND (? IS NULL OR v.username = ?)
+        LIMIT ?
+    ''', (tolerance, username, username, batch_size))
+    stale = cursor.fetchall()
+    for row in stale:
+        store_vector(conn, row["username"], row["doc_id"],
+                     np.frombuffer(row["features"], dtype=np.int32),
+                     np.frombuffer(row["counts"], dtype=np.float32))
+    conn.commit()
+    return len(stale)